@@ -0,0 +1,452 @@
+import argparse
+import contextlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import re
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import generate_city_kml as city_kml
+import generate_city_points as city_points
+from city_grid import GRID_STEP
+
+BENCHMARK_SIZES = [1000, 10000, 100000, 1000000]
+BENCHMARK_REPEAT = 3
+EQUIVALENCE_CELLS = 2000
+REGRESSION_THRESHOLD = 0.2  # flag runs more than 20% slower than the baseline
+RESULTS_FILE = 'benchmark_results.json'  # in the repo root, ignored by git
+BASE_LAT = 39.0
+BASE_LON = -99.0
+EMPTY_CELL_FRACTION = 0.1  # water, parks and airports with no population
+BLANK_VALUE_FRACTION = 0.01  # values left blank in the export
+
+DATA_FOLDER = Path(__file__).parent / 'data'
+STREETS = ['Main St', 'Oak Ave', 'Maple Dr', 'Church Rd', 'Lake Shore Blvd', 'Academy Way']
+TOWNS = [('Bessemer', 'AL', 'Alabama'), ('Aspen', 'CO', 'Colorado'), ('Charleston', 'SC', 'South Carolina'),
+         ('Naples', 'FL', 'Florida'), ('Baltimore', 'MD', 'Maryland'), ('Austin', 'TX', 'Texas')]
+
+def synthetic_city(cells, seed=0):
+    """A demographics table shaped like the real exports.
+
+    Cells sit on the 0.015 degree lattice in a roughly square block, with
+    the placeholder columns and one column per data dictionary ID:
+    percentages in [0, 0.3], averages around 100 and counts around 1000.
+    About a tenth of the cells are empty and about 1% of the values blank.
+    """
+    rng = np.random.default_rng(seed)
+    dictionary = pd.read_csv(DATA_FOLDER / 'data_dictionary.csv')
+    width = int(np.ceil(np.sqrt(cells)))
+    index = np.arange(cells)
+    df = pd.DataFrame({
+        'ID': index + 1,
+        'Name': index + 100001,
+        'Address': 0,
+        'City': 0,
+        'State': 0,
+        'Zip': 0,
+        'Latitude': np.round(BASE_LAT + (index // width) * GRID_STEP, 6),
+        'Longitude': np.round(BASE_LON + (index % width) * GRID_STEP, 6)
+    })
+    empty = rng.random(cells) < EMPTY_CELL_FRACTION
+    for key, aggregation in zip(dictionary['ID'], dictionary['Aggregation']):
+        if key.startswith(('X', 'CDA')):
+            values = rng.uniform(0, 0.3, cells)
+        elif aggregation == 'mean':
+            values = rng.gamma(5.0, 20.0, cells)
+        else:
+            values = rng.gamma(2.0, 500.0, cells)
+        values = np.where(empty, 0.0, np.round(values, 2))
+        df[key] = np.where(rng.random(cells) < BLANK_VALUE_FRACTION, np.nan, values)
+    return df
+
+def synthetic_schools(count, seed=0):
+    """A private school table with the messy addresses clean_address handles."""
+    rng = np.random.default_rng(seed)
+    town = rng.integers(len(TOWNS), size=count)
+    street = rng.integers(len(STREETS), size=count)
+    number = rng.integers(1, 9999, size=count)
+    extra = rng.integers(4, size=count)
+    addresses = []
+    for i in range(count):
+        name, code, _ = TOWNS[town[i]]
+        line = f"{number[i]} {STREETS[street[i]]}"
+        if extra[i] == 1:
+            line += f" Suite {number[i] % 300}"
+        elif extra[i] == 2:
+            line += f" # {number[i] % 40}B"
+        address = f"{line}\n{name}, {code} {30000 + number[i]:05d}"
+        if extra[i] != 3:
+            address += f"\n({200 + number[i] % 700}) 555-{number[i]:04d}"
+        addresses.append(address)
+    return pd.DataFrame({
+        'name': [f"School {i}" for i in range(count)],
+        'tuition': np.where(rng.random(count) < 0.2, np.nan, np.round(rng.gamma(2.0, 9000.0, count), -1)),
+        'grades': 'PK-12',
+        'address': addresses,
+        'religion': 'Nonsectarian',
+        'state': [TOWNS[t][2] for t in town],
+        'scraped_at': '2025-02-13T17:24:42'
+    })
+
+def write_city_inputs(workdir, df):
+    """Lay out a data folder like the real one so process_city finds its definitions."""
+    demographics_dir = os.path.join(workdir, 'data', 'demographics')
+    os.makedirs(demographics_dir, exist_ok=True)
+    for name in ['data_dictionary.csv', 'calc_fields.csv', city_kml.OUTPUT_SCHEMA_FILE]:
+        with open(DATA_FOLDER / name, 'rb') as src, open(os.path.join(workdir, 'data', name), 'wb') as dst:
+            dst.write(src.read())
+    input_file = os.path.join(demographics_dir, 'Synthetic.csv')
+    df.to_csv(input_file, index=False)
+    output_dir = os.path.join(workdir, 'KMLs')
+    os.makedirs(output_dir, exist_ok=True)
+    return input_file, output_dir
+
+def legacy_features(df, calc_fields):
+    """Per-row features the way process_city built them before vectorization.
+
+    Names are taken from the column so iterrows' float upcast doesn't
+    turn 100001 into 100001.0.
+    """
+    features = []
+    for name, (_, row) in zip(df['Name'].tolist(), df.iterrows()):
+        metrics = {col: row[col] for col in df.columns if col not in ['Name', 'Latitude', 'Longitude']}
+        for field_name, formula in calc_fields.items():
+            metrics[field_name] = city_kml.evaluate_formula(formula, row)
+        features.append({'Name': name, 'Latitude': row['Latitude'], 'Longitude': row['Longitude'],
+                         'metrics': metrics})
+    return features
+
+def city_metrics(df, calc_fields):
+    metrics = df.drop(columns=['Name', 'Latitude', 'Longitude'])
+    calc_df = city_kml.evaluate_formulas(df, calc_fields)
+    for field_name in calc_df.columns:
+        metrics[field_name] = calc_df[field_name]
+    return metrics
+
+# Each benchmark takes (cells, workdir), does its setup and returns
+# (items processed, callable to time)
+
+def bench_calculate_point_spacing(cells, workdir):
+    df = synthetic_city(cells)
+    return cells, lambda: city_kml.calculate_point_spacing(df)
+
+def bench_evaluate_formula(cells, workdir):
+    df = synthetic_city(cells)
+    calc_fields = city_kml.load_calc_fields(DATA_FOLDER / 'calc_fields.csv')
+    rows = [row for _, row in df.iterrows()]
+    return cells, lambda: [city_kml.evaluate_formula(formula, row)
+                           for row in rows for formula in calc_fields.values()]
+
+def bench_evaluate_formulas(cells, workdir):
+    df = synthetic_city(cells)
+    calc_fields = city_kml.load_calc_fields(DATA_FOLDER / 'calc_fields.csv')
+    return cells, lambda: city_kml.evaluate_formulas(df, calc_fields)
+
+def bench_create_kml_content(cells, workdir):
+    df = synthetic_city(cells)
+    calc_fields = city_kml.load_calc_fields(DATA_FOLDER / 'calc_fields.csv')
+    field_mapping = city_kml.load_data_dictionary(DATA_FOLDER / 'data_dictionary.csv')
+    features = legacy_features(df, calc_fields)
+    return cells, lambda: city_kml.create_kml_content(features, GRID_STEP / 2, GRID_STEP / 2, field_mapping)
+
+def bench_kml_stream_writer(cells, workdir):
+    df = synthetic_city(cells)
+    calc_fields = city_kml.load_calc_fields(DATA_FOLDER / 'calc_fields.csv')
+    field_mapping = city_kml.load_data_dictionary(DATA_FOLDER / 'data_dictionary.csv')
+    metrics = city_metrics(df, calc_fields)
+
+    def run():
+        with city_kml.KMLStreamWriter(os.devnull, GRID_STEP / 2, GRID_STEP / 2, field_mapping) as writer:
+            writer.write_placemarks(df['Name'].tolist(), df['Latitude'], df['Longitude'], metrics)
+    return cells, run
+
+def bench_process_city(cells, workdir):
+    input_file, output_dir = write_city_inputs(workdir, synthetic_city(cells))
+    return cells, lambda: city_kml.process_city(input_file, output_dir, binary=True)
+
+def bench_process_city_chunked(cells, workdir):
+    input_file, output_dir = write_city_inputs(workdir, synthetic_city(cells))
+    return cells, lambda: city_kml.process_city(input_file, output_dir, binary=True,
+                                                chunk_size=city_kml.CSV_CHUNK_SIZE)
+
+def bench_generate_grid_points(cells, workdir):
+    side = int(np.ceil(np.sqrt(cells)))
+    return side * side, lambda: city_points.generate_grid_points(
+        BASE_LAT + (side - 1) * GRID_STEP, BASE_LON, BASE_LAT, BASE_LON + (side - 1) * GRID_STEP)
+
+def bench_save_to_xls(cells, workdir):
+    index = np.arange(cells)
+    data = city_points.create_city_data(np.column_stack([BASE_LAT + index // 1000 * GRID_STEP,
+                                                         BASE_LON + index % 1000 * GRID_STEP]))
+    return cells, lambda: city_points.save_to_xls(data, Path(workdir) / 'points.xls')
+
+def bench_clean_address(cells, workdir):
+    import geocode_schools
+    schools = synthetic_schools(cells)
+    return cells, lambda: [geocode_schools.clean_address(address, state)
+                           for address, state in zip(schools['address'], schools['state'])]
+
+def bench_normalize_addresses(cells, workdir):
+    import geocode_schools
+    schools = synthetic_schools(cells)
+    return cells, lambda: geocode_schools.normalize_addresses(schools)
+
+# name: (benchmark, largest size run unless --no-limits)
+BENCHMARKS = {
+    'calculate_point_spacing': (bench_calculate_point_spacing, None),
+    'evaluate_formula': (bench_evaluate_formula, 10000),
+    'evaluate_formulas': (bench_evaluate_formulas, None),
+    'create_kml_content': (bench_create_kml_content, 10000),
+    'kml_stream_writer': (bench_kml_stream_writer, None),
+    'process_city': (bench_process_city, 100000),
+    'process_city_chunked': (bench_process_city_chunked, 100000),
+    'generate_grid_points': (bench_generate_grid_points, None),
+    'save_to_xls': (bench_save_to_xls, 100000),
+    'clean_address': (bench_clean_address, 100000),
+    'normalize_addresses': (bench_normalize_addresses, None)
+}
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def run_benchmark(name, cells, repeat=BENCHMARK_REPEAT):
+    """Run one benchmark in the current (fresh) process.
+
+    Setup is done once, then the timed call runs repeat times. Peak RSS
+    is reported after setup and after the timed runs.
+    """
+    logging.disable(logging.INFO)
+    benchmark = BENCHMARKS[name][0]
+    with tempfile.TemporaryDirectory() as workdir, contextlib.redirect_stdout(io.StringIO()):
+        items, run = benchmark(cells, workdir)
+        setup_rss = peak_rss_mb()
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - start)
+    best = min(timings)
+    return {
+        'benchmark': name,
+        'cells': cells,
+        'items': items,
+        'seconds': best,
+        'median_seconds': float(np.median(timings)),
+        'throughput': items / best if best > 0 else None,
+        'setup_rss_mb': round(setup_rss, 1),
+        'peak_rss_mb': round(peak_rss_mb(), 1)
+    }
+
+def run_isolated(name, cells, repeat):
+    """Run a benchmark in a freshly spawned process so its peak RSS is its own."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(run_benchmark, name, cells, repeat).result()
+
+def kml_numbers(text):
+    """Names, per-metric values and coordinates of every Placemark in KML text.
+
+    Also returns, per metric, one unit in the last decimal place each
+    value was written with (1 for integers).
+    """
+    names = re.findall(r'<n>(.*?)</n>', text)
+    values = {}
+    units = {}
+    for key, value in re.findall(r'<data name="(.*?)">(.*?)</data>', text):
+        values.setdefault(key, []).append(float(value))
+        decimals = len(value) - value.index('.') - 1 if '.' in value and 'e' not in value else 0
+        units.setdefault(key, []).append(10.0 ** -decimals)
+    coordinates = [float(v) for ring in re.findall(r'<coordinates>(.*?)</coordinates>', text, re.DOTALL)
+                   for point in ring.split() for v in point.split(',')]
+    return (names, {key: np.array(column) for key, column in values.items()}, np.array(coordinates),
+            {key: np.array(column) for key, column in units.items()})
+
+def compare_kml(expected, actual, rtol=0.0):
+    """Compare the numbers in two KML texts; exact unless rtol is given.
+
+    With rtol, values may also differ by one unit in the last place the
+    schema (or the default 2/4 decimals) writes, since a value rounded
+    from float32 can land on the other side of a rounding boundary.
+    """
+    expected_names, expected_values, expected_coordinates, expected_units = kml_numbers(expected)
+    actual_names, actual_values, actual_coordinates, actual_units = kml_numbers(actual)
+    result = {'identical_text': expected == actual, 'cells': len(expected_names),
+              'same_names': expected_names == actual_names,
+              'same_metrics': list(expected_values) == list(actual_values),
+              'same_coordinates': np.array_equal(expected_coordinates, actual_coordinates),
+              'max_abs_diff': 0.0, 'rtol': rtol}
+    matched = result['same_names'] and result['same_metrics']
+    if matched:
+        for key, column in expected_values.items():
+            if len(column) != len(actual_values[key]):
+                matched = False
+                break
+            same = column == actual_values[key]  # also matches infinities
+            difference = np.where(same, 0.0, np.abs(column - actual_values[key]))
+            result['max_abs_diff'] = max(result['max_abs_diff'], float(np.nan_to_num(difference, nan=np.inf).max()))
+            unit = np.maximum(expected_units[key], actual_units[key])
+            tolerance = rtol * np.abs(column) + unit if rtol else 0.0
+            matched = matched and bool(np.all(difference <= tolerance * (1 + 1e-9)))
+    result['equivalent'] = bool(matched and result['same_coordinates'])
+    return result
+
+def check_equivalence(cells=EQUIVALENCE_CELLS):
+    """Check that the faster paths write the same KML numbers as the reference functions.
+
+    The row-by-row evaluate_formula + create_kml_content output is the
+    reference for the vectorized formulas and the streaming writer (exact),
+    and in-memory process_city is the reference for the chunked float32
+    path (relative tolerance 1e-6). Both process_city runs apply the
+    shipped output schema, and the data has blank values, so integer
+    precision columns with missing values are covered.
+    """
+    df = synthetic_city(cells, seed=1)
+    calc_fields = city_kml.load_calc_fields(DATA_FOLDER / 'calc_fields.csv')
+    field_mapping = city_kml.load_data_dictionary(DATA_FOLDER / 'data_dictionary.csv')
+    lat_spacing, lon_spacing = city_kml.calculate_point_spacing(df)
+    reference = city_kml.create_kml_content(legacy_features(df, calc_fields), lat_spacing, lon_spacing,
+                                            field_mapping)
+
+    checks = {}
+    with tempfile.TemporaryDirectory() as workdir, contextlib.redirect_stdout(io.StringIO()):
+        stream_file = os.path.join(workdir, 'stream.kml')
+        with city_kml.KMLStreamWriter(stream_file, lat_spacing, lon_spacing, field_mapping) as writer:
+            writer.write_placemarks(df['Name'].tolist(), df['Latitude'], df['Longitude'],
+                                    city_metrics(df, calc_fields))
+        with open(stream_file, 'r', encoding='utf-8') as f:
+            checks['vectorized_vs_reference'] = compare_kml(reference, f.read())
+
+        input_file, output_dir = write_city_inputs(workdir, df)
+        chunked_dir = os.path.join(workdir, 'chunked')
+        os.makedirs(chunked_dir)
+        city_kml.process_city(input_file, output_dir)
+        city_kml.process_city(input_file, chunked_dir, chunk_size=max(1, cells // 7))
+        with open(city_kml.city_output_file(input_file, output_dir), 'r', encoding='utf-8') as f:
+            in_memory = f.read()
+        with open(city_kml.city_output_file(input_file, chunked_dir), 'r', encoding='utf-8') as f:
+            checks['chunked_vs_in_memory'] = compare_kml(in_memory, f.read(), rtol=1e-6)
+    return checks
+
+def check_school_schema(cells=EQUIVALENCE_CELLS, tuition_threshold=50000, school_radius=3):
+    """Check that the school columns reach the KML and .bin with non-default options.
+
+    Their names carry --tuition-threshold and --school-radius, so the
+    output schema has to match them by pattern rather than by the
+    default names.
+    """
+    df = synthetic_city(cells, seed=2)
+    schools = synthetic_schools(cells // 10, seed=2)
+    rng = np.random.default_rng(2)
+    width = int(np.ceil(np.sqrt(cells))) * GRID_STEP
+    features = [{'type': 'Feature',
+                 'geometry': {'type': 'Point', 'coordinates': [BASE_LON + lon, BASE_LAT + lat]},
+                 'properties': {'tuition': None if np.isnan(tuition) else float(tuition)}}
+                for lon, lat, tuition in zip(rng.uniform(0, width, len(schools)), rng.uniform(0, width, len(schools)),
+                                             schools['tuition'])]
+    with tempfile.TemporaryDirectory() as workdir, contextlib.redirect_stdout(io.StringIO()):
+        input_file, output_dir = write_city_inputs(workdir, df)
+        schools_file = os.path.join(workdir, 'schools.geojson')
+        with open(schools_file, 'w', encoding='utf-8') as f:
+            json.dump({'type': 'FeatureCollection', 'features': features}, f)
+        city_kml.process_city(input_file, output_dir, binary=True, schools_file=schools_file,
+                              tuition_threshold=tuition_threshold, school_radius=school_radius)
+        with open(city_kml.city_output_file(input_file, output_dir), 'r', encoding='utf-8') as f:
+            kml_names = set(kml_numbers(f.read())[1])
+        header, _ = city_kml.read_city_binary(city_kml.city_binary_file(input_file, output_dir))
+        bin_names = {column['name'] for column in header['columns']}
+    expected = [f'Schools Tuition >=${tuition_threshold:,.0f}', f'Mean Tuition within {school_radius} Cells']
+    missing = [name for name in expected if name not in kml_names or name not in bin_names]
+    return {'equivalent': not missing, 'max_abs_diff': 0.0, 'missing': missing}
+
+def compare_with_baseline(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """Print each result against the baseline; return the regressions."""
+    previous = {(r['benchmark'], r['cells']): r for r in baseline.get('results', [])}
+    regressions = []
+    print(f"\n{'benchmark':<26} {'cells':>9} {'baseline s':>11} {'now s':>10} {'ratio':>7}")
+    for result in results:
+        before = previous.get((result['benchmark'], result['cells']))
+        if not before:
+            continue
+        ratio = result['seconds'] / before['seconds'] if before['seconds'] else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions.append(result)
+        print(f"{result['benchmark']:<26} {result['cells']:>9} {before['seconds']:>11.4f} "
+              f"{result['seconds']:>10.4f} {ratio:>7.2f}{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the build pipeline hot paths on synthetic data')
+    parser.add_argument('--sizes', type=int, nargs='+', default=BENCHMARK_SIZES,
+                        help='Cell counts to benchmark (default: 1k 10k 100k 1M)')
+    parser.add_argument('--benchmarks', nargs='+', choices=list(BENCHMARKS),
+                        help='Benchmarks to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=BENCHMARK_REPEAT,
+                        help=f'Timed runs per benchmark; the fastest is reported (default: {BENCHMARK_REPEAT})')
+    parser.add_argument('--no-limits', action='store_true',
+                        help='Also run the slow reference paths at sizes above their usual limit')
+    parser.add_argument('--output', help=f'Results JSON (default: {RESULTS_FILE})')
+    parser.add_argument('--baseline', help='Earlier results JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help=f'Slowdown ratio over the baseline reported as a regression (default: {REGRESSION_THRESHOLD})')
+    parser.add_argument('--skip-check', action='store_true',
+                        help='Skip the KML equivalence check')
+    args = parser.parse_args()
+
+    output_file = args.output or str(Path(__file__).parent / RESULTS_FILE)
+    results = []
+    for name in args.benchmarks or list(BENCHMARKS):
+        limit = BENCHMARKS[name][1]
+        for cells in args.sizes:
+            if limit and cells > limit and not args.no_limits:
+                print(f"{name:<26} {cells:>9}  skipped (above {limit} cells, see --no-limits)")
+                continue
+            result = run_isolated(name, cells, args.repeat)
+            results.append(result)
+            print(f"{name:<26} {cells:>9}  {result['seconds']:9.4f}s  {result['throughput']:>14,.0f}/s  "
+                  f"peak {result['peak_rss_mb']:8.1f} MB")
+
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'results': results
+    }
+    failed = False
+    if not args.skip_check:
+        report['equivalence'] = check_equivalence()
+        report['equivalence']['school_schema'] = check_school_schema()
+        for check, outcome in report['equivalence'].items():
+            status = 'ok' if outcome['equivalent'] else 'MISMATCH'
+            print(f"Equivalence {check}: {status} (max abs diff {outcome['max_abs_diff']:g})")
+            failed = failed or not outcome['equivalent']
+
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} results to {output_file}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare_with_baseline(results, json.load(f), args.threshold)
+        failed = failed or bool(regressions)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
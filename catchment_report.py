@@ -0,0 +1,107 @@
+import argparse
+import os
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from city_grid import CatchmentIndex
+from generate_city_kml import BINARY_EXTENSION, read_city_binary
+
+KML_NS = '{http://www.opengis.net/kml/2.2}'
+SITE_FILES = ['preferred_locations.kml', 'other_locations.kml']
+RADII_KM = [1.0, 3.0, 5.0]
+CATCHMENT_METRICS = ['Kids 5-14 >$250k', 'Kids 5-17 >$250k']
+CATCHMENT_DECIMALS = 2  # the .bin columns are float32, so later digits are noise
+
+def load_sites(kml_file):
+    """Read the name and point of every Placemark in a locations KML."""
+    sites = []
+    for _, element in ET.iterparse(kml_file):
+        if element.tag != f'{KML_NS}Placemark':
+            continue
+        name = element.findtext(f'{KML_NS}name', default='').strip()
+        coordinates = element.findtext(f'.//{KML_NS}Point/{KML_NS}coordinates')
+        if coordinates:
+            lon, lat = map(float, coordinates.strip().split(',')[:2])
+            sites.append({'site': name, 'source': os.path.basename(kml_file), 'lat': lat, 'lon': lon})
+        element.clear()
+    return sites
+
+def load_city_indexes(input_dir, metrics):
+    """Build a CatchmentIndex from every city .bin file in input_dir."""
+    indexes = {}
+    for binary_file in sorted(Path(input_dir).glob(f"*{BINARY_EXTENSION}")):
+        header, columns = read_city_binary(str(binary_file))
+        missing = [name for name in metrics if name not in columns]
+        if missing:
+            print(f"Warning: {', '.join(missing)} not found in {binary_file}")
+        indexes[binary_file.stem] = CatchmentIndex(
+            columns['Latitude'], columns['Longitude'],
+            {name: columns[name] for name in metrics if name in columns},
+            header['spacing']['lat'], header['spacing']['lon'])
+    return indexes
+
+def catchment_report(sites, indexes, metrics, radii_km=RADII_KM, shape='circle'):
+    """Catchment sums for every site, metric and radius.
+
+    Each site is matched to the first city grid whose bounding box holds
+    it; sites outside every grid get empty values. With shape='square'
+    the catchment is the square with half-side radius_km. Sums are
+    rounded to CATCHMENT_DECIMALS places.
+    """
+    report = pd.DataFrame(sites, columns=['site', 'source', 'lat', 'lon'])
+    report['city'] = None
+    for metric in metrics:
+        for radius in radii_km:
+            report[f'{metric} within {radius:g} km'] = np.nan
+
+    lats = report['lat'].to_numpy(dtype=np.float64)
+    lons = report['lon'].to_numpy(dtype=np.float64)
+    unmatched = np.ones(len(report), dtype=bool)
+    for city, index in indexes.items():
+        inside = unmatched & index.contains(lats, lons)
+        if not inside.any():
+            continue
+        unmatched &= ~inside
+        report.loc[inside, 'city'] = city
+        for metric in metrics:
+            if metric not in index.tables:
+                continue
+            for radius in radii_km:
+                if shape == 'square':
+                    values = index.rectangle_sums(metric, lats[inside], lons[inside], radius, radius)
+                else:
+                    values = index.radius_sums(metric, lats[inside], lons[inside], radius)
+                report.loc[inside, f'{metric} within {radius:g} km'] = np.round(values, CATCHMENT_DECIMALS)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Sum grid metrics around candidate sites using summed-area tables')
+    parser.add_argument('--input-dir', help='Directory of city .bin files (default: data/KMLs)')
+    parser.add_argument('--sites', nargs='+', help='Location KMLs (default: preferred and other locations)')
+    parser.add_argument('--metrics', nargs='+', default=CATCHMENT_METRICS,
+                        help='Metric names to sum (default: the Kids >$250k metrics)')
+    parser.add_argument('--radius-km', type=float, nargs='+', default=RADII_KM,
+                        help='Catchment radii in km (default: 1 3 5)')
+    parser.add_argument('--shape', choices=['circle', 'square'], default='circle',
+                        help='Approximate circle or square catchment (default: circle)')
+    parser.add_argument('--output', help='Report CSV (default: data/catchment_report.csv)')
+    args = parser.parse_args()
+
+    base_path = Path(__file__).parent
+    input_dir = Path(args.input_dir) if args.input_dir else base_path / "data/KMLs"
+    site_files = args.sites or [str(base_path / "data" / name) for name in SITE_FILES]
+    output_file = args.output or str(base_path / "data/catchment_report.csv")
+
+    sites = [site for site_file in site_files for site in load_sites(site_file)]
+    indexes = load_city_indexes(input_dir, args.metrics)
+    report = catchment_report(sites, indexes, args.metrics, args.radius_km, args.shape)
+    report.to_csv(output_file, index=False)
+    matched = report['city'].notna().sum()
+    print(f"Wrote catchment sums for {len(report)} sites ({matched} inside a city grid) to {output_file}")
+
+if __name__ == "__main__":
+    main()
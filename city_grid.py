@@ -0,0 +1,250 @@
+import json
+
+import numpy as np
+
+GRID_STEP = 0.015
+KM_PER_DEGREE_LAT = 110.574
+KM_PER_DEGREE_LON = 111.320  # at the equator; scaled by cos(latitude)
+CIRCLE_BANDS = 8
+CELL_ID_OFFSET = 1 << 31
+POLYGON_CHUNK = 1 << 22  # point/edge pairs tested per broadcast
+
+def lattice_index(values, step=GRID_STEP):
+    """Index of the grid cell containing each value along one axis.
+
+    Grid points sit on multiples of step (see generate_city_points.snap_to_grid)
+    and each cell is centered on its point, so this is snap_to_grid applied
+    to value + step / 2, returned as an integer step count.
+    """
+    return np.floor(np.asarray(values, dtype=np.float64) / step + 0.5).astype(np.int64)
+
+def cell_ids(lats, lons, lat_step=GRID_STEP, lon_step=GRID_STEP):
+    """Stable 64-bit IDs of the grid cells containing each point.
+
+    The offset lat index fills the high 32 bits and the offset lon index
+    the low 32 bits, so overlapping city grids on the same lattice give
+    the same ID for the same cell.
+    """
+    lat_index = (lattice_index(lats, lat_step) + CELL_ID_OFFSET).astype(np.uint64)
+    lon_index = (lattice_index(lons, lon_step) + CELL_ID_OFFSET).astype(np.uint64)
+    return (lat_index << np.uint64(32)) | lon_index
+
+def cell_centers(ids, lat_step=GRID_STEP, lon_step=GRID_STEP):
+    """Lat/lon of the cell centers for IDs from cell_ids."""
+    ids = np.asarray(ids, dtype=np.uint64)
+    lat_index = (ids >> np.uint64(32)).astype(np.int64) - CELL_ID_OFFSET
+    lon_index = (ids & np.uint64(0xffffffff)).astype(np.int64) - CELL_ID_OFFSET
+    return np.round(lat_index * lat_step, 6), np.round(lon_index * lon_step, 6)
+
+def lattice_blocks(lats, lons, factor, lat_step=GRID_STEP, lon_step=GRID_STEP):
+    """Group cells into factor x factor blocks of the lattice.
+
+    Returns the center of every occupied block and, per cell, the index
+    of its block, ready for np.bincount.
+    """
+    lat_block = np.floor_divide(lattice_index(lats, lat_step), factor)
+    lon_block = np.floor_divide(lattice_index(lons, lon_step), factor)
+    keys = ((lat_block + CELL_ID_OFFSET).astype(np.uint64) << np.uint64(32)) | \
+           (lon_block + CELL_ID_OFFSET).astype(np.uint64)
+    keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    offset = (factor - 1) / 2
+    block_lats = np.round((lat_block[first] * factor + offset) * lat_step, 6)
+    block_lons = np.round((lon_block[first] * factor + offset) * lon_step, 6)
+    return block_lats, block_lons, inverse.reshape(-1)
+
+def load_boundary(file_path):
+    """Read every ring of a GeoJSON Polygon/MultiPolygon as (n, 2) lon/lat arrays.
+
+    Accepts a bare geometry, a Feature or a FeatureCollection. Holes and
+    separate parts are returned alongside outer rings; points_in_polygon's
+    even-odd rule sorts them out.
+    """
+    with open(file_path, 'r', encoding='utf-8') as f:
+        geojson = json.load(f)
+    geometries = [feature['geometry'] for feature in geojson.get('features', [])] or \
+                 [geojson.get('geometry', geojson)]
+    rings = []
+    for geometry in geometries:
+        if geometry['type'] == 'Polygon':
+            polygons = [geometry['coordinates']]
+        elif geometry['type'] == 'MultiPolygon':
+            polygons = geometry['coordinates']
+        else:
+            continue
+        rings.extend(np.asarray(ring, dtype=np.float64)[:, :2] for polygon in polygons for ring in polygon)
+    return rings
+
+def points_in_polygon(lats, lons, rings):
+    """Even-odd point-in-polygon test of many points against lon/lat rings.
+
+    Points are first filtered by the rings' bounding box, then every
+    remaining point is crossed against the edges in broadcast chunks.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    inside = np.zeros(len(lats), dtype=bool)
+    if not rings:
+        return inside
+    vertices = np.concatenate(rings)
+    candidates = np.flatnonzero((lons >= vertices[:, 0].min()) & (lons <= vertices[:, 0].max()) &
+                                (lats >= vertices[:, 1].min()) & (lats <= vertices[:, 1].max()))
+    if not len(candidates):
+        return inside
+    x, y = lons[candidates, None], lats[candidates, None]
+
+    starts = vertices
+    ends = np.concatenate([np.roll(ring, -1, axis=0) for ring in rings])
+    crossings = np.zeros(len(candidates), dtype=np.int64)
+    step = max(1, POLYGON_CHUNK // len(candidates))
+    for i in range(0, len(starts), step):
+        x0, y0 = starts[i:i + step, 0], starts[i:i + step, 1]
+        x1, y1 = ends[i:i + step, 0], ends[i:i + step, 1]
+        straddles = (y0 > y) != (y1 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+        crossings += (straddles & (x < x_cross)).sum(axis=1)
+    inside[candidates] = crossings % 2 == 1
+    return inside
+
+class CityGrid:
+    """Dense 2D layout of a city's cells indexed by (lat step, lon step).
+
+    Row 0 is the southernmost lattice row and column 0 the westernmost.
+    rows/cols give each cell's position so per-cell arrays can be
+    scattered into the dense array and gathered back in O(1).
+    """
+
+    def __init__(self, lats, lons, lat_step=GRID_STEP, lon_step=GRID_STEP):
+        self.lat_step = lat_step
+        self.lon_step = lon_step
+        lat_index = lattice_index(lats, lat_step)
+        lon_index = lattice_index(lons, lon_step)
+        self.lat_origin = int(lat_index.min()) if len(lat_index) else 0
+        self.lon_origin = int(lon_index.min()) if len(lon_index) else 0
+        self.rows = lat_index - self.lat_origin
+        self.cols = lon_index - self.lon_origin
+        self.shape = (int(self.rows.max()) + 1 if len(self.rows) else 0,
+                      int(self.cols.max()) + 1 if len(self.cols) else 0)
+
+    def locate(self, lats, lons):
+        """Rows, cols and an in-bounds mask for arbitrary points."""
+        rows = lattice_index(lats, self.lat_step) - self.lat_origin
+        cols = lattice_index(lons, self.lon_step) - self.lon_origin
+        inside = (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+        return rows, cols, inside
+
+    def to_dense(self, values, fill=0.0):
+        """Scatter one value per cell into a dense 2D array."""
+        dense = np.full(self.shape, fill, dtype=np.float64)
+        dense[self.rows, self.cols] = values
+        return dense
+
+    def accumulate(self, lats, lons, weights=None):
+        """Sum weights (or count points) into the cell containing each point.
+
+        Points outside the grid's bounding box are ignored.
+        """
+        rows, cols, inside = self.locate(lats, lons)
+        flat = rows[inside] * self.shape[1] + cols[inside]
+        weights = None if weights is None else np.asarray(weights, dtype=np.float64)[inside]
+        counts = np.bincount(flat, weights=weights, minlength=self.shape[0] * self.shape[1])
+        return counts.reshape(self.shape)
+
+def summed_area_table(dense):
+    """Summed-area table with a zero first row and column.
+
+    table[r, c] is the sum of dense[:r, :c], so any rectangle sum takes
+    four lookups.
+    """
+    table = np.zeros((dense.shape[0] + 1, dense.shape[1] + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(dense, axis=0), axis=1, out=table[1:, 1:])
+    return table
+
+def rectangle_sum(table, row_min, col_min, row_max, col_max):
+    """Sum over inclusive row/col ranges, clipped to the table's grid."""
+    rows, cols = table.shape[0] - 1, table.shape[1] - 1
+    r0 = np.clip(np.asarray(row_min), 0, rows)
+    c0 = np.clip(np.asarray(col_min), 0, cols)
+    r1 = np.clip(np.asarray(row_max) + 1, 0, rows)
+    c1 = np.clip(np.asarray(col_max) + 1, 0, cols)
+    r1, c1 = np.maximum(r1, r0), np.maximum(c1, c0)
+    return table[r1, c1] - table[r0, c1] - table[r1, c0] + table[r0, c0]
+
+def window_sum(table, rows, cols, radius):
+    """Sum of the (2 * radius + 1)-cell square around each (row, col)."""
+    return rectangle_sum(table, rows - radius, cols - radius, rows + radius, cols + radius)
+
+class CatchmentIndex:
+    """Summed-area tables for every metric of one city's grid.
+
+    Rectangle and approximate-radius sums around any number of sites cost
+    a fixed number of table lookups per site, whatever the radius. Cells
+    count when their center falls inside the shape, and the cell holding
+    the site always counts, so shapes smaller than a cell are not empty.
+    """
+
+    def __init__(self, lats, lons, metrics, lat_step=GRID_STEP, lon_step=GRID_STEP):
+        self.grid = CityGrid(lats, lons, lat_step, lon_step)
+        self.tables = {name: summed_area_table(self.grid.to_dense(np.asarray(values, dtype=np.float64)))
+                       for name, values in metrics.items()}
+
+    def contains(self, lats, lons):
+        """True for sites inside the grid's bounding box."""
+        return self.grid.locate(lats, lons)[2]
+
+    def _row_bounds(self, lats, offsets_km):
+        """First row whose center lies at or above lat + offset, per site."""
+        degrees = lats + offsets_km / KM_PER_DEGREE_LAT
+        return np.ceil(degrees / self.grid.lat_step - 1e-9).astype(np.int64) - self.grid.lat_origin
+
+    def _row_top(self, lats, offset_km):
+        """Last row whose center lies at or below lat + offset, per site."""
+        degrees = lats + offset_km / KM_PER_DEGREE_LAT
+        return np.floor(degrees / self.grid.lat_step + 1e-9).astype(np.int64) - self.grid.lat_origin
+
+    def _col_range(self, lats, lons, half_width_km):
+        half_width = half_width_km / (KM_PER_DEGREE_LON * np.cos(np.radians(lats)))
+        col_min = np.ceil((lons - half_width) / self.grid.lon_step - 1e-9).astype(np.int64)
+        col_max = np.floor((lons + half_width) / self.grid.lon_step + 1e-9).astype(np.int64)
+        return col_min - self.grid.lon_origin, col_max - self.grid.lon_origin
+
+    def _add_site_cells(self, total, metric, rows, cols, counted):
+        """Add the site's own cell wherever the shape missed its center."""
+        missed = ~counted
+        total[missed] += rectangle_sum(self.tables[metric], rows[missed], cols[missed], rows[missed], cols[missed])
+        return total
+
+    def rectangle_sums(self, metric, lats, lons, half_height_km, half_width_km):
+        """Sum of a metric over the rectangle centered on each site."""
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        row_min = self._row_bounds(lats, -half_height_km)
+        row_max = self._row_top(lats, half_height_km)
+        col_min, col_max = self._col_range(lats, lons, half_width_km)
+        total = rectangle_sum(self.tables[metric], row_min, col_min, row_max, col_max)
+        rows, cols, _ = self.grid.locate(lats, lons)
+        counted = (row_min <= rows) & (rows <= row_max) & (col_min <= cols) & (cols <= col_max)
+        return self._add_site_cells(total, metric, rows, cols, counted)
+
+    def radius_sums(self, metric, lats, lons, radius_km, bands=CIRCLE_BANDS):
+        """Approximate sum of a metric within radius_km of each site.
+
+        The circle is covered by a fixed number of horizontal bands, each
+        a rectangle as wide as the circle at the band's middle, so every
+        query costs 4 * bands lookups.
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        edges = np.linspace(-radius_km, radius_km, bands + 1)
+        bounds = [self._row_bounds(lats, edge) for edge in edges[:-1]]
+        bounds.append(self._row_top(lats, radius_km) + 1)
+
+        rows, cols, _ = self.grid.locate(lats, lons)
+        total = np.zeros(len(lats))
+        counted = np.zeros(len(lats), dtype=bool)
+        for i in range(bands):
+            middle = (edges[i] + edges[i + 1]) / 2
+            col_min, col_max = self._col_range(lats, lons, np.sqrt(radius_km ** 2 - middle ** 2))
+            total += rectangle_sum(self.tables[metric], bounds[i], col_min, bounds[i + 1] - 1, col_max)
+            counted |= (bounds[i] <= rows) & (rows < bounds[i + 1]) & (col_min <= cols) & (cols <= col_max)
+        return self._add_site_cells(total, metric, rows, cols, counted)
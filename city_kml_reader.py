@@ -0,0 +1,246 @@
+import argparse
+import gzip
+import os
+import xml.etree.ElementTree as ET
+import zipfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import pipeline_metrics
+from generate_city_kml import (KML_EXTENSIONS, OUTPUT_SCHEMA_FILE, CityBinaryWriter,
+                               city_binary_file, city_stats_file, load_aggregation_rules, load_data_dictionary,
+                               load_output_schema, resolve_output_schema, schema_columns, write_city_lod,
+                               write_city_stats)
+from generate_city_tiles import load_tile_properties, write_tile_pyramid
+
+KML_NS = '{http://www.opengis.net/kml/2.2}'
+KML_BLOCK_ROWS = 50000  # Placemarks parsed into Python lists before packing into arrays
+SCHOOL_MEAN_PREFIX = 'Mean Tuition within'  # see generate_city_kml.school_metrics
+
+def open_kml(file_path):
+    """Open a .kml, .kml.gz or .kmz (its first .kml member) as a binary stream."""
+    file_path = str(file_path)
+    if file_path.endswith(KML_EXTENSIONS['gzip']):
+        return gzip.open(file_path, 'rb')
+    if file_path.endswith(KML_EXTENSIONS['kmz']):
+        archive = zipfile.ZipFile(file_path)
+        member = next(name for name in archive.namelist() if name.lower().endswith('.kml'))
+        return archive.open(member)
+    return open(file_path, 'rb')
+
+def kml_city_name(file_path):
+    """City name of a KML written by generate_city_kml, without any compression suffix."""
+    name = os.path.basename(str(file_path))
+    for extension in sorted(KML_EXTENSIONS.values(), key=len, reverse=True):
+        if name.endswith(extension):
+            return name[:-len(extension)]
+    return os.path.splitext(name)[0]
+
+def city_kml_files(input_dir):
+    """One KML per city in a directory, preferring the plain .kml.
+
+    --precompress writes a .kml.gz next to each .kml, which would otherwise
+    be read as a second copy of the city.
+    """
+    preference = list(KML_EXTENSIONS.values())
+    by_city = {}
+    for path in Path(input_dir).iterdir():
+        extension = next((extension for extension in preference if path.name.endswith(extension)), None)
+        if extension is not None:
+            by_city.setdefault(kml_city_name(path), []).append((preference.index(extension), str(path)))
+    return [min(candidates)[1] for _, candidates in sorted(by_city.items())]
+
+def parse_float(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return np.nan
+
+def pack_block(count, values):
+    return count, {key: np.array(column, dtype=np.float64) for key, column in values.items()}
+
+def read_city_kml(file_path, block_rows=KML_BLOCK_ROWS):
+    """Stream the Placemarks of a KML into NumPy columns.
+
+    Handles the grid KMLs written by create_kml_content/KMLStreamWriter
+    (<n>, <data name="..."> and a square ring per cell) as well as
+    the location KMLs (<name> and a Point). Returns a header like
+    read_city_binary's, with the count and the grid spacing (zero for
+    points), and a dict of columns: Name, Latitude and Longitude of each
+    cell center, then one float64 array per data name. Values that are
+    missing or not numbers are NaN.
+
+    Elements are cleared as soon as each Placemark is read, so memory
+    holds the columns and one block of Python values, never the tree.
+    """
+    names, lats, lons, half_lats, half_lons = [], [], [], [], []
+    blocks = []
+    block = {}
+    block_count = 0
+    document = None
+    with open_kml(file_path) as f:
+        for event, element in ET.iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                if document is None and element.tag == f'{KML_NS}Document':
+                    document = element
+                continue
+            if element.tag != f'{KML_NS}Placemark':
+                continue
+
+            name = None
+            values = {}
+            coordinates = None
+            for child in element.iter():
+                tag = child.tag
+                if tag == f'{KML_NS}n' or (tag == f'{KML_NS}name' and name is None):
+                    name = (child.text or '').strip()
+                elif tag == f'{KML_NS}data':
+                    values[child.get('name')] = parse_float(child.text)
+                elif tag == f'{KML_NS}Data':
+                    values[child.get('name')] = parse_float(child.findtext(f'{KML_NS}value'))
+                elif tag == f'{KML_NS}coordinates' and coordinates is None:
+                    coordinates = child.text
+            element.clear()
+            if document is not None:
+                document.clear()
+
+            points = [point.split(',') for point in (coordinates or '').split()]
+            if points:
+                point_lons = [float(point[0]) for point in points]
+                point_lats = [float(point[1]) for point in points]
+                west, east = min(point_lons), max(point_lons)
+                south, north = min(point_lats), max(point_lats)
+                lons.append(round((west + east) / 2, 6))
+                lats.append(round((south + north) / 2, 6))
+                half_lons.append((east - west) / 2)
+                half_lats.append((north - south) / 2)
+            else:
+                lons.append(np.nan)
+                lats.append(np.nan)
+                half_lons.append(0.0)
+                half_lats.append(0.0)
+            names.append(name)
+
+            # Columns present in earlier rows but not this one, then new ones
+            for key, column in block.items():
+                column.append(values.pop(key, np.nan))
+            for key, value in values.items():
+                block[key] = [np.nan] * block_count + [value]
+            block_count += 1
+            if block_count == block_rows:
+                blocks.append(pack_block(block_count, block))
+                block = {key: [] for key in block}
+                block_count = 0
+    if block_count:
+        blocks.append(pack_block(block_count, block))
+
+    keys = list(dict.fromkeys(key for _, block_values in blocks for key in block_values))
+    columns = {
+        'Name': np.array(names, dtype=object),
+        'Latitude': np.array(lats, dtype=np.float64),
+        'Longitude': np.array(lons, dtype=np.float64)
+    }
+    for key in keys:
+        columns[key] = np.concatenate([block_values.get(key, np.full(count, np.nan))
+                                       for count, block_values in blocks]) if blocks else np.zeros(0)
+    # Rings are written at 4 decimals, so take the typical cell size
+    header = {
+        'count': len(names),
+        'spacing': {'lat': round(float(np.median(half_lats)) * 2, 6) if half_lats else 0.0,
+                    'lon': round(float(np.median(half_lons)) * 2, 6) if half_lons else 0.0}
+    }
+    return header, columns
+
+def regenerate_city(kml_file, output_dir, data_folder, stats=False, binary=False, lod=False, tiles_dir=None,
+                    tile_properties=None):
+    """Rebuild a city's stats, .bin, LOD levels or tiles from its published KML.
+
+    Display names in the KML are mapped back to data dictionary IDs so the
+    output schema and aggregation rules apply as in a full build. Returns
+    the number of cells read.
+    """
+    city_name = kml_city_name(kml_file)
+    compression = next((key for key, extension in KML_EXTENSIONS.items()
+                        if key and str(kml_file).endswith(extension)), None)
+    # The city_*_file helpers name outputs after the city's demographics file
+    input_file = os.path.join(output_dir, f'{city_name}.csv')
+    print(f"Reading {kml_file}...")
+
+    with pipeline_metrics.stage('read', city=city_name) as read:
+        header, columns = read_city_kml(kml_file)
+        read['rows'] = header['count']
+    field_mapping = load_data_dictionary(os.path.join(data_folder, 'data_dictionary.csv'))
+    rules = load_aggregation_rules(os.path.join(data_folder, 'data_dictionary.csv'))
+    keys = {str(name): key for key, name in field_mapping.items()}
+    metrics = pd.DataFrame({keys.get(name, name): values for name, values in columns.items()
+                            if name not in ['Name', 'Latitude', 'Longitude']})
+    for key in metrics.columns:
+        if str(key).startswith(SCHOOL_MEAN_PREFIX):
+            rules[key] = ('mean', None)
+    schema = resolve_output_schema(load_output_schema(os.path.join(data_folder, OUTPUT_SCHEMA_FILE), city_name),
+                                   metrics.columns, field_mapping)
+    lats, lons = columns['Latitude'], columns['Longitude']
+    lat_spacing, lon_spacing = header['spacing']['lat'] / 2, header['spacing']['lon'] / 2
+
+    if stats:
+        stats_file = city_stats_file(input_file, output_dir)
+        with pipeline_metrics.stage('stats', header['count'], city=city_name):
+            write_city_stats(stats_file, metrics, field_mapping)
+        print(f"Created {stats_file}")
+    if binary:
+        binary_file = city_binary_file(input_file, output_dir)
+        with pipeline_metrics.stage('binary', header['count'], city=city_name), \
+                CityBinaryWriter(binary_file, header['count'], schema_columns(schema, metrics.columns, 'bin'),
+                                 lat_spacing, lon_spacing, field_mapping, schema) as binary_writer:
+            binary_writer.write_rows(0, lats, lons, metrics)
+        print(f"Created {binary_file}")
+    if lod:
+        with pipeline_metrics.stage('lod', header['count'], city=city_name):
+            lod_file = write_city_lod(input_file, output_dir, lats, lons, metrics, lat_spacing, lon_spacing,
+                                      field_mapping, rules, compression=compression, binary=binary, schema=schema)
+        print(f"Created {lod_file}")
+    if tiles_dir:
+        properties = tile_properties or load_tile_properties()
+        missing = [name for name in properties if name not in columns]
+        if missing:
+            print(f"Warning: {', '.join(missing)} not found in {kml_file}")
+        with pipeline_metrics.stage('tiles', header['count'], city=city_name):
+            count = write_tile_pyramid(os.path.join(tiles_dir, city_name), lats, lons, header['spacing']['lat'],
+                                       header['spacing']['lon'],
+                                       {name: np.nan_to_num(columns[name]) for name in properties if name in columns})
+        print(f"Wrote {count} tiles for {city_name} to {os.path.join(tiles_dir, city_name)}")
+    return header['count']
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Regenerate stats, .bin, LOD levels or tiles from existing city KMLs')
+    parser.add_argument('kml_files', nargs='*', help='City KMLs to read (default: one KML per city in --input-dir)')
+    parser.add_argument('--input-dir', help='Directory of city KMLs (default: data/KMLs)')
+    parser.add_argument('--output-dir', help='Directory for the regenerated files (default: the input directory)')
+    parser.add_argument('--data-dir', help='Folder with data_dictionary.csv and output_schema.csv (default: data)')
+    parser.add_argument('--stats', action='store_true', help='Write <city>.stats.json')
+    parser.add_argument('--binary', action='store_true', help='Write the columnar <city>.bin')
+    parser.add_argument('--lod', action='store_true', help='Write 2x/4x/8x block-aggregated levels')
+    parser.add_argument('--tiles-dir', help='Also build vector tile pyramids here')
+    parser.add_argument('--properties', nargs='+',
+                        help='Metric names to carry in the tiles (default: the metrics listed in config.js)')
+    pipeline_metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    base_path = Path(__file__).parent
+    input_dir = Path(args.input_dir) if args.input_dir else base_path / "data/KMLs"
+    output_dir = Path(args.output_dir) if args.output_dir else input_dir
+    data_folder = Path(args.data_dir) if args.data_dir else base_path / "data"
+    kml_files = args.kml_files or city_kml_files(input_dir)
+    if not (args.stats or args.binary or args.lod or args.tiles_dir):
+        parser.error('Nothing to regenerate: pass --stats, --binary, --lod or --tiles-dir')
+
+    with pipeline_metrics.start_run('city_kml_reader', args):
+        for kml_file in kml_files:
+            regenerate_city(kml_file, str(output_dir), str(data_folder), args.stats, args.binary, args.lod,
+                            args.tiles_dir, args.properties)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from city_grid import cell_ids
+from generate_city_kml import BINARY_EXTENSION, read_city_binary
+
+CACHE_BUDGET_BYTES = 512 * 1024 * 1024
+FILTER_BUCKETS = 32
+
+def bucket_bitmaps(values, buckets=FILTER_BUCKETS):
+    """Split a column into quantile buckets with one packed bitmap each.
+
+    Returns the bucket edges (buckets + 1 values, min to max) and a
+    (buckets, ceil(n / 8)) uint8 array whose row b has bit i set when
+    cell i falls in bucket b.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    edges = np.unique(np.quantile(values, np.linspace(0, 1, buckets + 1))) if len(values) else np.zeros(2)
+    if len(edges) < 2:
+        edges = np.array([edges[0], edges[0]])
+    bucket = np.clip(np.searchsorted(edges, values, side='right') - 1, 0, len(edges) - 2)
+    bitmaps = np.packbits(bucket[None, :] == np.arange(len(edges) - 1)[:, None], axis=1)
+    return edges, bitmaps
+
+def filter_rows(values, edges, bitmaps, low=None, high=None):
+    """Row indices with low <= value <= high, answered from bucket bitmaps.
+
+    Buckets lying entirely inside the range are ORed together without
+    looking at the values; only cells in the (at most two) buckets that
+    straddle a bound are compared.
+    """
+    count = len(values)
+    low = -np.inf if low is None else low
+    high = np.inf if high is None else high
+    lower, upper = edges[:-1], edges[1:]
+    # Bucket b holds lower[b] <= v < upper[b] (the last one also v == max)
+    inside = (lower >= low) & (upper <= high)
+    overlaps = (upper >= low) & (lower <= high)
+    selected = np.zeros(bitmaps.shape[1], dtype=np.uint8)
+    for b in np.flatnonzero(inside):
+        selected |= bitmaps[b]
+    rows = np.flatnonzero(np.unpackbits(selected, count=count))
+    boundary = np.flatnonzero(overlaps & ~inside)
+    if len(boundary):
+        candidates = np.flatnonzero(np.unpackbits(np.bitwise_or.reduce(bitmaps[boundary], axis=0), count=count))
+        candidate_values = values[candidates]
+        rows = np.union1d(rows, candidates[(candidate_values >= low) & (candidate_values <= high)])
+    return rows
+
+class CityColumnCache:
+    """City .bin columns held in memory, least recently used first out.
+
+    Cities are loaded from input_dir on first use and evicted once the
+    arrays and bitmaps held exceed budget_bytes; the city just requested
+    is always kept. Bucket bitmaps are built per metric on first query.
+    Safe to share between server threads.
+    """
+
+    def __init__(self, input_dir, budget_bytes=CACHE_BUDGET_BYTES, buckets=FILTER_BUCKETS):
+        self.input_dir = input_dir
+        self.budget_bytes = budget_bytes
+        self.buckets = buckets
+        self.cities = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def city_names(self):
+        return sorted(name[:-len(BINARY_EXTENSION)] for name in os.listdir(self.input_dir)
+                      if name.endswith(BINARY_EXTENSION))
+
+    def get(self, name):
+        """The cached entry for a city, loading it if needed.
+
+        Raises KeyError when the city has no .bin file.
+        """
+        with self._lock:
+            if name in self.cities:
+                self.cities.move_to_end(name)
+                self.hits += 1
+                return self.cities[name]
+        binary_file = os.path.join(self.input_dir, name + BINARY_EXTENSION)
+        if os.path.basename(binary_file) != name + BINARY_EXTENSION or not os.path.isfile(binary_file):
+            raise KeyError(name)
+        header, columns = read_city_binary(binary_file)
+        entry = {
+            'header': header,
+            'columns': {column: np.array(values) for column, values in columns.items()},
+            'bitmaps': {},
+            'lock': threading.Lock()
+        }
+        entry['nbytes'] = sum(values.nbytes for values in entry['columns'].values())
+        with self._lock:
+            self.misses += 1
+            if name not in self.cities:
+                self.cities[name] = entry
+                self.nbytes += entry['nbytes']
+                self._evict(keep=name)
+            self.cities.move_to_end(name)
+            return self.cities[name]
+
+    def _evict(self, keep):
+        while self.nbytes > self.budget_bytes and len(self.cities) > 1:
+            name, entry = next(iter(self.cities.items()))
+            if name == keep:
+                self.cities.move_to_end(name)
+                continue
+            del self.cities[name]
+            self.nbytes -= entry['nbytes']
+
+    def bitmaps(self, name, entry, metric):
+        """Bucket edges and bitmaps for one metric, built once per city."""
+        with entry['lock']:
+            if metric not in entry['bitmaps']:
+                edges, bitmaps = bucket_bitmaps(entry['columns'][metric], self.buckets)
+                entry['bitmaps'][metric] = (edges, bitmaps)
+                with self._lock:
+                    entry['nbytes'] += edges.nbytes + bitmaps.nbytes
+                    if name in self.cities:
+                        self.nbytes += edges.nbytes + bitmaps.nbytes
+                        self._evict(keep=name)
+            return entry['bitmaps'][metric]
+
+    def query(self, name, metric, low=None, high=None):
+        """Rows of a city whose metric lies in [low, high].
+
+        Returns the entry and the matching row indices. Raises KeyError
+        for an unknown city or metric.
+        """
+        entry = self.get(name)
+        if metric not in entry['columns']:
+            raise KeyError(metric)
+        edges, bitmaps = self.bitmaps(name, entry, metric)
+        return entry, filter_rows(entry['columns'][metric], edges, bitmaps, low, high)
+
+    def stats(self):
+        with self._lock:
+            return {'cities': list(self.cities), 'bytes': self.nbytes, 'budget': self.budget_bytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+def row_cell_ids(entry, rows):
+    """Global cell IDs (see city_grid.cell_ids) of the given rows."""
+    spacing = entry['header']['spacing']
+    return cell_ids(entry['columns']['Latitude'][rows], entry['columns']['Longitude'][rows],
+                    spacing['lat'], spacing['lon'])
+
+def rows_geojson(entry, rows, metrics):
+    """A FeatureCollection of the given rows' squares with metric properties."""
+    spacing = entry['header']['spacing']
+    half_lat, half_lon = spacing['lat'] / 2, spacing['lon'] / 2
+    lats = entry['columns']['Latitude'][rows].tolist()
+    lons = entry['columns']['Longitude'][rows].tolist()
+    values = {metric: entry['columns'][metric][rows].tolist() for metric in metrics}
+    ids = row_cell_ids(entry, rows).tolist()
+    features = []
+    for i, (lat, lon) in enumerate(zip(lats, lons)):
+        west, east, south, north = lon - half_lon, lon + half_lon, lat - half_lat, lat + half_lat
+        features.append({
+            'type': 'Feature',
+            'id': str(ids[i]),
+            'geometry': {
+                'type': 'Polygon',
+                'coordinates': [[[west, south], [east, south], [east, north], [west, north], [west, south]]]
+            },
+            'properties': {metric: values[metric][i] for metric in metrics}
+        })
+    return {'type': 'FeatureCollection', 'features': features}
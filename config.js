@@ -8,6 +8,9 @@ const config = {
     zoom: 4,
     
     // City configurations
+    // update_config.py adds binFile, statsFile and lodFile for the .bin,
+    // .stats.json and .lod.json files generate_city_kml.py writes next to
+    // each KML; the .bin is loaded in place of the KML when present
     cities: {
         aspen: {
             name: 'CO - Aspen',
@@ -260,6 +263,9 @@ const config = {
     // Schools configuration
     schools: {
         source: 'data/schools.geojson',
+        // Load only the schools in view once tiles are built with
+        // geocode_schools.py --tiles-dir data/schools_tiles
+        // tileIndex: 'data/schools_tiles/index.json',
         defaultMinTuition: 30000,
         layer: {
             paint: {
@@ -1,7 +1,68 @@
 import pandas as pd
 import numpy as np
 from pathlib import Path
+import argparse
+import gzip
+import hashlib
+import io
+import json
 import os
+import struct
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from fnmatch import fnmatchcase
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import pipeline_metrics
+from city_grid import CityGrid, cell_ids, lattice_blocks, summed_area_table, window_sum
+
+FORMULA_OPERATORS = ['*', '/', '+', '-', '(', ')']
+ZERO_TOLERANCE = 1e-10
+KML_BATCH_SIZE = 2000
+MANIFEST_FILE = 'build_manifest.json'
+BINARY_EXTENSION = '.bin'
+BINARY_VERSION = 1
+STATS_EXTENSION = '.stats.json'
+STATS_QUANTILES = [0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99]
+STATS_BINS = 20
+TUITION_THRESHOLD = 30000
+SCHOOL_RADIUS = 2
+POPULATION_FIELD = 'CYA01V001'  # Total Population
+CSV_CHUNK_SIZE = 50000
+CSV_SAMPLE_ROWS = 1000
+STATS_COLUMN_BATCH = 16
+OUTPUT_SCHEMA_FILE = 'output_schema.csv'
+SCHEMA_FORMATS = ['kml', 'bin']
+SCHEMA_TYPES = ['float32', 'float64', 'uint8', 'uint16', 'uint32', 'int16', 'int32']
+LOD_FACTORS = [2, 4, 8]
+LOD_BASE_MIN_ZOOM = 10  # full-resolution cells from this zoom in
+LOD_DIR = 'lod'
+LOD_EXTENSION = '.lod.json'
+# Bump when a code change alters the generated output so every city rebuilds
+GENERATOR_VERSION = 1
+KML_EXTENSIONS = {None: '.kml', 'gzip': '.kml.gz', 'kmz': '.kmz'}
+
+KML_HEADER = '\n'.join([
+    '<?xml version="1.0" encoding="UTF-8"?>',
+    '<kml xmlns="http://www.opengis.net/kml/2.2">',
+    '<Document>',
+    '<Style id="style_default">',
+    '<PolyStyle>',
+    '<color>66ffffff</color>',  # White with transparency
+    '<outline>0</outline>',
+    '</PolyStyle>',
+    '</Style>'
+])
+KML_FOOTER = '\n'.join(['</Document>', '</kml>'])
+PLACEMARK_START = '<Placemark>\n<styleUrl>#style_default</styleUrl>\n<n>{}</n>'
+PLACEMARK_END = ('<Polygon>\n<outerBoundaryIs>\n<LinearRing>\n'
+                 '<coordinates>{}</coordinates>\n'
+                 '</LinearRing>\n</outerBoundaryIs>\n</Polygon>\n</Placemark>')
 
 def calculate_point_spacing(df):
     """Calculate the spacing between points in the dataset for both latitude and longitude."""
@@ -54,6 +115,91 @@ def load_data_dictionary(file_path):
         print(f"Warning: Could not load data dictionary: {e}")
         return {}
 
+def load_aggregation_rules(file_path):
+    """Load how each data dictionary column combines across cells.
+
+    Columns whose Aggregation is 'mean' (averages, medians, percentages)
+    map to ('mean', weight column or None); everything else is summed.
+    """
+    try:
+        df = pd.read_csv(file_path)
+        if 'Aggregation' not in df.columns:
+            return {}
+        weights = df['Weight'] if 'Weight' in df.columns else pd.Series(np.nan, index=df.index)
+        rules = {}
+        for key, aggregation, weight in zip(df['ID'], df['Aggregation'], weights):
+            if str(aggregation).strip().lower() == 'mean':
+                rules[key] = ('mean', weight if isinstance(weight, str) and weight.strip() else None)
+        return rules
+    except Exception as e:
+        print(f"Warning: Could not load aggregation rules: {e}")
+        return {}
+
+def load_output_schema(file_path, layer=None):
+    """Load the declared output columns that apply to one layer (city).
+
+    Each row names a Metric (column ID or display name) with the Formats
+    it goes to (kml and/or bin, blank for both, 'none' to leave it out),
+    the KML Precision in decimal places, the binary Type and a Scale for
+    integer types. Layer '*' applies to every city; rows naming the city
+    override them. A '*' in Metric matches any text, for columns named
+    after build options such as the school tuition threshold and radius. Returns None when there is no schema file, meaning
+    every metric is written as before.
+    """
+    if not os.path.exists(file_path):
+        return None
+    df = pd.read_csv(file_path, dtype=str, keep_default_na=False)
+    rows = df.to_dict('records')
+    general = [row for row in rows if row.get('Layer', '').strip() in ('', '*')]
+    specific = [row for row in rows if layer is not None and row.get('Layer', '').strip() == layer]
+    schema = {}
+    for row in general + specific:
+        formats = row.get('Formats', '').replace(';', ' ').lower().split() or SCHEMA_FORMATS
+        dtype = row.get('Type', '').strip() or 'float32'
+        if dtype not in SCHEMA_TYPES:
+            raise ValueError(f"Unknown type '{dtype}' for {row['Metric']} in {file_path}")
+        precision = row.get('Precision', '').strip()
+        scale = row.get('Scale', '').strip()
+        schema[row['Metric'].strip()] = {
+            'formats': [name for name in formats if name in SCHEMA_FORMATS],
+            'precision': int(precision) if precision else None,
+            'type': dtype,
+            'scale': float(scale) if scale else 1
+        }
+    return schema
+
+def resolve_output_schema(schema, metric_keys, field_mapping=None):
+    """Key an output schema by metric column, in schema order.
+
+    Returns None when schema is None. Metrics the data has but the schema
+    leaves out are reported once.
+    """
+    if schema is None:
+        return None
+    field_mapping = field_mapping or {}
+    keys_by_name = {}
+    for key in metric_keys:
+        keys_by_name.setdefault(key, key)
+        keys_by_name.setdefault(str(field_mapping.get(key, key)), key)
+    resolved = {}
+    for name, entry in schema.items():
+        if '*' in name:
+            for key in metric_keys:
+                if fnmatchcase(str(key), name) or fnmatchcase(str(field_mapping.get(key, key)), name):
+                    resolved[key] = entry
+        elif name in keys_by_name:
+            resolved[keys_by_name[name]] = entry
+    skipped = [str(field_mapping.get(key, key)) for key in metric_keys if key not in resolved]
+    if skipped:
+        print(f"Not in output schema: {', '.join(skipped)}")
+    return resolved
+
+def schema_columns(schema, metric_keys, output_format):
+    """Metric keys written to one output format ('kml' or 'bin')."""
+    if schema is None:
+        return list(metric_keys)
+    return [key for key, entry in schema.items() if output_format in entry['formats']]
+
 def load_calc_fields(file_path):
     """Load the calculated fields definitions."""
     try:
@@ -134,6 +280,153 @@ def evaluate_formula(formula, row_data):
         print(f"Warning: Could not evaluate formula '{formula}' (processed to '{expr}'): {e}")
         return 0
 
+def tokenize_formula(formula):
+    """Split a formula string into operator, number and variable tokens."""
+    expr = str(formula)
+    for op in FORMULA_OPERATORS:
+        expr = expr.replace(op, f' {op} ')
+    return expr.split()
+
+def compile_formula(formula):
+    """Parse a formula once into an expression tree.
+
+    Nodes are tuples: ('num', value), ('var', name), ('neg', node) and
+    (op, left, right) for the binary operators. Division uses the usual
+    precedence, which matches evaluate_formula for every formula in
+    calc_fields.csv (a single division after the numerator).
+    """
+    tokens = tokenize_formula(formula)
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def take():
+        nonlocal pos
+        token = peek()
+        if token is None:
+            raise ValueError("unexpected end of formula")
+        pos += 1
+        return token
+
+    def parse_sum():
+        node = parse_product()
+        while peek() in ('+', '-'):
+            op = take()
+            node = (op, node, parse_product())
+        return node
+
+    def parse_product():
+        node = parse_unary()
+        while peek() in ('*', '/'):
+            op = take()
+            node = (op, node, parse_unary())
+        return node
+
+    def parse_unary():
+        if peek() == '-':
+            take()
+            return ('neg', parse_unary())
+        if peek() == '+':
+            take()
+            return parse_unary()
+        return parse_atom()
+
+    def parse_atom():
+        token = take()
+        if token == '(':
+            node = parse_sum()
+            if take() != ')':
+                raise ValueError("expected ')'")
+            return node
+        if token in FORMULA_OPERATORS:
+            raise ValueError(f"unexpected '{token}'")
+        if token[0].isdigit():
+            return ('num', float(token))
+        return ('var', token)
+
+    tree = parse_sum()
+    if peek() is not None:
+        raise ValueError(f"unexpected '{peek()}'")
+    return tree
+
+def formula_variables(tree):
+    """Return the set of variable names referenced by a compiled formula."""
+    if tree[0] == 'var':
+        return {tree[1]}
+    if tree[0] == 'num':
+        return set()
+    names = set()
+    for child in tree[1:]:
+        names |= formula_variables(child)
+    return names
+
+def evaluate_compiled(tree, columns, size):
+    """Evaluate a compiled formula over whole columns with NumPy."""
+    kind = tree[0]
+    if kind == 'num':
+        return np.full(size, tree[1])
+    if kind == 'var':
+        values = columns.get(tree[1])
+        return np.zeros(size) if values is None else values
+    if kind == 'neg':
+        return -evaluate_compiled(tree[1], columns, size)
+
+    left = evaluate_compiled(tree[1], columns, size)
+    right = evaluate_compiled(tree[2], columns, size)
+    if kind == '+':
+        return left + right
+    if kind == '-':
+        return left - right
+    if kind == '*':
+        return left * right
+
+    # Safe division: tiny or missing denominators and tiny results give 0
+    valid = np.abs(right) >= ZERO_TOLERANCE
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.where(valid, left / np.where(valid, right, 1.0), 0.0)
+    result[np.abs(result) < ZERO_TOLERANCE] = 0.0
+    return result
+
+def formula_column(df, name):
+    """Numeric column for formula evaluation: NaN and tiny values become 0."""
+    values = pd.to_numeric(df[name], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+    values = np.nan_to_num(values, nan=0.0, posinf=0.0, neginf=0.0)
+    values[np.abs(values) < ZERO_TOLERANCE] = 0.0
+    return values
+
+def evaluate_formulas(df, calc_fields):
+    """Evaluate every calculated field over the whole DataFrame.
+
+    Each formula is parsed once and evaluated as column operations.
+    Missing variables are reported once per formula and treated as 0.
+    Returns a DataFrame with one column per calculated field.
+    """
+    size = len(df)
+    columns = {}
+    results = {}
+    for field_name, formula in calc_fields.items():
+        try:
+            tree = compile_formula(formula)
+        except Exception as e:
+            print(f"Warning: Could not compile formula '{formula}': {e}")
+            results[field_name] = np.zeros(size)
+            continue
+
+        variables = formula_variables(tree)
+        missing = sorted(v for v in variables if v not in df.columns)
+        if missing:
+            print(f"Warning: Variables {', '.join(missing)} not found in data for '{field_name}'")
+        for name in variables:
+            if name not in columns and name in df.columns:
+                columns[name] = formula_column(df, name)
+
+        result = evaluate_compiled(tree, columns, size).astype(np.float64)
+        result = np.nan_to_num(result, nan=0.0, posinf=0.0, neginf=0.0)
+        result[np.abs(result) < ZERO_TOLERANCE] = 0.0
+        results[field_name] = result
+    return pd.DataFrame(results, index=df.index)
+
 def create_kml_content(features, square_size_lat, square_size_lon, field_mapping=None):
     """Create KML content for a set of features."""
     kml = ['<?xml version="1.0" encoding="UTF-8"?>',
@@ -192,64 +485,906 @@ def create_kml_content(features, square_size_lat, square_size_lon, field_mapping
     kml.extend(['</Document>', '</kml>'])
     return '\n'.join(kml)
 
-def write_kml_file(filename, features, square_size_lat, square_size_lon, field_mapping=None):
-    """Write KML content to a file."""
-    kml_content = create_kml_content(features, square_size_lat, square_size_lon, field_mapping)
-    with open(filename, 'w', encoding='utf-8') as f:
-        f.write(kml_content)
+def load_school_points(file_path):
+    """Load school coordinates and tuition (NaN when unknown) from schools.geojson."""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        features = json.load(f)['features']
+    lons = np.array([feature['geometry']['coordinates'][0] for feature in features], dtype=np.float64)
+    lats = np.array([feature['geometry']['coordinates'][1] for feature in features], dtype=np.float64)
+    tuition = np.array([feature['properties'].get('tuition') for feature in features], dtype=np.float64)
+    return lats, lons, tuition
 
-def process_city(input_file, output_kml_dir):
-    """Process a single city's demographics file and create KML."""
-    print(f"Processing {input_file}...")
+def school_metrics(lats, lons, lat_spacing, lon_spacing, schools, tuition_threshold=TUITION_THRESHOLD,
+                   radius=SCHOOL_RADIUS):
+    """Per-cell school counts and tuition from a grid spatial join.
+
+    Each school is assigned to the cell containing it by lattice index,
+    so the join is O(schools + cells). The mean tuition within radius
+    cells comes from summed-area tables rather than pairwise distances.
+    Schools outside the city's bounding box are ignored.
+    """
+    school_lats, school_lons, tuition = schools
+    grid = CityGrid(lats, lons, lat_spacing * 2, lon_spacing * 2)
+    has_tuition = ~np.isnan(tuition)
     
-    # Load data dictionary from data folder
+    counts = grid.accumulate(school_lats, school_lons)
+    above = grid.accumulate(school_lats, school_lons, (tuition >= tuition_threshold) & has_tuition)
+    tuition_sum = summed_area_table(grid.accumulate(school_lats, school_lons, np.where(has_tuition, tuition, 0.0)))
+    tuition_count = summed_area_table(grid.accumulate(school_lats, school_lons, has_tuition))
+    
+    nearby_sum = window_sum(tuition_sum, grid.rows, grid.cols, radius)
+    nearby_count = window_sum(tuition_count, grid.rows, grid.cols, radius)
+    mean_tuition = np.divide(nearby_sum, nearby_count, out=np.zeros(len(grid.rows)), where=nearby_count > 0)
+    return pd.DataFrame({
+        'School Count': counts[grid.rows, grid.cols],
+        f'Schools Tuition >=${tuition_threshold:,.0f}': above[grid.rows, grid.cols],
+        f'Mean Tuition within {radius} Cells': mean_tuition
+    })
+
+def format_metric_values(values, precision=None):
+    """Format a column of metric values the way create_kml_content does.
+
+    Numbers are rounded to 4 decimal places when |value| <= 1 and to 2
+    otherwise, or to precision places when given (0 writes integers);
+    missing or non-numeric values are written as 0.
+    """
+    if isinstance(values, pd.Series):
+        values = values.to_numpy()
+    if values.dtype == object:
+        values = np.array([v if isinstance(v, (int, float)) else np.nan for v in values], dtype=np.float64)
+    values = values.astype(np.float64)
+    finite = np.isfinite(values)
+    if precision is None:
+        digits = np.where(np.abs(values) <= 1, 4, 2).tolist()
+    else:
+        digits = [precision or None] * len(values)
+    # round(x, None) returns an int, which NaN and infinity can't become
+    formatted = list(map(str, map(round, np.where(finite, values, 0.0).tolist(), digits)))
+    for i in np.flatnonzero(~finite).tolist():
+        formatted[i] = '0' if np.isnan(values[i]) else str(values[i])
+    return formatted
+
+def format_coordinate_rings(lats, lons, square_size_lat, square_size_lon):
+    """Format the square ring around every cell center as KML coordinates."""
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    fmt = '{:.4f}'.format
+    west = list(map(fmt, (lons - square_size_lon).tolist()))
+    east = list(map(fmt, (lons + square_size_lon).tolist()))
+    south = list(map(fmt, (lats - square_size_lat).tolist()))
+    north = list(map(fmt, (lats + square_size_lat).tolist()))
+    ring = '{0},{1},0 {2},{1},0 {2},{3},0 {0},{3},0 {0},{1},0'.format
+    return list(map(ring, west, south, east, north))
+
+class KMLStreamWriter:
+    """Write Placemarks to a KML file in batches instead of building one string.
+
+    Output is byte-for-byte what create_kml_content produces. Set
+    compression to 'gzip' for a .kml.gz file or 'kmz' for a zipped KMZ.
+    schema (from resolve_output_schema) sets per-metric precision.
+    """
+
+    def __init__(self, filename, square_size_lat, square_size_lon, field_mapping=None,
+                 compression=None, batch_size=KML_BATCH_SIZE, schema=None):
+        if compression not in KML_EXTENSIONS:
+            raise ValueError(f"Unknown KML compression: {compression}")
+        self.filename = filename
+        self.square_size_lat = square_size_lat
+        self.square_size_lon = square_size_lon
+        self.field_mapping = field_mapping or {}
+        self.batch_size = batch_size
+        self.precision = {key: entry['precision'] for key, entry in (schema or {}).items()}
+        self.count = 0
+        self._archive = None
+        if compression == 'gzip':
+            self._file = gzip.open(filename, 'wt', encoding='utf-8', newline='')
+        elif compression == 'kmz':
+            self._archive = zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED)
+            self._file = io.TextIOWrapper(self._archive.open('doc.kml', 'w'), encoding='utf-8', newline='')
+        else:
+            self._file = open(filename, 'w', encoding='utf-8', newline='')
+        self._file.write(KML_HEADER)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def write_placemarks(self, names, lats, lons, metrics):
+        """Write one Placemark per row; metrics is a DataFrame of metric columns."""
+        names = list(names)
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        for start in range(0, len(names), self.batch_size):
+            stop = start + self.batch_size
+            self._write_batch(names[start:stop], lats[start:stop], lons[start:stop],
+                              metrics.iloc[start:stop])
+
+    def _write_batch(self, names, lats, lons, metrics):
+        start = time.perf_counter()
+        columns = [list(map(PLACEMARK_START.format, names))]
+        for key in metrics.columns:
+            mapped_key = str(self.field_mapping.get(key, key))
+            template = '<data name="' + mapped_key.replace('{', '{{').replace('}', '}}') + '">{}</data>'
+            columns.append(list(map(template.format, format_metric_values(metrics[key], self.precision.get(key)))))
+        rings = format_coordinate_rings(lats, lons, self.square_size_lat, self.square_size_lon)
+        columns.append(list(map(PLACEMARK_END.format, rings)))
+        text = '\n'.join(map('\n'.join, zip(*columns)))
+        serialized = time.perf_counter()
+
+        self._file.write('\n')
+        self._file.write(text)
+        self.count += len(names)
+        # Batches are too many for a line each; they add up into the run's stage totals
+        pipeline_metrics.add_time('serialize', serialized - start, len(names))
+        pipeline_metrics.add_time('write', time.perf_counter() - serialized, len(names))
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.write('\n' + KML_FOOTER)
+        self._file.close()
+        if self._archive is not None:
+            self._archive.close()
+        self._file = None
+
+def metric_matrix(metrics):
+    """Metric columns as one float64 matrix, with missing values as 0 like the KML."""
+    matrix = metrics.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+    return np.nan_to_num(matrix, nan=0.0)
+
+def compute_metric_stats(metrics, field_mapping=None, quantiles=STATS_QUANTILES, bins=STATS_BINS):
+    """Summary statistics for every metric column, computed column-wise.
+
+    For each metric: min, max, mean, total, non-zero cell count, the
+    requested quantiles and a fixed-bin histogram between min and max.
+    """
+    field_mapping = field_mapping or {}
+    matrix = metric_matrix(metrics)
+    count = matrix.shape[0]
+    if count == 0:
+        return {}
+
+    mins = matrix.min(axis=0)
+    maxs = matrix.max(axis=0)
+    quantile_values = np.quantile(matrix, quantiles, axis=0)
+
+    # Histogram every column at once: offset each column's bin ids so one
+    # bincount covers them all
+    widths = np.where(maxs > mins, maxs - mins, 1.0)
+    bin_ids = np.clip(((matrix - mins) / widths * bins).astype(np.int64), 0, bins - 1)
+    bin_ids += np.arange(matrix.shape[1]) * bins
+    histograms = np.bincount(bin_ids.ravel(), minlength=matrix.shape[1] * bins).reshape(-1, bins)
+
+    stats = {}
+    for i, key in enumerate(metrics.columns):
+        stats[str(field_mapping.get(key, key))] = {
+            'min': float(mins[i]),
+            'max': float(maxs[i]),
+            'mean': float(matrix[:, i].mean()),
+            'total': float(matrix[:, i].sum()),
+            'nonzero': int(np.count_nonzero(matrix[:, i])),
+            'quantiles': {str(q): float(v) for q, v in zip(quantiles, quantile_values[:, i])},
+            'histogram': {
+                'edges': np.linspace(mins[i], maxs[i], bins + 1).tolist(),
+                'counts': histograms[i].tolist()
+            }
+        }
+    return stats
+
+def write_city_stats(filename, metrics, field_mapping=None):
+    """Write per-metric statistics for one city as JSON.
+
+    Columns are summarized a batch at a time so only a few float64
+    copies of the metrics exist at once.
+    """
+    metric_stats = {}
+    for start in range(0, len(metrics.columns), STATS_COLUMN_BATCH):
+        metric_stats.update(compute_metric_stats(metrics.iloc[:, start:start + STATS_COLUMN_BATCH],
+                                                 field_mapping))
+    stats = {'count': len(metrics), 'metrics': metric_stats}
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump(stats, f, separators=(',', ':'))
+
+class CityBinaryWriter:
+    """Write a compact columnar file of cell centers and metrics.
+
+    Layout: a little-endian uint32 header length, a UTF-8 JSON header
+    padded to 8 bytes, then one little-endian typed array per column.
+    Every column starts on an 8-byte boundary so the client can wrap the
+    fetched ArrayBuffer in Float64Array/Float32Array views without copying.
+    The header lists each column's name, type, byte offset and length,
+    plus the cell count and grid spacing. Rows can be written in any
+    order of chunks because each column's region is fixed up front.
+
+    Metrics are float32 unless schema (from resolve_output_schema) gives
+    another type. Integer columns hold round(value * scale), clipped to
+    the type's range; the header records any scale other than 1.
+    """
+
+    def __init__(self, filename, count, metric_keys, square_size_lat, square_size_lon,
+                 field_mapping=None, schema=None):
+        field_mapping = field_mapping or {}
+        schema = schema or {}
+        self.filename = filename
+        self.count = count
+        self.columns = [('latitude', 'Latitude', 'float64'), ('longitude', 'Longitude', 'float64')]
+        self.columns += [(key, str(field_mapping.get(key, key)), schema[key]['type'] if key in schema else 'float32')
+                         for key in metric_keys]
+        self.scales = {key: schema[key]['scale'] for key in metric_keys if key in schema}
+
+        header_columns = []
+        offset = 0
+        self.offsets = {}
+        for key, name, dtype in self.columns:
+            self.offsets[key] = offset
+            header_columns.append({'name': name, 'type': dtype, 'offset': offset})
+            if self.scales.get(key, 1) != 1:
+                header_columns[-1]['scale'] = self.scales[key]
+            offset += self._padded(count * np.dtype(dtype).itemsize)
+        header = {
+            'version': BINARY_VERSION,
+            'count': count,
+            'spacing': {'lat': square_size_lat * 2, 'lon': square_size_lon * 2},
+            'columns': header_columns
+        }
+
+        # Offsets in the header are relative to the end of the header block
+        header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+        header_bytes += b' ' * (self._padded(4 + len(header_bytes)) - 4 - len(header_bytes))
+        self.data_start = 4 + len(header_bytes)
+        self._file = open(filename, 'wb')
+        self._file.write(struct.pack('<I', len(header_bytes)))
+        self._file.write(header_bytes)
+        self._file.truncate(self.data_start + offset)
+
+    @staticmethod
+    def _padded(size):
+        return (size + 7) // 8 * 8
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def write_rows(self, start, lats, lons, metrics):
+        """Write rows [start, start + len(lats)) of every column."""
+        values = {'latitude': lats, 'longitude': lons}
+        for key, _, dtype in self.columns:
+            column = values[key] if key in values else metrics[key]
+            column = pd.to_numeric(pd.Series(np.asarray(column)), errors='coerce').to_numpy(dtype=np.float64)
+            column = np.nan_to_num(column, nan=0.0)
+            if np.issubdtype(np.dtype(dtype), np.integer):
+                limits = np.iinfo(dtype)
+                column = np.clip(np.round(column * self.scales.get(key, 1)), limits.min, limits.max)
+            itemsize = np.dtype(dtype).itemsize
+            self._file.seek(self.data_start + self.offsets[key] + start * itemsize)
+            self._file.write(column.astype('<' + np.dtype(dtype).str[1:]).tobytes())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def read_city_binary(filename):
+    """Read a file written by CityBinaryWriter.
+
+    Returns the JSON header and a dict of column name to NumPy array.
+    The arrays are read-only views over a memory map of the file, except
+    scaled integer columns, which are decoded to float64.
+    """
+    with open(filename, 'rb') as f:
+        header_length = struct.unpack('<I', f.read(4))[0]
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    data = np.memmap(filename, dtype=np.uint8, mode='r')
+    data_start = 4 + header_length
+    columns = {}
+    for column in header['columns']:
+        dtype = np.dtype(column['type']).newbyteorder('<')
+        start = data_start + column['offset']
+        columns[column['name']] = data[start:start + header['count'] * dtype.itemsize].view(dtype)
+        if 'scale' in column:
+            columns[column['name']] = columns[column['name']] / column['scale']
+    return header, columns
+
+def aggregate_metrics(metrics, inverse, block_count, rules=None):
+    """Combine per-cell metrics into per-block metrics.
+
+    inverse gives each cell's block. Metrics are summed unless rules maps
+    them to ('mean', weight); those are averaged weighted by the weight
+    column, or unweighted where the weight is missing or sums to zero.
+    """
+    rules = rules or {}
+    cells = np.bincount(inverse, minlength=block_count)
+    numeric = {key: np.nan_to_num(pd.to_numeric(metrics[key], errors='coerce').to_numpy(dtype=np.float64))
+               for key in metrics.columns}
+    blocks = {}
+    for key, values in numeric.items():
+        aggregation, weight = rules.get(key, ('sum', None))
+        totals = np.bincount(inverse, weights=values, minlength=block_count)
+        if aggregation != 'mean':
+            blocks[key] = totals
+            continue
+        mean = totals / np.maximum(cells, 1)
+        if weight in numeric:
+            weight_totals = np.bincount(inverse, weights=numeric[weight], minlength=block_count)
+            weighted = np.bincount(inverse, weights=values * numeric[weight], minlength=block_count)
+            mean = np.divide(weighted, weight_totals, out=mean, where=weight_totals > 0)
+        blocks[key] = mean
+    return pd.DataFrame(blocks)
+
+def write_city_lod(input_file, output_kml_dir, lats, lons, metrics, lat_spacing, lon_spacing,
+                   field_mapping=None, rules=None, compression=None, binary=False,
+                   factors=LOD_FACTORS, schema=None):
+    """Write coarser copies of a city's grid for zoomed-out views.
+
+    Each level merges factor x factor blocks of cells into one cell named
+    by its block ID, written to lod/<city>.x<factor> KML (and .bin).
+    <city>.lod.json lists every level with the zoom range it is drawn at
+    and the metrics that were summed, so the client can scale colors.
+    schema projects and quantizes the levels like the full-resolution files.
+    """
+    rules = rules or {}
+    field_mapping = field_mapping or {}
+    city_name = os.path.splitext(os.path.basename(input_file))[0]
+    lod_dir = os.path.join(output_kml_dir, LOD_DIR)
+    os.makedirs(lod_dir, exist_ok=True)
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+
+    levels = [{'factor': 1, 'file': os.path.basename(city_output_file(input_file, output_kml_dir, compression)),
+               'cells': len(lats), 'minzoom': LOD_BASE_MIN_ZOOM}]
+    for factor in factors:
+        block_lats, block_lons, inverse = lattice_blocks(lats, lons, factor, lat_spacing * 2, lon_spacing * 2)
+        blocks = aggregate_metrics(metrics, inverse, len(block_lats), rules)
+        names = cell_ids(block_lats, block_lons, lat_spacing * 2 * factor, lon_spacing * 2 * factor)
+        file_name = f'{city_name}.x{factor}{KML_EXTENSIONS[compression]}'
+        with KMLStreamWriter(os.path.join(lod_dir, file_name), lat_spacing * factor, lon_spacing * factor,
+                             field_mapping, compression=compression, schema=schema) as writer:
+            writer.write_placemarks(names.tolist(), block_lats, block_lons,
+                                    blocks[schema_columns(schema, blocks.columns, 'kml')])
+        level = {'factor': factor, 'file': f'{LOD_DIR}/{file_name}', 'cells': len(block_lats),
+                 'maxzoom': LOD_BASE_MIN_ZOOM - int(np.log2(factor)) + 1}
+        if factor != factors[-1]:
+            level['minzoom'] = level['maxzoom'] - 1
+        if binary:
+            binary_name = f'{city_name}.x{factor}{BINARY_EXTENSION}'
+            with CityBinaryWriter(os.path.join(lod_dir, binary_name), len(block_lats),
+                                  schema_columns(schema, blocks.columns, 'bin'), lat_spacing * factor,
+                                  lon_spacing * factor, field_mapping, schema) as binary_writer:
+                binary_writer.write_rows(0, block_lats, block_lons, blocks)
+            level['binFile'] = f'{LOD_DIR}/{binary_name}'
+        levels.append(level)
+
+    lod_file = city_lod_file(input_file, output_kml_dir)
+    summed = [str(field_mapping.get(key, key)) for key in schema_columns(schema, metrics.columns, 'kml')
+              if rules.get(key, ('sum',))[0] != 'mean']
+    with open(lod_file, 'w', encoding='utf-8') as f:
+        json.dump({'levels': levels, 'summed': summed}, f, indent=2)
+    return lod_file
+
+def write_kml_file(filename, features, square_size_lat, square_size_lon, field_mapping=None,
+                   compression=None):
+    """Write features to a KML file through the streaming writer."""
+    with KMLStreamWriter(filename, square_size_lat, square_size_lon, field_mapping,
+                         compression=compression) as writer:
+        for start in range(0, len(features), writer.batch_size):
+            batch = features[start:start + writer.batch_size]
+            metrics = pd.DataFrame([feature['metrics'] for feature in batch])
+            writer.write_placemarks([feature['Name'] for feature in batch],
+                                    [feature['Latitude'] for feature in batch],
+                                    [feature['Longitude'] for feature in batch],
+                                    metrics)
+
+def load_city_definitions(input_file):
+    """Load the data dictionary, calculated fields, aggregation rules and output schema for a demographics file."""
     data_folder = os.path.dirname(os.path.dirname(input_file))
     data_dict_path = os.path.join(data_folder, 'data_dictionary.csv')
     calc_fields_path = os.path.join(data_folder, 'calc_fields.csv')
+    city_name = os.path.splitext(os.path.basename(input_file))[0]
+    return (load_data_dictionary(data_dict_path), load_calc_fields(calc_fields_path),
+            load_aggregation_rules(data_dict_path),
+            load_output_schema(os.path.join(data_folder, OUTPUT_SCHEMA_FILE), city_name))
+
+def process_city(input_file, output_kml_dir, compression=None, binary=False, schools_file=None,
+                 tuition_threshold=TUITION_THRESHOLD, school_radius=SCHOOL_RADIUS, drop_empty=False,
+                 lod=False, chunk_size=None):
+    """Process a single city's demographics file and create KML.
+
+    Per-metric statistics are written next to the KML as <city>.stats.json.
+    With binary=True a columnar .bin file is written there too. With a
+    schools_file, school count and tuition metrics are added per cell.
+    With drop_empty=True cells with zero total population are left out.
+    With lod=True coarser block-aggregated levels are written as well.
+    With chunk_size the CSV is streamed; see process_city_chunked.
+    """
+    if chunk_size:
+        return process_city_chunked(input_file, output_kml_dir, compression, binary, schools_file,
+                                    tuition_threshold, school_radius, drop_empty, lod, chunk_size)
+    print(f"Processing {input_file}...")
+    city = os.path.splitext(os.path.basename(input_file))[0]
     
-    field_mapping = load_data_dictionary(data_dict_path)
-    calc_fields = load_calc_fields(calc_fields_path)
-    
-    # Read the input CSV
-    df = pd.read_csv(input_file)
+    with pipeline_metrics.stage('load', city=city) as loaded:
+        # Load data dictionary from data folder
+        field_mapping, calc_fields, aggregation_rules, output_schema = load_city_definitions(input_file)
+        
+        # Read the input CSV
+        df = pd.read_csv(input_file)
+        loaded['rows'] = len(df)
     
     # Calculate point spacing
-    lat_spacing, lon_spacing = calculate_point_spacing(df)
+    with pipeline_metrics.stage('spacing', len(df), city=city):
+        lat_spacing, lon_spacing = calculate_point_spacing(df)
     
-    # Prepare features list
-    features = []
-    for _, row in df.iterrows():
-        # Get base metrics
-        metrics = {col: row[col] for col in df.columns if col not in ['Name', 'Latitude', 'Longitude']}
-        
-        # Add calculated fields
-        for field_name, formula in calc_fields.items():
-            metrics[field_name] = evaluate_formula(formula, row)
-        
-        features.append({
-            'Name': row['Name'],
-            'Latitude': row['Latitude'],
-            'Longitude': row['Longitude'],
-            'metrics': metrics
-        })
+    # Drop repeated cells, e.g. from overlapping exports stitched together
+    ids = cell_ids(df['Latitude'], df['Longitude'], lat_spacing * 2, lon_spacing * 2)
+    duplicated = pd.Series(ids).duplicated().to_numpy()
+    if duplicated.any():
+        print(f"Dropping {int(duplicated.sum())} duplicate cells")
+        df = df[~duplicated].reset_index(drop=True)
+    
+    # Drop unpopulated cells (water, parks, airports)
+    if drop_empty and POPULATION_FIELD in df.columns:
+        empty = df[POPULATION_FIELD].fillna(0).to_numpy() <= 0
+        if empty.any():
+            print(f"Dropping {int(empty.sum())} cells with no population")
+            df = df[~empty].reset_index(drop=True)
+    
+    # Evaluate calculated fields over whole columns
+    with pipeline_metrics.stage('formulas', len(df), city=city):
+        calc_df = evaluate_formulas(df, calc_fields)
+    
+    # Base metrics followed by calculated fields
+    metric_columns = [col for col in df.columns if col not in ['Name', 'Latitude', 'Longitude']]
+    metrics_df = df[metric_columns].copy()
+    for field_name in calc_df.columns:
+        metrics_df[field_name] = calc_df[field_name]
+    
+    # Join schools onto the grid
+    if schools_file:
+        with pipeline_metrics.stage('schools', len(df), city=city):
+            schools_df = school_metrics(df['Latitude'], df['Longitude'], lat_spacing, lon_spacing,
+                                        load_school_points(schools_file), tuition_threshold, school_radius)
+        for column in schools_df.columns:
+            metrics_df[column] = schools_df[column].to_numpy()
+        aggregation_rules[schools_df.columns[-1]] = ('mean', None)
+    
+    # Columns, precision and storage types declared for this city
+    schema = resolve_output_schema(output_schema, metrics_df.columns, field_mapping)
     
     # Create output filename
-    city_name = os.path.splitext(os.path.basename(input_file))[0]
-    output_file = os.path.join(output_kml_dir, f'{city_name}.kml')
+    output_file = city_output_file(input_file, output_kml_dir, compression)
     
-    # Write KML file
-    write_kml_file(output_file, features, lat_spacing, lon_spacing, field_mapping)
+    # Stream Placemarks to the KML file
+    with pipeline_metrics.stage('kml', len(df), city=city), \
+            KMLStreamWriter(output_file, lat_spacing, lon_spacing, field_mapping,
+                            compression=compression, schema=schema) as writer:
+        writer.write_placemarks(df['Name'].tolist(), df['Latitude'], df['Longitude'],
+                                metrics_df[schema_columns(schema, metrics_df.columns, 'kml')])
     print(f"Created {output_file}")
+    
+    stats_file = city_stats_file(input_file, output_kml_dir)
+    with pipeline_metrics.stage('stats', len(df), city=city):
+        write_city_stats(stats_file, metrics_df, field_mapping)
+    print(f"Created {stats_file}")
+    
+    if binary:
+        binary_file = city_binary_file(input_file, output_kml_dir)
+        with pipeline_metrics.stage('binary', len(df), city=city), \
+                CityBinaryWriter(binary_file, len(df), schema_columns(schema, metrics_df.columns, 'bin'),
+                                 lat_spacing, lon_spacing, field_mapping, schema) as binary_writer:
+            binary_writer.write_rows(0, df['Latitude'], df['Longitude'], metrics_df)
+        print(f"Created {binary_file}")
+    
+    if lod:
+        with pipeline_metrics.stage('lod', len(df), city=city):
+            lod_file = write_city_lod(input_file, output_kml_dir, df['Latitude'], df['Longitude'], metrics_df,
+                                      lat_spacing, lon_spacing, field_mapping, aggregation_rules,
+                                      compression=compression, binary=binary, schema=schema)
+        print(f"Created {lod_file}")
+    return writer.count
+
+def csv_dtypes(input_file, sample_rows=CSV_SAMPLE_ROWS):
+    """Column dtypes for reading a demographics CSV in chunks.
+
+    Coordinates stay float64 so cell edges round the same way; numeric
+    metrics are read as float32 and everything else (names, addresses)
+    as strings. Types are decided from the first sample_rows rows.
+    """
+    sample = pd.read_csv(input_file, nrows=sample_rows)
+    dtypes = {}
+    for column in sample.columns:
+        if column in ['Latitude', 'Longitude']:
+            dtypes[column] = np.float64
+        elif column != 'Name' and pd.api.types.is_numeric_dtype(sample[column]):
+            dtypes[column] = np.float32
+        else:
+            dtypes[column] = str
+    return dtypes, sample
+
+def process_city_chunked(input_file, output_kml_dir, compression=None, binary=False, schools_file=None,
+                         tuition_threshold=TUITION_THRESHOLD, school_radius=SCHOOL_RADIUS, drop_empty=False,
+                         lod=False, chunk_size=CSV_CHUNK_SIZE):
+    """Process a city's demographics file chunk by chunk in bounded memory.
+
+    A first pass reads only the coordinate columns (and population when
+    dropping empty cells) to find the grid spacing and the rows to keep.
+    The second pass reads chunk_size rows at a time as float32, runs the
+    vectorized formulas and appends to the KML and .bin writers. Only a
+    float32 matrix of the metrics is kept for stats and LOD levels.
+    """
+    print(f"Processing {input_file} in chunks of {chunk_size} rows...")
+    city = os.path.splitext(os.path.basename(input_file))[0]
+    
+    # First pass: coordinates only
+    with pipeline_metrics.stage('load', city=city, chunked=True) as loaded:
+        field_mapping, calc_fields, aggregation_rules, output_schema = load_city_definitions(input_file)
+        dtypes, sample = csv_dtypes(input_file)
+        position_columns = ['Latitude', 'Longitude'] + ([POPULATION_FIELD] if drop_empty else [])
+        positions = pd.read_csv(input_file, usecols=lambda column: column in position_columns,
+                                dtype={column: np.float64 for column in position_columns})
+        loaded['rows'] = len(positions)
+    with pipeline_metrics.stage('spacing', len(positions), city=city):
+        lat_spacing, lon_spacing = calculate_point_spacing(positions)
+    keep = ~pd.Series(cell_ids(positions['Latitude'], positions['Longitude'],
+                               lat_spacing * 2, lon_spacing * 2)).duplicated().to_numpy()
+    if not keep.all():
+        print(f"Dropping {int((~keep).sum())} duplicate cells")
+    if drop_empty and POPULATION_FIELD in positions.columns:
+        empty = keep & (positions[POPULATION_FIELD].fillna(0).to_numpy() <= 0)
+        if empty.any():
+            print(f"Dropping {int(empty.sum())} cells with no population")
+            keep &= ~empty
+    lats = positions['Latitude'].to_numpy()[keep]
+    lons = positions['Longitude'].to_numpy()[keep]
+    del positions
+    
+    # Schools need the whole grid; the result is a few columns per cell
+    schools_df = None
+    if schools_file:
+        with pipeline_metrics.stage('schools', len(lats), city=city):
+            schools_df = school_metrics(lats, lons, lat_spacing, lon_spacing, load_school_points(schools_file),
+                                        tuition_threshold, school_radius)
+        aggregation_rules[schools_df.columns[-1]] = ('mean', None)
+    
+    # Metric columns in the same order as process_city
+    base_columns = [col for col in sample.columns if col not in ['Name', 'Latitude', 'Longitude']]
+    metric_keys = base_columns + [key for key in evaluate_formulas(sample.head(1), calc_fields).columns
+                                  if key not in base_columns]
+    if schools_df is not None:
+        metric_keys += [key for key in schools_df.columns if key not in metric_keys]
+    metrics = np.zeros((len(lats), len(metric_keys)), dtype=np.float32)
+    schema = resolve_output_schema(output_schema, metric_keys, field_mapping)
+    kml_keys = schema_columns(schema, metric_keys, 'kml')
+    
+    output_file = city_output_file(input_file, output_kml_dir, compression)
+    binary_writer = None
+    if binary:
+        binary_file = city_binary_file(input_file, output_kml_dir)
+        binary_writer = CityBinaryWriter(binary_file, len(lats), schema_columns(schema, metric_keys, 'bin'),
+                                         lat_spacing, lon_spacing, field_mapping, schema)
+    
+    # Second pass: stream chunks through the vectorized pipeline; formulas,
+    # serialize and write times add up into the run's stage totals
+    row = 0
+    offset = 0
+    try:
+        with pipeline_metrics.stage('chunks', len(lats), city=city, chunk_size=chunk_size), \
+                KMLStreamWriter(output_file, lat_spacing, lon_spacing, field_mapping,
+                                compression=compression, schema=schema) as writer:
+            for chunk in pd.read_csv(input_file, dtype=dtypes, chunksize=chunk_size):
+                chunk_keep = keep[offset:offset + len(chunk)]
+                offset += len(chunk)
+                chunk = chunk[chunk_keep].reset_index(drop=True)
+                if chunk.empty:
+                    continue
+                chunk_metrics = chunk[base_columns].copy()
+                start = time.perf_counter()
+                calc_df = evaluate_formulas(chunk, calc_fields)
+                pipeline_metrics.add_time('formulas', time.perf_counter() - start, len(chunk))
+                for field_name in calc_df.columns:
+                    chunk_metrics[field_name] = calc_df[field_name]
+                if schools_df is not None:
+                    for column in schools_df.columns:
+                        chunk_metrics[column] = schools_df[column].to_numpy()[row:row + len(chunk)]
+                
+                writer.write_placemarks(chunk['Name'].tolist(), chunk['Latitude'], chunk['Longitude'],
+                                        chunk_metrics[kml_keys])
+                if binary_writer is not None:
+                    binary_writer.write_rows(row, chunk['Latitude'], chunk['Longitude'], chunk_metrics)
+                metrics[row:row + len(chunk)] = metric_matrix(chunk_metrics[metric_keys])
+                row += len(chunk)
+    finally:
+        if binary_writer is not None:
+            binary_writer.close()
+    print(f"Created {output_file}")
+    if binary_writer is not None:
+        print(f"Created {binary_file}")
+    
+    metrics_df = pd.DataFrame(metrics, columns=metric_keys, copy=False)
+    stats_file = city_stats_file(input_file, output_kml_dir)
+    with pipeline_metrics.stage('stats', len(lats), city=city):
+        write_city_stats(stats_file, metrics_df, field_mapping)
+    print(f"Created {stats_file}")
+    
+    if lod:
+        with pipeline_metrics.stage('lod', len(lats), city=city):
+            lod_file = write_city_lod(input_file, output_kml_dir, lats, lons, metrics_df, lat_spacing,
+                                      lon_spacing, field_mapping, aggregation_rules, compression=compression,
+                                      binary=binary, schema=schema)
+        print(f"Created {lod_file}")
+    return writer.count
+
+def run_city(input_file, output_kml_dir, compression=None, binary=False, city_options=None):
+    """Process one city and report its outcome instead of raising.
+
+    city_options holds extra process_city keyword arguments.
+    """
+    start = time.perf_counter()
+    result = {'city': os.path.splitext(os.path.basename(input_file))[0], 'cells': 0, 'error': None}
+    try:
+        result['cells'] = process_city(input_file, output_kml_dir, compression=compression, binary=binary,
+                                       **(city_options or {}))
+    except Exception as e:
+        print(f"Error processing {input_file}: {e}")
+        result['error'] = str(e)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def precompressed_files(file_path):
+    """The .gz (and .br when brotli is installed) siblings precompress_file writes for file_path.
+
+    Already-compressed outputs (.kml.gz, .kmz) get none.
+    """
+    if file_path.endswith(('.gz', '.kmz', '.br')):
+        return []
+    return [file_path + '.gz'] + ([file_path + '.br'] if brotli is not None else [])
+
+def precompress_file(file_path):
+    """Write .gz (and .br when brotli is installed) siblings for local-server.py.
+
+    Already-compressed outputs (.kml.gz, .kmz) are left alone. Returns the
+    paths written.
+    """
+    if not precompressed_files(file_path):
+        return []
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    written = []
+    with open(file_path + '.gz', 'wb') as f:
+        # mtime=0 keeps the bytes, and so the ETag, stable across rebuilds
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    written.append(file_path + '.gz')
+    if brotli is not None:
+        with open(file_path + '.br', 'wb') as f:
+            f.write(brotli.compress(data))
+        written.append(file_path + '.br')
+    return written
+
+def city_output_files(input_file, output_kml_dir, compression=None, binary=False, lod=False, precompress=False):
+    """Every file a build writes for one city, main KML first.
+
+    With precompress the .gz/.br siblings of those files follow them.
+    """
+    output_files = [city_output_file(input_file, output_kml_dir, compression),
+                    city_stats_file(input_file, output_kml_dir)]
+    if binary:
+        output_files.append(city_binary_file(input_file, output_kml_dir))
+    if lod:
+        lod_file = city_lod_file(input_file, output_kml_dir)
+        output_files.append(lod_file)
+        if os.path.exists(lod_file):
+            with open(lod_file, 'r', encoding='utf-8') as f:
+                for level in json.load(f)['levels'][1:]:
+                    output_files += [os.path.join(output_kml_dir, level[key])
+                                     for key in ['file', 'binFile'] if key in level]
+    if precompress:
+        output_files += [sibling for file_path in output_files for sibling in precompressed_files(file_path)]
+    return output_files
+
+def file_sha256(file_path):
+    """Hash a file's contents in chunks."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def city_output_file(input_file, output_kml_dir, compression=None):
+    """Path of the KML written for a demographics file."""
+    city_name = os.path.splitext(os.path.basename(input_file))[0]
+    return os.path.join(output_kml_dir, f'{city_name}{KML_EXTENSIONS[compression]}')
+
+def city_binary_file(input_file, output_kml_dir):
+    """Path of the columnar binary file written for a demographics file."""
+    city_name = os.path.splitext(os.path.basename(input_file))[0]
+    return os.path.join(output_kml_dir, f'{city_name}{BINARY_EXTENSION}')
+
+def city_stats_file(input_file, output_kml_dir):
+    """Path of the metric statistics JSON written for a demographics file."""
+    city_name = os.path.splitext(os.path.basename(input_file))[0]
+    return os.path.join(output_kml_dir, f'{city_name}{STATS_EXTENSION}')
+
+def city_lod_file(input_file, output_kml_dir):
+    """Path of the level-of-detail index written for a demographics file."""
+    city_name = os.path.splitext(os.path.basename(input_file))[0]
+    return os.path.join(output_kml_dir, f'{city_name}{LOD_EXTENSION}')
+
+def city_fingerprint(input_file, shared_hashes, settings):
+    """Hashes of everything a city's KML depends on."""
+    fingerprint = {'demographics': file_sha256(input_file)}
+    fingerprint.update(shared_hashes)
+    fingerprint['settings'] = hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+    return fingerprint
+
+def shared_input_hashes(data_folder):
+    """Hash data_dictionary.csv, calc_fields.csv and the output schema, which every city reads."""
+    hashes = {}
+    for name in ['data_dictionary.csv', 'calc_fields.csv', OUTPUT_SCHEMA_FILE]:
+        file_path = os.path.join(data_folder, name)
+        hashes[name] = file_sha256(file_path) if os.path.exists(file_path) else None
+    return hashes
+
+def load_build_manifest(manifest_path):
+    """Load the build manifest, or an empty one if missing or unreadable."""
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_build_manifest(manifest_path, manifest):
+    """Write the build manifest atomically."""
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+def is_up_to_date(manifest, output_files, fingerprint):
+    """True when every output exists and was built from identical inputs.
+
+    A precompressed .gz/.br sibling older than its source also counts as stale.
+    """
+    key = os.path.basename(output_files[0])
+    if not all(os.path.exists(f) for f in output_files) or manifest.get(key) != fingerprint:
+        return False
+    outputs = set(output_files)
+    return all(os.path.getmtime(f) >= os.path.getmtime(f[:-len(extension)])
+               for f in output_files for extension in ('.gz', '.br')
+               if f.endswith(extension) and f[:-len(extension)] in outputs)
+
+def print_summary(results, elapsed):
+    """Print per-city wall time and cell counts for a build."""
+    print("\nBuild summary:")
+    for result in sorted(results, key=lambda r: r['city']):
+        if result['error']:
+            status = f"FAILED: {result['error']}"
+        elif result.get('skipped'):
+            status = "up to date, skipped"
+        else:
+            status = f"{result['cells']} cells"
+        print(f"  {result['city']:<50} {result['seconds']:8.2f}s  {status}")
+    failed = sum(1 for result in results if result['error'])
+    skipped = sum(1 for result in results if result.get('skipped'))
+    print(f"Processed {len(results)} cities ({failed} failed, {skipped} skipped) in {elapsed:.2f}s")
 
 def main():
+    parser = argparse.ArgumentParser(description='Generate city KML files from demographics CSVs')
+    parser.add_argument('--compression', choices=['gzip', 'kmz'], default=None,
+                        help='Write gzipped .kml.gz or zipped .kmz files instead of plain KML')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of cities to process in parallel (default: 1)')
+    parser.add_argument('--binary', action='store_true',
+                        help='Also write a compact columnar .bin file per city for the map client')
+    parser.add_argument('--schools',
+                        help='schools.geojson to join onto the grid as per-cell school metrics')
+    parser.add_argument('--tuition-threshold', type=float, default=TUITION_THRESHOLD,
+                        help=f'Tuition counted as high-tuition in school metrics (default: {TUITION_THRESHOLD})')
+    parser.add_argument('--school-radius', type=int, default=SCHOOL_RADIUS,
+                        help=f'Radius in cells for the nearby mean tuition (default: {SCHOOL_RADIUS})')
+    parser.add_argument('--lod', action='store_true',
+                        help='Also write 2x/4x/8x block-aggregated levels for zoomed-out views')
+    parser.add_argument('--chunk-size', type=int,
+                        help=f'Stream each CSV this many rows at a time as float32 (e.g. {CSV_CHUNK_SIZE})')
+    parser.add_argument('--drop-empty', action='store_true',
+                        help='Leave out cells with zero total population')
+    parser.add_argument('--precompress', action='store_true',
+                        help='Also write .gz (and .br with brotli installed) copies for local-server.py to serve')
+    parser.add_argument('--force', action='store_true',
+                        help='Rebuild every city even if its inputs are unchanged')
+    parser.add_argument('--input-dir', help='Directory of demographics CSVs (default: data/demographics)')
+    parser.add_argument('--output-dir', help='Directory for KML output (default: data/KMLs)')
+    pipeline_metrics.add_arguments(parser)
+    args = parser.parse_args()
+    with pipeline_metrics.start_run('generate_city_kml', args):
+        build(args)
+
+def build(args):
+    """Build every stale city in args.input_dir; see main for the options."""
     # Define paths
     base_path = Path(__file__).parent
-    input_dir = base_path / "data/demographics"
-    output_dir = base_path / "data/KMLs"
+    input_dir = Path(args.input_dir) if args.input_dir else base_path / "data/demographics"
+    output_dir = Path(args.output_dir) if args.output_dir else base_path / "data/KMLs"
+    os.makedirs(output_dir, exist_ok=True)
+    
+    # Skip cities whose inputs and settings match the last build
+    manifest_path = str(output_dir / MANIFEST_FILE)
+    manifest = load_build_manifest(manifest_path)
+    settings = {'generator_version': GENERATOR_VERSION, 'compression': args.compression,
+                'binary': args.binary}
+    shared_hashes = shared_input_hashes(str(input_dir.parent))
+    city_options = {'drop_empty': args.drop_empty, 'lod': args.lod, 'chunk_size': args.chunk_size}
+    if args.drop_empty:
+        settings['drop_empty'] = True
+    if args.lod:
+        settings['lod'] = True
+    if args.chunk_size:
+        # float32 metrics can round differently in the last KML digit
+        settings['float32'] = True
+    if args.precompress:
+        settings['precompress'] = True
+    if args.schools:
+        city_options.update(schools_file=args.schools, tuition_threshold=args.tuition_threshold,
+                            school_radius=args.school_radius)
+        settings.update(tuition_threshold=args.tuition_threshold, school_radius=args.school_radius)
+        shared_hashes['schools'] = file_sha256(args.schools)
+    
+    start = time.perf_counter()
+    results = []
+    stale = {}
+    for input_file in sorted(str(input_file) for input_file in input_dir.glob("*.csv")):
+        output_files = city_output_files(input_file, str(output_dir), args.compression, args.binary, args.lod,
+                                         args.precompress)
+        output_file = output_files[0]
+        fingerprint = city_fingerprint(input_file, shared_hashes, settings)
+        if not args.force and is_up_to_date(manifest, output_files, fingerprint):
+            city = os.path.splitext(os.path.basename(input_file))[0]
+            results.append({'city': city, 'cells': 0, 'seconds': 0.0, 'error': None, 'skipped': True})
+        else:
+            stale[input_file] = (output_file, fingerprint)
+    
+    # Process the stale CSV files
+    built = []
+    if args.jobs > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            futures = {executor.submit(run_city, input_file, str(output_dir), args.compression, args.binary,
+                                       city_options): input_file
+                       for input_file in stale}
+            for future in as_completed(futures):
+                try:
+                    built.append((futures[future], future.result()))
+                except Exception as e:
+                    # The worker process itself died (e.g. out of memory)
+                    city = os.path.splitext(os.path.basename(futures[future]))[0]
+                    built.append((futures[future], {'city': city, 'cells': 0, 'seconds': 0.0, 'error': str(e)}))
+    else:
+        for input_file in stale:
+            built.append((input_file, run_city(input_file, str(output_dir), args.compression, args.binary,
+                                               city_options)))
+    
+    # Record what was built so the next run can skip it
+    for input_file, result in built:
+        output_file, fingerprint = stale[input_file]
+        if result['error']:
+            manifest.pop(os.path.basename(output_file), None)
+        else:
+            manifest[os.path.basename(output_file)] = fingerprint
+            if args.precompress:
+                with pipeline_metrics.stage('precompress', city=result['city']):
+                    for file_path in city_output_files(input_file, str(output_dir), args.compression,
+                                                       args.binary, args.lod):
+                        precompress_file(file_path)
+        results.append(result)
+    if built:
+        save_build_manifest(manifest_path, manifest)
+    pipeline_metrics.count('cities_built', sum(1 for _, result in built if not result['error']))
+    pipeline_metrics.count('cities_failed', sum(1 for _, result in built if result['error']))
+    pipeline_metrics.count('cities_skipped', len(results) - len(built))
+    pipeline_metrics.count('cells', sum(result['cells'] for _, result in built))
     
-    # Process all CSV files in the input directory
-    for input_file in input_dir.glob("*.csv"):
-        process_city(str(input_file), str(output_dir))
+    print_summary(results, time.perf_counter() - start)
 
 if __name__ == "__main__":
     main()
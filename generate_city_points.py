@@ -2,9 +2,17 @@ import pandas as pd
 import numpy as np
 import xlwt
 import os
+import argparse
 from pathlib import Path
 import logging
 
+import pipeline_metrics
+from city_grid import cell_ids, load_boundary, points_in_polygon
+
+HEADERS = ['ID', 'Name', 'Address', 'City', 'State', 'Zip', 'Latitude', 'Longitude']
+XLS_MAX_ROWS = 65536  # Legacy .xls row limit, including the header row
+OUTPUT_FORMATS = {'xls': '.xls', 'csv': '.csv', 'parquet': '.parquet'}
+
 # Set up logging
 logging.basicConfig(
     level=logging.INFO,
@@ -45,63 +53,179 @@ def generate_grid_points(nw_lat, nw_lon, se_lat, se_lon, step_size=0.015):
     lats = np.linspace(grid_nw_lat, grid_se_lat, lat_steps + 1)
     longs = np.linspace(grid_nw_lon, grid_se_lon, lon_steps + 1)
     
-    # Create grid points
-    points = []
-    for lat in lats:
-        for lon in longs:
-            points.append((round(lat, 6), round(lon, 6)))  # Round to 6 decimal places for consistency
+    # Create grid points, rows running north to south and west to east
+    grid_lats, grid_lons = np.meshgrid(lats, longs, indexing='ij')
+    points = np.column_stack([grid_lats.ravel(), grid_lons.ravel()])
     
     logging.info(f"Generated {len(points)} points")
     return points
 
-def create_city_data(points):
+def create_city_data(points, names=None):
+    """Build the upload table for an (n, 2) array of lat/lon points.
+
+    Names default to 100001, 100002, ...; pass names (e.g. cell IDs) to
+    override them.
+    """
     logging.info(f"Creating data for {len(points)} points")
     
     # Prepare data in the exact format needed
-    data = []
-    for i, (lat, lon) in enumerate(points, 1):
-        data.append({
-            'ID': str(i),  # Start IDs at 1
-            'Name': str(i + 100000),  # Start Names at 100001
-            'Address': '',  # Empty string for unused fields
-            'City': '',
-            'State': '',
-            'Zip': '',
-            'Latitude': f'{lat:.6f}',
-            'Longitude': f'{lon:.6f}'
-        })
-    
-    return data
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    ids = np.arange(1, len(points) + 1)
+    names = (ids + 100000).astype(str) if names is None else np.asarray(names).astype(str)
+    fmt = '{:.6f}'.format  # Rounds to 6 decimal places for consistency
+    return pd.DataFrame({
+        'ID': ids.astype(str),  # Start IDs at 1
+        'Name': names,  # Start Names at 100001
+        'Address': '',  # Empty string for unused fields
+        'City': '',
+        'State': '',
+        'Zip': '',
+        'Latitude': list(map(fmt, points[:, 0].tolist())),
+        'Longitude': list(map(fmt, points[:, 1].tolist()))
+    }, columns=HEADERS)
+
+def split_output_paths(output_path, parts):
+    """Output paths for a table split into several files."""
+    output_path = Path(output_path)
+    if parts == 1:
+        return [output_path]
+    return [output_path.with_name(f"{output_path.stem}_part{i}{output_path.suffix}") for i in range(1, parts + 1)]
 
 def save_to_xls(data, output_path):
-    logging.info(f"Creating Excel file: {output_path}")
-    
-    # Create new workbook and sheet
-    wb = xlwt.Workbook()
-    ws = wb.add_sheet('TAS')  # Use 'TAS' as sheet name to match template
+    """Write the upload table to .xls, splitting into several files past the row limit.
+
+    Each file holds a 'TAS' sheet (matching the upload template) with the
+    header row. Returns the paths written.
+    """
+    rows_per_file = XLS_MAX_ROWS - 1
+    parts = max(1, -(-len(data) // rows_per_file))
+    paths = split_output_paths(output_path, parts)
+    if parts > 1:
+        logging.info(f"{len(data)} rows exceed the .xls limit, splitting into {parts} files")
     
     # Define text style (force text format for all cells)
     style = xlwt.XFStyle()
     style.num_format_str = '@'
     
-    # Write headers
-    headers = ['ID', 'Name', 'Address', 'City', 'State', 'Zip', 'Latitude', 'Longitude']
-    for col, header in enumerate(headers):
-        ws.write(0, col, header, style)
-    
-    # Write data
-    for row, point in enumerate(data, 1):
-        for col, header in enumerate(headers):
-            ws.write(row, col, point[header], style)
-        if row % 10 == 0:
-            logging.info(f"Wrote {row} rows")
-    
-    # Save the file
-    logging.info("Saving workbook...")
-    wb.save(output_path)
-    logging.info("Save complete")
+    values = data[HEADERS].to_numpy(dtype=object)
+    for part, path in enumerate(paths):
+        logging.info(f"Creating Excel file: {path}")
+        
+        # Create new workbook and sheet
+        wb = xlwt.Workbook()
+        ws = wb.add_sheet('TAS')  # Use 'TAS' as sheet name to match template
+        
+        # Write headers
+        for col, header in enumerate(HEADERS):
+            ws.write(0, col, header, style)
+        
+        # Write data a row at a time, flushing finished rows to keep memory flat
+        for row, record in enumerate(values[part * rows_per_file:(part + 1) * rows_per_file].tolist(), 1):
+            sheet_row = ws.row(row)
+            for col, value in enumerate(record):
+                sheet_row.write(col, value, style)
+            if row % 1000 == 0:
+                ws.flush_row_data()
+        
+        # Save the file
+        wb.save(str(path))
+        logging.info(f"Saved {path}")
+    return paths
+
+def save_points(data, output_path, output_format='xls'):
+    """Write the upload table as .xls, .csv or .parquet. Returns the paths written."""
+    if output_format == 'xls':
+        return save_to_xls(data, output_path)
+    if output_format == 'csv':
+        data.to_csv(output_path, index=False)
+    elif output_format == 'parquet':
+        data.to_parquet(output_path, index=False)  # Requires pyarrow or fastparquet
+    else:
+        raise ValueError(f"Unknown output format: {output_format}")
+    logging.info(f"Saved {output_path}")
+    return [Path(output_path)]
+
+def boundary_file(boundaries_dir, city_name):
+    """Path of a city's boundary GeoJSON, or None when it has none."""
+    if not boundaries_dir:
+        return None
+    file_path = Path(boundaries_dir) / f"{city_name.replace(' ', '_')}.geojson"
+    return file_path if file_path.exists() else None
+
+def clip_to_boundary(points, rings):
+    """Keep only the points whose cell center lies inside the boundary."""
+    return points[points_in_polygon(points[:, 0], points[:, 1], rings)]
+
+def city_points(row, boundaries_dir=None):
+    """Grid points for one row of lat_long_to_process.csv.
+
+    When boundaries_dir holds <City_Name>.geojson, points outside that
+    boundary (ocean, neighboring counties) are dropped.
+    """
+    nw_lat, nw_lon = parse_coordinates(row['Northwest'])
+    se_lat, se_lon = parse_coordinates(row['Southeast'])
+    points = generate_grid_points(nw_lat, nw_lon, se_lat, se_lon)
+    file_path = boundary_file(boundaries_dir, row['City Name'])
+    if file_path:
+        clipped = clip_to_boundary(points, load_boundary(file_path))
+        logging.info(f"Clipped {row['City Name']} to {file_path.name}: kept {len(clipped)} of {len(points)} points")
+        points = clipped
+    return points
+
+def build_national_points(cities, boundaries_dir=None):
+    """One deduplicated point table covering every city.
+
+    Overlapping cities share lattice points; each cell is kept once and
+    named by its 64-bit cell ID so uploaded results can be joined back.
+    """
+    points = np.concatenate([city_points(row, boundaries_dir) for _, row in cities.iterrows()])
+    ids, first = np.unique(cell_ids(points[:, 0], points[:, 1]), return_index=True)
+    logging.info(f"{len(points)} city points collapse to {len(ids)} unique cells "
+                 f"({len(points) - len(ids)} duplicates removed)")
+    return create_city_data(points[first], names=ids)
+
+def split_national_demographics(national_csv, cities, output_dir, boundaries_dir=None):
+    """Fan a demographics export for the national point set back out per city.
+
+    The export's Name column holds cell IDs. Each city's cells are
+    selected with one reindex on that column and written to
+    <output_dir>/<City>.csv for generate_city_kml.py.
+    """
+    national = pd.read_csv(national_csv, dtype={'Name': str})
+    national['Name'] = national['Name'].astype(np.uint64)
+    national = national.drop_duplicates('Name').set_index('Name')
+    os.makedirs(output_dir, exist_ok=True)
+    for _, row in cities.iterrows():
+        city_name = row['City Name']
+        points = city_points(row, boundaries_dir)
+        city_df = national.reindex(cell_ids(points[:, 0], points[:, 1]))
+        missing = city_df.isna().all(axis=1)
+        if missing.any():
+            logging.warning(f"{city_name}: {int(missing.sum())} cells missing from {national_csv}")
+        city_df = city_df[~missing].rename_axis('Name').reset_index()
+        output_path = Path(output_dir) / f"{city_name.replace(' ', '_')}.csv"
+        city_df.to_csv(output_path, index=False)
+        logging.info(f"Wrote {len(city_df)} cells for {city_name} to {output_path}")
 
 def main():
+    parser = argparse.ArgumentParser(description='Generate grid points for each city in lat_long_to_process.csv')
+    parser.add_argument('--format', choices=list(OUTPUT_FORMATS), default='xls',
+                        help='Output format (default: xls, split into several files past 65,535 rows)')
+    parser.add_argument('--national', action='store_true',
+                        help='Write one deduplicated national_points file named by cell ID instead of per-city files')
+    parser.add_argument('--split-national', metavar='DEMOGRAPHICS_CSV',
+                        help='Split a demographics export of the national points into per-city CSVs')
+    parser.add_argument('--demographics-dir',
+                        help='Where --split-national writes city CSVs (default: data/demographics)')
+    parser.add_argument('--boundaries-dir',
+                        help='Clip each city to <City_Name>.geojson in this directory when present')
+    pipeline_metrics.add_arguments(parser)
+    args = parser.parse_args()
+    with pipeline_metrics.start_run('generate_city_points', args):
+        generate_points(args)
+
+def generate_points(args):
+    """Write the points files main's options ask for."""
     logging.info("Starting city points generation process")
     
     # Set up paths
@@ -112,33 +236,49 @@ def main():
     logging.info(f"Reading city coordinates from: {input_file}")
     df = pd.read_csv(input_file)
     
+    if args.national:
+        output_path = output_dir / f"national_points{OUTPUT_FORMATS[args.format]}"
+        with pipeline_metrics.stage('grid', cities=len(df)) as built:
+            points = build_national_points(df, args.boundaries_dir)
+            built['rows'] = len(points)
+        with pipeline_metrics.stage('write', len(points), format=args.format):
+            save_points(points, output_path, args.format)
+        return
+    if args.split_national:
+        demographics_dir = args.demographics_dir or base_dir / 'data' / 'demographics'
+        with pipeline_metrics.stage('split', cities=len(df)):
+            split_national_demographics(args.split_national, df, demographics_dir, args.boundaries_dir)
+        return
+    
     for _, row in df.iterrows():
         city_name = row['City Name']
         logging.info(f"\nProcessing {city_name}...")
         
         try:
             # Check if output file already exists
-            output_path = output_dir / f"{city_name.replace(' ', '_')}_points.xls"
-            if output_path.exists():
-                logging.info(f"Skipping {city_name} - XLS file already exists")
+            output_path = output_dir / f"{city_name.replace(' ', '_')}_points{OUTPUT_FORMATS[args.format]}"
+            if output_path.exists() or split_output_paths(output_path, 2)[0].exists():
+                logging.info(f"Skipping {city_name} - output file already exists")
                 continue
             
-            # Parse coordinates
-            nw_lat, nw_lon = parse_coordinates(row['Northwest'])
-            se_lat, se_lon = parse_coordinates(row['Southeast'])
-            
             # Generate points
-            points = generate_grid_points(nw_lat, nw_lon, se_lat, se_lon)
+            with pipeline_metrics.stage('grid', city=city_name) as generated:
+                points = city_points(row, args.boundaries_dir)
+                generated['rows'] = len(points)
             
             # Create data
-            city_data = create_city_data(points)
+            with pipeline_metrics.stage('build', len(points), city=city_name):
+                city_data = create_city_data(points)
             
-            # Save to Excel file
-            save_to_xls(city_data, output_path)
+            # Save the points
+            with pipeline_metrics.stage('write', len(points), city=city_name, format=args.format):
+                save_points(city_data, output_path, args.format)
+            pipeline_metrics.count('cities_built')
             logging.info(f"Successfully processed {city_name}")
             
         except Exception as e:
             logging.error(f"Error processing {city_name}: {str(e)}")
+            pipeline_metrics.count('cities_failed')
             continue  # Continue with next city if one fails
 
 if __name__ == "__main__":
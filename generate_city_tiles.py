@@ -0,0 +1,249 @@
+import argparse
+import json
+import math
+import os
+import re
+import struct
+from pathlib import Path
+
+import numpy as np
+
+from generate_city_kml import BINARY_EXTENSION, read_city_binary
+
+TILE_EXTENT = 4096
+TILE_LAYER = 'demographics'
+MIN_ZOOM = 6
+MAX_ZOOM = 12
+MAX_LATITUDE = 85.0511287798
+
+# The map colors by the metrics listed in config.js; everything else stays out of the tiles
+CONFIG_FILE = Path(__file__).parent / 'config.js'
+
+# MVT geometry commands
+MOVE_TO = 1
+LINE_TO = 2
+CLOSE_PATH = 7
+POLYGON = 3
+
+def load_tile_properties(config_file=CONFIG_FILE):
+    """Metric names in the metrics section of config.js, in the map's order."""
+    with open(config_file, 'r', encoding='utf-8') as f:
+        content = f.read()
+    match = re.search(r'\bmetrics\s*:\s*\{', content)
+    if not match:
+        raise ValueError(f"Could not find metrics in {config_file}")
+    names = []
+    depth = 1
+    for token in re.finditer(r'"([^"]*)"\s*:|[{}]', content[match.end():]):
+        if token.group(0) == '{':
+            depth += 1
+        elif token.group(0) == '}':
+            depth -= 1
+            if depth == 0:
+                break
+        elif depth == 1:
+            names.append(token.group(1))
+    return names
+
+def encode_varint(value):
+    """Encode a non-negative integer as a protobuf varint."""
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def zigzag(value):
+    """Zigzag-encode a signed integer for MVT geometry parameters."""
+    return (value << 1) ^ (value >> 63)
+
+def encode_field(field_number, wire_type, payload):
+    """Encode one protobuf field; payload is raw bytes for wire type 2."""
+    key = encode_varint((field_number << 3) | wire_type)
+    if wire_type == 2:
+        return key + encode_varint(len(payload)) + payload
+    return key + payload
+
+def encode_packed(field_number, values):
+    """Encode a packed repeated uint32 field."""
+    return encode_field(field_number, 2, b''.join(encode_varint(v) for v in values))
+
+def command(command_id, count):
+    return (command_id & 0x7) | (count << 3)
+
+def square_geometry(west, north, east, south):
+    """Geometry commands for one square ring in tile coordinates.
+
+    Tile y grows southward, so the ring runs west-south, west-north,
+    east-north, east-south to give the positive (clockwise) area MVT
+    requires for exterior rings.
+    """
+    return [
+        command(MOVE_TO, 1), zigzag(west), zigzag(south),
+        command(LINE_TO, 3),
+        zigzag(0), zigzag(north - south),
+        zigzag(east - west), zigzag(0),
+        zigzag(0), zigzag(south - north),
+        command(CLOSE_PATH, 1)
+    ]
+
+def encode_layer(name, features, keys, values):
+    """Encode an MVT layer from (id, tags, geometry) features."""
+    layer = encode_field(15, 0, encode_varint(2))
+    layer += encode_field(1, 2, name.encode('utf-8'))
+    for feature_id, tags, geometry in features:
+        feature = encode_field(1, 0, encode_varint(feature_id))
+        if tags:
+            feature += encode_packed(2, tags)
+        feature += encode_field(3, 0, encode_varint(POLYGON))
+        feature += encode_packed(4, geometry)
+        layer += encode_field(2, 2, feature)
+    for key in keys:
+        layer += encode_field(3, 2, key.encode('utf-8'))
+    for value in values:
+        layer += encode_field(4, 2, encode_field(2, 5, struct.pack('<f', value)))
+    layer += encode_field(5, 0, encode_varint(TILE_EXTENT))
+    return layer
+
+def project(lats, lons, zoom):
+    """Project lat/lon arrays to global Web Mercator pixel coordinates."""
+    scale = TILE_EXTENT * (1 << zoom)
+    lats = np.clip(lats, -MAX_LATITUDE, MAX_LATITUDE)
+    x = (lons + 180.0) / 360.0 * scale
+    sin_lat = np.sin(np.radians(lats))
+    y = (0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * scale
+    return x, y
+
+def tile_cells(lats, lons, half_lat, half_lon, zoom):
+    """Quantize every cell's square and list the tiles each one touches.
+
+    Returns the integer pixel edges of every square and parallel arrays
+    of (cell index, tile x, tile y) for each cell/tile overlap.
+    """
+    west, north = project(lats + half_lat, lons - half_lon, zoom)
+    east, south = project(lats - half_lat, lons + half_lon, zoom)
+    west = np.round(west).astype(np.int64)
+    east = np.maximum(np.round(east).astype(np.int64), west + 1)
+    north = np.round(north).astype(np.int64)
+    south = np.maximum(np.round(south).astype(np.int64), north + 1)
+
+    tx0, tx1 = west // TILE_EXTENT, (east - 1) // TILE_EXTENT
+    ty0, ty1 = north // TILE_EXTENT, (south - 1) // TILE_EXTENT
+    cells, tiles_x, tiles_y = [], [], []
+    for dx in range(int((tx1 - tx0).max(initial=0)) + 1):
+        for dy in range(int((ty1 - ty0).max(initial=0)) + 1):
+            mask = (tx0 + dx <= tx1) & (ty0 + dy <= ty1)
+            index = np.flatnonzero(mask)
+            cells.append(index)
+            tiles_x.append(tx0[index] + dx)
+            tiles_y.append(ty0[index] + dy)
+    return (west, north, east, south), np.concatenate(cells), np.concatenate(tiles_x), np.concatenate(tiles_y)
+
+def encode_tile(cell_index, tile_x, tile_y, edges, properties):
+    """Encode one tile holding the given cells.
+
+    Zero-valued properties are left out of a feature's tags; the map
+    coalesces a missing property to 0.
+    """
+    west, north, east, south = edges
+    origin_x, origin_y = tile_x * TILE_EXTENT, tile_y * TILE_EXTENT
+    keys = list(properties)
+    values = []
+    value_index = {}
+    features = []
+    for i in cell_index.tolist():
+        tags = []
+        for key_id, key in enumerate(keys):
+            value = float(properties[key][i])
+            if value == 0 or math.isnan(value):
+                continue
+            value = struct.unpack('<f', struct.pack('<f', value))[0]
+            if value not in value_index:
+                value_index[value] = len(values)
+                values.append(value)
+            tags.extend((key_id, value_index[value]))
+        geometry = square_geometry(int(west[i]) - origin_x, int(north[i]) - origin_y,
+                                   int(east[i]) - origin_x, int(south[i]) - origin_y)
+        features.append((i, tags, geometry))
+    return encode_field(3, 2, encode_layer(TILE_LAYER, features, keys, values))
+
+def write_tile_pyramid(output_dir, lats, lons, spacing_lat, spacing_lon, properties,
+                       min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM):
+    """Write a z/x/y directory of MVT tiles for one city's grid.
+
+    properties maps metric names to value arrays parallel to lats/lons.
+    Also writes metadata.json describing the layer and zoom range.
+    Returns the number of tiles written.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    properties = {key: np.asarray(values, dtype=np.float64) for key, values in properties.items()}
+    tile_count = 0
+    for zoom in range(min_zoom, max_zoom + 1):
+        edges, cells, tiles_x, tiles_y = tile_cells(lats, lons, spacing_lat / 2, spacing_lon / 2, zoom)
+        order = np.lexsort((cells, tiles_y, tiles_x))
+        cells, tiles_x, tiles_y = cells[order], tiles_x[order], tiles_y[order]
+        breaks = np.flatnonzero((np.diff(tiles_x) != 0) | (np.diff(tiles_y) != 0)) + 1
+        for group in np.split(np.arange(len(cells)), breaks):
+            if len(group) == 0:
+                continue
+            tile_x, tile_y = int(tiles_x[group[0]]), int(tiles_y[group[0]])
+            tile_path = os.path.join(output_dir, str(zoom), str(tile_x), f'{tile_y}.pbf')
+            os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+            with open(tile_path, 'wb') as f:
+                f.write(encode_tile(cells[group], tile_x, tile_y, edges, properties))
+            tile_count += 1
+
+    metadata = {
+        'name': os.path.basename(os.path.normpath(output_dir)),
+        'format': 'pbf',
+        'minzoom': min_zoom,
+        'maxzoom': max_zoom,
+        'bounds': [float(lons.min() - spacing_lon / 2), float(lats.min() - spacing_lat / 2),
+                   float(lons.max() + spacing_lon / 2), float(lats.max() + spacing_lat / 2)]
+                  if len(lats) else None,
+        'vector_layers': [{'id': TILE_LAYER, 'fields': {key: 'Number' for key in properties}}]
+    }
+    with open(os.path.join(output_dir, 'metadata.json'), 'w', encoding='utf-8') as f:
+        json.dump(metadata, f, indent=2)
+    return tile_count
+
+def build_city_tiles(binary_file, tiles_dir, properties=None, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM):
+    """Build the tile pyramid for one city from its columnar .bin file."""
+    header, columns = read_city_binary(binary_file)
+    properties = properties or load_tile_properties()
+    missing = [name for name in properties if name not in columns]
+    if missing:
+        print(f"Warning: {', '.join(missing)} not found in {binary_file}")
+    city_name = os.path.splitext(os.path.basename(binary_file))[0]
+    output_dir = os.path.join(tiles_dir, city_name)
+    count = write_tile_pyramid(output_dir, columns['Latitude'], columns['Longitude'],
+                               header['spacing']['lat'], header['spacing']['lon'],
+                               {name: columns[name] for name in properties if name in columns},
+                               min_zoom, max_zoom)
+    print(f"Wrote {count} tiles for {city_name} to {output_dir}")
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build Mapbox Vector Tile pyramids from the .bin files written by generate_city_kml.py --binary')
+    parser.add_argument('--input-dir', help='Directory of city .bin files (default: data/KMLs)')
+    parser.add_argument('--output-dir', help='Directory for z/x/y tiles (default: data/tiles)')
+    parser.add_argument('--min-zoom', type=int, default=MIN_ZOOM,
+                        help=f'Lowest zoom level to build (default: {MIN_ZOOM})')
+    parser.add_argument('--max-zoom', type=int, default=MAX_ZOOM,
+                        help=f'Highest zoom level to build (default: {MAX_ZOOM})')
+    parser.add_argument('--properties', nargs='+',
+                        help='Metric names to carry in the tiles (default: the metrics listed in config.js)')
+    args = parser.parse_args()
+
+    base_path = Path(__file__).parent
+    input_dir = Path(args.input_dir) if args.input_dir else base_path / "data/KMLs"
+    output_dir = Path(args.output_dir) if args.output_dir else base_path / "data/tiles"
+
+    for binary_file in sorted(input_dir.glob(f"*{BINARY_EXTENSION}")):
+        build_city_tiles(str(binary_file), str(output_dir), args.properties, args.min_zoom, args.max_zoom)
+
+if __name__ == "__main__":
+    main()
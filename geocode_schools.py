@@ -1,30 +1,212 @@
 import os
 import re
 import json
+import math
 import time
+import random
 import logging
+import sqlite3
+import threading
 import pandas as pd
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import quote
 from dotenv import load_dotenv
 from tqdm import tqdm
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('geocoding.log'),
-        logging.StreamHandler()
-    ]
-)
+import pipeline_metrics
 
 # Load environment variables
 load_dotenv()
 MAPBOX_TOKEN = os.getenv('MAPBOX_TOKEN')
 
-if not MAPBOX_TOKEN:
-    raise ValueError("Please set MAPBOX_TOKEN in your .env file")
+def configure_logging(debug=False):
+    """Log to geocoding.log and the console; only the script does this, not importers."""
+    logging.basicConfig(
+        level=logging.DEBUG if debug else logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler('geocoding.log'),
+            logging.StreamHandler()
+        ]
+    )
+
+def require_mapbox_token():
+    """Fail before geocoding, rather than at import, when no token is set."""
+    if not MAPBOX_TOKEN:
+        raise ValueError("Please set MAPBOX_TOKEN in your .env file")
+
+# Override to point the geocoder at another endpoint, e.g. a local stub for load tests
+GEOCODING_URL = os.getenv('MAPBOX_GEOCODING_URL', 'https://api.mapbox.com/geocoding/v5/mapbox.places')
+DEFAULT_WORKERS = 8
+DEFAULT_RATE_LIMIT = 10.0  # requests per second
+MAX_BACKOFF = 60.0
+# Returned by geocode_address when retries ran out on 429s, server errors or
+# network errors; unlike None (no match) it is not cached, so the next run retries
+TRANSIENT_FAILURE = 'transient'
+
+CACHE_DIR = 'cache'
+JSON_CACHE_FILE = os.path.join(CACHE_DIR, 'geocoding_cache.json')
+SQLITE_CACHE_FILE = os.path.join(CACHE_DIR, 'geocoding_cache.sqlite')
+CACHE_COMMIT_EVERY = 500
+
+SCHOOL_TILE_ZOOM = 7
+SCHOOL_TILE_INDEX = 'index.json'
+
+class JSONGeocodingCache:
+    """The original whole-file JSON cache: loaded fully, rewritten on commit.
+
+    Kept for compatibility; it has no timestamps, so TTLs do not apply.
+    The file is only rewritten when entries changed since the last commit.
+    """
+    def __init__(self, path=JSON_CACHE_FILE):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, key):
+        """Return (found, result); result is None for a failed geocode."""
+        if key in self.entries:
+            return True, self.entries[key]
+        return False, None
+
+    def lookup_many(self, keys):
+        """Return {key: result} for the keys that are cached."""
+        return {key: self.entries[key] for key in keys if key in self.entries}
+
+    def set(self, key, result):
+        if key not in self.entries or self.entries[key] != result:
+            self.entries[key] = result
+            self.dirty = True
+
+    def items(self):
+        return iter(self.entries.items())
+
+    def commit(self):
+        if not self.dirty:
+            return
+        # Write to a temp file first so a crash cannot truncate the cache
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def close(self):
+        self.commit()
+
+class SQLiteGeocodingCache:
+    """Geocoding cache in SQLite (WAL mode) with per-entry timestamps.
+
+    Upserts are single-row and committed in batches, so the cache never
+    has to be rewritten as a whole and a crash loses at most one batch.
+    Entries older than ttl_days, or failed (None) entries older than
+    failed_ttl_days, are reported as missing so they get re-geocoded.
+    An empty database is seeded from the legacy JSON cache if one exists.
+    """
+    def __init__(self, path=SQLITE_CACHE_FILE, ttl_days=None, failed_ttl_days=None,
+                 commit_every=CACHE_COMMIT_EVERY, legacy_json=JSON_CACHE_FILE):
+        self.path = path
+        self.ttl = ttl_days * 86400 if ttl_days is not None else None
+        self.failed_ttl = failed_ttl_days * 86400 if failed_ttl_days is not None else None
+        self.commit_every = commit_every
+        self.pending = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS geocodes ('
+            'key TEXT PRIMARY KEY, result TEXT, updated_at REAL NOT NULL)')
+        self.conn.commit()
+        if legacy_json and len(self) == 0 and os.path.exists(legacy_json):
+            self.import_json(legacy_json)
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM geocodes').fetchone()[0]
+
+    def import_json(self, json_path):
+        """Seed the cache from a legacy JSON cache, timestamped with its mtime."""
+        with open(json_path, 'r') as f:
+            entries = json.load(f)
+        updated_at = os.path.getmtime(json_path)
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO geocodes (key, result, updated_at) VALUES (?, ?, ?)',
+            ((key, json.dumps(result) if result is not None else None, updated_at)
+             for key, result in entries.items()))
+        self.conn.commit()
+        logging.info(f"Imported {len(entries)} geocoding results from {json_path}")
+
+    def _is_stale(self, result, updated_at, now):
+        ttl = self.failed_ttl if result is None else self.ttl
+        return ttl is not None and now - updated_at > ttl
+
+    def lookup(self, key):
+        """Return (found, result); result is None for a failed geocode."""
+        row = self.conn.execute('SELECT result, updated_at FROM geocodes WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return False, None
+        result = json.loads(row[0]) if row[0] is not None else None
+        if self._is_stale(result, row[1], time.time()):
+            return False, None
+        return True, result
+
+    def lookup_many(self, keys, chunk_size=500):
+        """Return {key: result} for the keys that are cached and not stale."""
+        keys = list(keys)
+        now = time.time()
+        found = {}
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            rows = self.conn.execute(
+                f'SELECT key, result, updated_at FROM geocodes WHERE key IN ({",".join("?" * len(chunk))})',
+                chunk)
+            for key, result, updated_at in rows:
+                result = json.loads(result) if result is not None else None
+                if not self._is_stale(result, updated_at, now):
+                    found[key] = result
+        return found
+
+    def set(self, key, result):
+        self.conn.execute(
+            'INSERT INTO geocodes (key, result, updated_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET result = excluded.result, updated_at = excluded.updated_at',
+            (key, json.dumps(result) if result is not None else None, time.time()))
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def items(self):
+        """Iterate (key, result) over entries that are not stale."""
+        now = time.time()
+        for key, result, updated_at in self.conn.execute('SELECT key, result, updated_at FROM geocodes'):
+            result = json.loads(result) if result is not None else None
+            if not self._is_stale(result, updated_at, now):
+                yield key, result
+
+    def commit(self):
+        self.conn.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+def open_geocoding_cache(backend='sqlite', path=None, ttl_days=None, failed_ttl_days=None):
+    """Open the geocoding cache for the given backend ('sqlite' or 'json')."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    if backend == 'json':
+        return JSONGeocodingCache(path or JSON_CACHE_FILE)
+    if backend == 'sqlite':
+        return SQLiteGeocodingCache(path or SQLITE_CACHE_FILE, ttl_days=ttl_days,
+                                    failed_ttl_days=failed_ttl_days)
+    raise ValueError(f"Unknown cache backend: {backend}")
 
 def clean_address(address, state):
     """Clean address by removing phone numbers and extra whitespace"""
@@ -62,190 +244,384 @@ def clean_address(address, state):
     address = re.sub(r',\s*,', ',', address)
     return address.strip()
 
-def batch_geocode(addresses, retry_count=3, delay=1):
+# Patterns used by normalize_addresses, in the order clean_address applies them
+PHONE_PATTERNS = [re.compile(r'\(\d{3}\)\s*\d{3}-\d{4}'), re.compile(r'\d{3}-\d{3}-\d{4}')]
+UNIT_PATTERNS = [
+    re.compile(r'#\s*[A-Za-z0-9-]+(?=[\s,]|$)'),
+    re.compile(r'(?:Ste|Suite)\s+[A-Za-z0-9-]+(?=[\s,]|$)'),
+    re.compile(r'Unit\s+[A-Za-z0-9-]+(?=[\s,]|$)')
+]
+WHITESPACE_PATTERN = re.compile(r'\s+')
+DOUBLE_COMMA_PATTERN = re.compile(r',\s*,')
+
+def normalize_addresses(df):
+    """Vectorized clean_address over a whole school table.
+
+    Returns a DataFrame with 'clean_address' and 'address_key' columns
+    aligned with df; both are None where the address or state is missing.
+    """
+    valid = df['address'].notna() & df['state'].notna()
+    address = df.loc[valid, 'address'].astype(str)
+    state = df.loc[valid, 'state'].astype(str)
+    
+    for pattern in PHONE_PATTERNS + UNIT_PATTERNS:
+        address = address.str.replace(pattern, '', regex=True)
+    
+    # Collapse newlines and runs of whitespace
+    address = address.str.replace(WHITESPACE_PATTERN, ' ', regex=True).str.strip()
+    address = address.str.replace('#', '', regex=False)
+    
+    # Add state if not in address
+    address = pd.Series(
+        [a if s in a else f"{a}, {s}" for a, s in zip(address.tolist(), state.tolist())],
+        index=address.index, dtype=object)
+    address = address.str.replace(DOUBLE_COMMA_PATTERN, ',', regex=True).str.strip()
+    
+    result = pd.DataFrame({'clean_address': None, 'address_key': None}, index=df.index, dtype=object)
+    result.loc[valid, 'clean_address'] = address
+    result.loc[valid, 'address_key'] = address.str.lower().str.replace(' ', '', regex=False)
+    return result
+
+class TokenBucket:
+    """Thread-safe token bucket that limits requests per second.
+
+    pause() holds back every caller, e.g. while honouring a 429 Retry-After.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+def retry_after_seconds(response, default):
+    """Seconds to wait from a Retry-After header, falling back to default."""
+    try:
+        return max(0.0, float(response.headers.get('Retry-After')))
+    except (TypeError, ValueError):
+        return default
+
+def create_session(pool_size=DEFAULT_WORKERS):
+    """Create a keep-alive session whose connection pool fits all workers."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def geocode_address(session, address, bucket, base_url=GEOCODING_URL, retry_count=3, delay=1):
+    """
+    Geocode one address, backing off exponentially on 429s and server errors
+    
+    Returns the result, None when the geocoder found no match or rejected
+    the request, or TRANSIENT_FAILURE when every attempt was rate limited
+    or failed on the server or network side.
+    """
+    for attempt in range(retry_count):
+        backoff = min(MAX_BACKOFF, delay * (2 ** attempt)) + random.uniform(0, delay)
+        bucket.acquire()
+        start = time.perf_counter()
+        try:
+            response = session.get(
+                f"{base_url}/{quote(address, safe='')}.json",
+                params={
+                    "access_token": MAPBOX_TOKEN,
+                    "limit": 1,
+                    "country": "US"
+                },
+                timeout=30
+            )
+            pipeline_metrics.observe('geocoder', time.perf_counter() - start)
+            if response.status_code == 429:
+                pipeline_metrics.count('geocoder_rate_limited')
+                # Rate limited: slow every worker down, not just this one
+                wait = retry_after_seconds(response, backoff)
+                bucket.pause(wait)
+                logging.warning(f"Rate limited, backing off {wait:.1f}s")
+                continue
+            response.raise_for_status()
+            data = response.json()
+            
+            if data['features']:
+                feature = data['features'][0]
+                return {
+                    'address': address,
+                    'coordinates': feature['geometry']['coordinates'],
+                    'confidence': feature.get('relevance', 0),
+                    'place_name': feature['place_name']
+                }
+            logging.warning(f"No results found for address: {address}")
+            return None
+            
+        except requests.exceptions.RequestException as e:
+            pipeline_metrics.count('geocoder_errors')
+            status = getattr(e.response, 'status_code', None)
+            if status is not None and 400 <= status < 500:
+                # Client errors will not succeed on retry
+                logging.error(f"Failed to geocode address: {address}")
+                logging.error(f"Error: {str(e)}")
+                return None
+            if attempt == retry_count - 1:
+                logging.error(f"Failed to geocode address: {address}")
+                logging.error(f"Error: {str(e)}")
+                return TRANSIENT_FAILURE
+            time.sleep(backoff)
+    
+    logging.error(f"Failed to geocode address after {retry_count} attempts: {address}")
+    return TRANSIENT_FAILURE
+
+def batch_geocode(addresses, retry_count=3, delay=1, workers=DEFAULT_WORKERS,
+                  rate_limit=DEFAULT_RATE_LIMIT, base_url=GEOCODING_URL, session=None, bucket=None):
     """
-    Geocode multiple addresses in a single request
+    Geocode multiple addresses concurrently
+    
+    Requests share one keep-alive session, at most `workers` are in flight
+    and a token bucket keeps the overall rate under `rate_limit` per second.
+    Results are returned in the same order as the addresses; see
+    geocode_address for what each result can be.
     """
     if not addresses:
         return []
     
     start_time = time.time()
+    session = session or create_session(workers)
+    bucket = bucket or TokenBucket(rate_limit)
     
-    # Prepare the batch request
-    # Note: We're using the temporary solution of multiple API calls
-    # In production, you'd want to use Mapbox's batch geocoding endpoint
-    results = []
-    
-    for address in addresses:
-        for attempt in range(retry_count):
-            try:
-                response = requests.get(
-                    f"https://api.mapbox.com/geocoding/v5/mapbox.places/{address}.json",
-                    params={
-                        "access_token": MAPBOX_TOKEN,
-                        "limit": 1,
-                        "country": "US"
-                    }
-                )
-                response.raise_for_status()
-                data = response.json()
-                
-                if data['features']:
-                    feature = data['features'][0]
-                    results.append({
-                        'address': address,
-                        'coordinates': feature['geometry']['coordinates'],
-                        'confidence': feature.get('relevance', 0),
-                        'place_name': feature['place_name']
-                    })
-                else:
-                    results.append(None)
-                    logging.warning(f"No results found for address: {address}")
-                
-                # Add a small delay between requests to respect rate limits
-                time.sleep(0.1)
-                break
-                
-            except requests.exceptions.RequestException as e:
-                if attempt == retry_count - 1:
-                    results.append(None)
-                    logging.error(f"Failed to geocode address: {address}")
-                    logging.error(f"Error: {str(e)}")
-                else:
-                    time.sleep(delay * (attempt + 1))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(
+            lambda address: geocode_address(session, address, bucket, base_url, retry_count, delay),
+            addresses))
     
     elapsed = time.time() - start_time
     logging.debug(f"Batch geocoded {len(addresses)} addresses in {elapsed:.2f}s")
     return results
 
-def process_schools(input_csv, output_geojson, batch_size=25):
+def school_features(df, results):
+    """
+    Yield a GeoJSON feature per school with a successful geocode
+    
+    df needs clean_address/address_key columns from normalize_addresses;
+    results maps address keys to cached geocoding results. The join is a
+    DataFrame merge and properties are built from whole columns.
+    """
+    geocoded = pd.DataFrame(
+        [(key, result['coordinates'], result['confidence'], result['place_name'])
+         for key, result in results.items() if result],
+        columns=['address_key', 'coordinates', 'confidence', 'place_name'], dtype=object)
+    merged = df[['name', 'clean_address', 'tuition', 'grades', 'religion', 'state', 'address_key']].merge(
+        geocoded, on='address_key', how='inner')
+    
+    # Handle NaN values for JSON serialization
+    def nullable(column):
+        return merged[column].astype(object).where(merged[column].notna(), None).tolist()
+    
+    tuition = pd.to_numeric(merged['tuition'], errors='coerce').astype(object)
+    columns = {
+        "name": nullable('name'),
+        "address": merged['clean_address'].tolist(),
+        "tuition": tuition.where(tuition.notna(), None).tolist(),
+        "grades": nullable('grades'),
+        "religion": nullable('religion'),
+        "state": merged['state'].tolist(),
+        "confidence": merged['confidence'].tolist(),
+        "place_name": merged['place_name'].tolist()
+    }
+    for coordinates, values in zip(merged['coordinates'], zip(*columns.values())):
+        yield {
+            "type": "Feature",
+            "geometry": {
+                "type": "Point",
+                "coordinates": coordinates
+            },
+            "properties": dict(zip(columns.keys(), values))
+        }
+
+def write_geojson(output_geojson, features):
+    """
+    Stream features into a FeatureCollection file one at a time
+    
+    The output is identical to json.dump of the whole collection.
+    Returns the number of features written.
+    """
+    count = 0
+    with open(output_geojson, 'w') as f:
+        f.write('{"type": "FeatureCollection", "features": [')
+        for feature in features:
+            if count:
+                f.write(', ')
+            f.write(json.dumps(feature))
+            count += 1
+        f.write(']}')
+    return count
+
+def tile_quadkey(lon, lat, zoom):
+    """Web Mercator quadkey of the tile containing a point."""
+    lat = max(min(lat, 85.05112878), -85.05112878)
+    n = 1 << zoom
+    x = min(n - 1, max(0, int((lon + 180.0) / 360.0 * n)))
+    sin_lat = math.sin(math.radians(lat))
+    y = min(n - 1, max(0, int((0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * n)))
+    digits = []
+    for i in range(zoom, 0, -1):
+        mask = 1 << (i - 1)
+        digits.append(str((1 if x & mask else 0) + (2 if y & mask else 0)))
+    return ''.join(digits)
+
+def quadkey_bbox(quadkey):
+    """[west, south, east, north] of a quadkey's tile."""
+    x = y = 0
+    for digit in quadkey:
+        x, y = x * 2 + (int(digit) & 1), y * 2 + (int(digit) >> 1)
+    n = 1 << len(quadkey)
+    
+    def lat(tile_y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / n))))
+    
+    return [x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0, lat(y)]
+
+def write_school_tiles(output_dir, features, zoom=SCHOOL_TILE_ZOOM):
+    """
+    Partition school features into one GeoJSON file per quadkey tile
+    
+    Features are serialized into per-tile buffers as they arrive and each
+    tile is written once at the end, so only one file is open at a time.
+    index.json maps each quadkey to its file, bounding box, school count
+    and tuition min/max, so the map can fetch only tiles in view that can
+    pass its tuition filter. Returns the index.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    buffers = {}
+    tiles = {}
+    for feature in features:
+        lon, lat = feature['geometry']['coordinates'][:2]
+        quadkey = tile_quadkey(lon, lat, zoom)
+        if quadkey not in tiles:
+            buffers[quadkey] = []
+            tiles[quadkey] = {'file': f'{quadkey}.geojson', 'bbox': quadkey_bbox(quadkey),
+                              'count': 0, 'tuition_min': None, 'tuition_max': None}
+        tile = tiles[quadkey]
+        buffers[quadkey].append(json.dumps(feature))
+        tile['count'] += 1
+        tuition = feature['properties'].get('tuition')
+        if tuition is not None:
+            tile['tuition_min'] = tuition if tile['tuition_min'] is None else min(tile['tuition_min'], tuition)
+            tile['tuition_max'] = tuition if tile['tuition_max'] is None else max(tile['tuition_max'], tuition)
+    
+    for quadkey, buffer in buffers.items():
+        with open(os.path.join(output_dir, tiles[quadkey]['file']), 'w') as f:
+            f.write('{"type": "FeatureCollection", "features": [')
+            f.write(', '.join(buffer))
+            f.write(']}')
+    
+    index = {'zoom': zoom, 'tiles': dict(sorted(tiles.items()))}
+    with open(os.path.join(output_dir, SCHOOL_TILE_INDEX), 'w') as f:
+        json.dump(index, f, indent=1)
+    logging.info(f"Wrote {sum(t['count'] for t in tiles.values())} schools into {len(tiles)} tiles in {output_dir}")
+    return index
+
+def process_schools(input_csv, output_geojson, batch_size=25, workers=DEFAULT_WORKERS,
+                    rate_limit=DEFAULT_RATE_LIMIT, base_url=GEOCODING_URL, cache_backend='sqlite',
+                    cache_path=None, cache_ttl_days=None, failed_ttl_days=None, tiles_dir=None,
+                    tile_zoom=SCHOOL_TILE_ZOOM):
     """
     Process school data from CSV and create a GeoJSON file
     """
+    require_mapbox_token()
     start_time = time.time()
     logging.info(f"Starting geocoding process at {datetime.now()}")
     
     # Read CSV file
-    df = pd.read_csv(input_csv)
-    # Drop rows with missing addresses or states
-    df = df.dropna(subset=['address', 'state'])
+    with pipeline_metrics.stage('load') as loaded:
+        df = pd.read_csv(input_csv)
+        # Drop rows with missing addresses or states
+        df = df.dropna(subset=['address', 'state'])
+        loaded['rows'] = len(df)
     logging.info(f"Loaded {len(df)} schools from {input_csv}")
     
-    # Initialize GeoJSON structure
-    geojson = {
-        "type": "FeatureCollection",
-        "features": []
-    }
+    # Open the geocoding cache
+    geocoding_cache = open_geocoding_cache(cache_backend, cache_path, cache_ttl_days, failed_ttl_days)
+    logging.info(f"Opened geocoding cache with {len(geocoding_cache)} entries")
     
-    # Create cache directory if it doesn't exist
-    os.makedirs('cache', exist_ok=True)
-    cache_file = 'cache/geocoding_cache.json'
+    # One session and rate limiter shared by every batch
+    session = create_session(workers)
+    bucket = TokenBucket(rate_limit)
     
-    # Load existing cache
-    geocoding_cache = {}
-    if os.path.exists(cache_file):
-        with open(cache_file, 'r') as f:
-            geocoding_cache = json.load(f)
-            logging.info(f"Loaded {len(geocoding_cache)} cached geocoding results")
+    # Normalize every address once and find the unique keys not yet cached
+    with pipeline_metrics.stage('normalize', len(df)):
+        df = df.join(normalize_addresses(df))
+        df = df[df['address_key'].notna()]
+        unique = df.drop_duplicates('address_key')
+    with pipeline_metrics.stage('cache_lookup', len(unique)):
+        results = geocoding_cache.lookup_many(unique['address_key'])
+    to_geocode = {address_key: clean_addr
+                  for address_key, clean_addr in zip(unique['address_key'], unique['clean_address'])
+                  if address_key not in results}
     
     # Track statistics
-    cache_hits = 0
+    cache_hits = int(df['address_key'].isin(results.keys()).sum())
     successful_geocodes = 0
     failed_geocodes = 0
+    transient_failures = 0
+    pipeline_metrics.count('geocode_cache_hits', len(unique) - len(to_geocode))
+    pipeline_metrics.count('geocode_cache_misses', len(to_geocode))
+    logging.info(f"{len(df)} schools share {df['address_key'].nunique()} unique addresses, "
+                 f"{len(to_geocode)} of them not cached")
     
-    # Process schools in batches
-    for i in tqdm(range(0, len(df), batch_size)):
-        batch_df = df.iloc[i:i+batch_size]
-        
-        # Prepare addresses to geocode
-        addresses_to_geocode = []
-        batch_rows = []
-        
-        for _, row in batch_df.iterrows():
-            clean_addr = clean_address(row['address'], row['state'])
-            if clean_addr is None:
-                continue
-                
-            address_key = clean_addr.lower().replace(' ', '')
-            
-            if address_key in geocoding_cache:
-                cache_hits += 1
-                if geocoding_cache[address_key]:
-                    # Handle NaN values for JSON serialization
-                    properties = {
-                        "name": row['name'] if pd.notna(row['name']) else None,
-                        "address": clean_addr,
-                        "tuition": float(row['tuition']) if pd.notna(row['tuition']) else None,
-                        "grades": row['grades'] if pd.notna(row['grades']) else None,
-                        "religion": row['religion'] if pd.notna(row['religion']) else None,
-                        "state": row['state'],
-                        "confidence": geocoding_cache[address_key]['confidence'],
-                        "place_name": geocoding_cache[address_key]['place_name']
-                    }
-                    
-                    feature = {
-                        "type": "Feature",
-                        "geometry": {
-                            "type": "Point",
-                            "coordinates": geocoding_cache[address_key]['coordinates']
-                        },
-                        "properties": properties
-                    }
-                    geojson['features'].append(feature)
-            else:
-                addresses_to_geocode.append(clean_addr)
-                batch_rows.append(row)
-        
-        # Geocode new addresses
-        if addresses_to_geocode:
-            results = batch_geocode(addresses_to_geocode)
-            
-            for j, result in enumerate(results):
-                row = batch_rows[j]
-                address_key = addresses_to_geocode[j].lower().replace(' ', '')
-                
+    # Geocode the unique uncached addresses in batches
+    pending = list(to_geocode.items())
+    with pipeline_metrics.stage('geocode', len(pending)):
+        for i in tqdm(range(0, len(pending), batch_size)):
+            batch = pending[i:i+batch_size]
+            batch_results = batch_geocode([clean_addr for _, clean_addr in batch], workers=workers,
+                                          rate_limit=rate_limit, base_url=base_url, session=session,
+                                          bucket=bucket)
+            for (address_key, _), result in zip(batch, batch_results):
+                if result == TRANSIENT_FAILURE:
+                    # Leave it out of the cache so the next run tries again
+                    results[address_key] = None
+                    transient_failures += 1
+                    pipeline_metrics.count('geocode_transient_failures')
+                    continue
+                results[address_key] = result
+                geocoding_cache.set(address_key, result)
                 if result:
                     successful_geocodes += 1
-                    geocoding_cache[address_key] = result
-                    
-                    # Handle NaN values for JSON serialization
-                    properties = {
-                        "name": row['name'] if pd.notna(row['name']) else None,
-                        "address": addresses_to_geocode[j],
-                        "tuition": float(row['tuition']) if pd.notna(row['tuition']) else None,
-                        "grades": row['grades'] if pd.notna(row['grades']) else None,
-                        "religion": row['religion'] if pd.notna(row['religion']) else None,
-                        "state": row['state'],
-                        "confidence": result['confidence'],
-                        "place_name": result['place_name']
-                    }
-                    
-                    feature = {
-                        "type": "Feature",
-                        "geometry": {
-                            "type": "Point",
-                            "coordinates": result['coordinates']
-                        },
-                        "properties": properties
-                    }
-                    geojson['features'].append(feature)
                 else:
                     failed_geocodes += 1
-                    geocoding_cache[address_key] = None
-        
-        # Save cache periodically
-        if i % (batch_size * 10) == 0:
-            with open(cache_file, 'w') as f:
-                json.dump(geocoding_cache, f)
-            logging.info(f"Saved cache with {len(geocoding_cache)} entries (processed {i}/{len(df)} schools)")
+            
+            # Commit cache periodically
+            if i % (batch_size * 10) == 0:
+                geocoding_cache.commit()
+                logging.info(f"Committed geocoding cache (geocoded {i}/{len(pending)} addresses)")
     
     # Save final cache
-    with open(cache_file, 'w') as f:
-        json.dump(geocoding_cache, f)
+    geocoding_cache.close()
     
-    # Save GeoJSON
-    with open(output_geojson, 'w') as f:
-        json.dump(geojson, f)
+    # Save GeoJSON, fanning results back out to every school sharing an address
+    with pipeline_metrics.stage('write', len(df)):
+        write_geojson(output_geojson, school_features(df, results))
+        if tiles_dir:
+            write_school_tiles(tiles_dir, school_features(df, results), tile_zoom)
     
     end_time = time.time()
     elapsed = end_time - start_time
@@ -256,13 +632,16 @@ def process_schools(input_csv, output_geojson, batch_size=25):
     logging.info(f"Average time per school: {elapsed/len(df):.2f} seconds")
     logging.info(f"Total schools processed: {len(df)}")
     logging.info(f"Cache hits: {cache_hits}")
-    logging.info(f"Successful new geocodes: {successful_geocodes}")
-    logging.info(f"Failed geocodes: {failed_geocodes}")
-    logging.info(f"Success rate: {((cache_hits + successful_geocodes) / len(df)) * 100:.1f}%")
+    logging.info(f"Successful new geocodes: {successful_geocodes} unique addresses")
+    logging.info(f"Failed geocodes: {failed_geocodes} unique addresses")
+    logging.info(f"Not cached after rate limits or server errors: {transient_failures} unique addresses")
+    geocoded = int(df['address_key'].map(results).map(bool).sum())
+    logging.info(f"Success rate: {(geocoded / len(df)) * 100:.1f}%")
     logging.info(f"GeoJSON saved to: {output_geojson}")
-    logging.info(f"Geocoding cache saved to: {cache_file}")
+    logging.info(f"Geocoding cache saved to: {geocoding_cache.path}")
 
-def reformat_geojson(input_csv, output_geojson, cache_file='cache/geocoding_cache.json'):
+def reformat_geojson(input_csv, output_geojson, cache_backend='sqlite', cache_path=None, tiles_dir=None,
+                     tile_zoom=SCHOOL_TILE_ZOOM):
     """
     Reformat existing geocoded data with proper JSON null values without re-geocoding
     """
@@ -273,57 +652,25 @@ def reformat_geojson(input_csv, output_geojson, cache_file='cache/geocoding_cach
     df = df.dropna(subset=['address', 'state'])
     
     # Load existing cache
-    if not os.path.exists(cache_file):
-        raise FileNotFoundError(f"Cache file {cache_file} not found. Please run geocoding first.")
-        
-    with open(cache_file, 'r') as f:
-        geocoding_cache = json.load(f)
-    
-    # Initialize GeoJSON structure
-    geojson = {
-        "type": "FeatureCollection",
-        "features": []
-    }
+    geocoding_cache = open_geocoding_cache(cache_backend, cache_path)
+    if len(geocoding_cache) == 0:
+        raise FileNotFoundError(f"Geocoding cache {geocoding_cache.path} is empty. Please run geocoding first.")
     
-    # Process all schools
-    for _, row in tqdm(df.iterrows(), total=len(df)):
-        clean_addr = clean_address(row['address'], row['state'])
-        if clean_addr is None:
-            continue
-            
-        address_key = clean_addr.lower().replace(' ', '')
-        
-        if address_key in geocoding_cache and geocoding_cache[address_key]:
-            # Handle NaN values for JSON serialization
-            properties = {
-                "name": row['name'] if pd.notna(row['name']) else None,
-                "address": clean_addr,
-                "tuition": float(row['tuition']) if pd.notna(row['tuition']) else None,
-                "grades": row['grades'] if pd.notna(row['grades']) else None,
-                "religion": row['religion'] if pd.notna(row['religion']) else None,
-                "state": row['state'],
-                "confidence": geocoding_cache[address_key]['confidence'],
-                "place_name": geocoding_cache[address_key]['place_name']
-            }
-            
-            feature = {
-                "type": "Feature",
-                "geometry": {
-                    "type": "Point",
-                    "coordinates": geocoding_cache[address_key]['coordinates']
-                },
-                "properties": properties
-            }
-            geojson['features'].append(feature)
+    # Join every school to its cached result
+    df = df.join(normalize_addresses(df))
+    df = df[df['address_key'].notna()]
+    results = geocoding_cache.lookup_many(df['address_key'].unique())
+    geocoding_cache.close()
     
     # Save reformatted GeoJSON
-    with open(output_geojson, 'w') as f:
-        json.dump(geojson, f)
+    count = write_geojson(output_geojson, school_features(df, results))
+    if tiles_dir:
+        write_school_tiles(tiles_dir, school_features(df, results), tile_zoom)
     
-    logging.info(f"Reformatted {len(geojson['features'])} schools with proper null values")
+    logging.info(f"Reformatted {count} schools with proper null values")
     logging.info(f"GeoJSON saved to: {output_geojson}")
 
-if __name__ == "__main__":
+def main():
     import argparse
     
     parser = argparse.ArgumentParser(description='Geocode school addresses to GeoJSON')
@@ -331,17 +678,44 @@ if __name__ == "__main__":
     parser.add_argument('output_geojson', help='Output GeoJSON file')
     parser.add_argument('--batch-size', type=int, default=25,
                       help='Number of records to process in each batch (default: 25)')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                      help=f'Maximum concurrent geocoding requests (default: {DEFAULT_WORKERS})')
+    parser.add_argument('--rate-limit', type=float, default=DEFAULT_RATE_LIMIT,
+                      help=f'Maximum geocoding requests per second (default: {DEFAULT_RATE_LIMIT:g})')
+    parser.add_argument('--base-url', default=GEOCODING_URL,
+                      help='Geocoding endpoint base URL (default: Mapbox places, or MAPBOX_GEOCODING_URL)')
+    parser.add_argument('--cache-backend', choices=['sqlite', 'json'], default='sqlite',
+                      help='Geocoding cache store (default: sqlite, seeded from the JSON cache)')
+    parser.add_argument('--cache-path', help='Path of the geocoding cache file')
+    parser.add_argument('--cache-ttl-days', type=float,
+                      help='Re-geocode cached results older than this many days')
+    parser.add_argument('--failed-ttl-days', type=float,
+                      help='Retry cached failed geocodes older than this many days')
+    parser.add_argument('--tiles-dir',
+                      help='Also write schools partitioned into quadkey tiles with an index.json here')
+    parser.add_argument('--tile-zoom', type=int, default=SCHOOL_TILE_ZOOM,
+                      help=f'Zoom level of the school tiles (default: {SCHOOL_TILE_ZOOM})')
     parser.add_argument('--debug', action='store_true',
                       help='Enable debug logging')
     parser.add_argument('--reformat-only', action='store_true',
                       help='Only reformat existing geocoded data without re-geocoding')
     
+    pipeline_metrics.add_arguments(parser)
+    
     args = parser.parse_args()
     
-    if args.debug:
-        logging.getLogger().setLevel(logging.DEBUG)
+    configure_logging(args.debug)
     
-    if args.reformat_only:
-        reformat_geojson(args.input_csv, args.output_geojson)
-    else:
-        process_schools(args.input_csv, args.output_geojson, args.batch_size)
+    with pipeline_metrics.start_run('geocode_schools', args):
+        if args.reformat_only:
+            reformat_geojson(args.input_csv, args.output_geojson, args.cache_backend, args.cache_path,
+                             tiles_dir=args.tiles_dir, tile_zoom=args.tile_zoom)
+        else:
+            process_schools(args.input_csv, args.output_geojson, args.batch_size,
+                            workers=args.workers, rate_limit=args.rate_limit, base_url=args.base_url,
+                            cache_backend=args.cache_backend, cache_path=args.cache_path,
+                            cache_ttl_days=args.cache_ttl_days, failed_ttl_days=args.failed_ttl_days,
+                            tiles_dir=args.tiles_dir, tile_zoom=args.tile_zoom)
+
+if __name__ == "__main__":
+    main()
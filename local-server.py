@@ -1,16 +1,43 @@
 import http.server
-import socketserver
+import email.utils
+import io
+import json
 import os
+import re
 import sys
 from functools import partial
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from city_query import CityColumnCache, row_cell_ids, rows_geojson
+
+# Pages and scripts change constantly during development; everything else
+# (KMLs, .bin, tiles, GeoJSON) is revalidated with ETag/Last-Modified
+NO_STORE_EXTENSIONS = ('.html', '.js')
+
+# Build-time siblings, best first: <file>.br, then <file>.gz
+PRECOMPRESSED = [('br', '.br'), ('gzip', '.gz')]
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# /api/city/<name>?metric=...&min=...&max=... answers from city .bin files
+API_PREFIX = '/api/city'
+CITY_DATA_DIR = os.path.join('data', 'KMLs')
+CITY_CACHE_MB = int(os.environ.get('CITY_CACHE_MB', 512))
 
 class CORSHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    extensions_map = {
+        **http.server.SimpleHTTPRequestHandler.extensions_map,
+        '.pbf': 'application/x-protobuf'  # Vector tiles from generate_city_tiles.py
+    }
+
+    city_cache = None
+
     def end_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET')
-        self.send_header('Cache-Control', 'no-store, no-cache, must-revalidate')
+        self.send_header('Cache-Control', getattr(self, 'cache_control', 'no-store, no-cache, must-revalidate'))
         return super().end_headers()
-        
+
     def handle_one_request(self):
         try:
             return super().handle_one_request()
@@ -19,17 +46,201 @@ class CORSHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         except Exception as e:
             print(f"Error handling request: {e}")
 
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == API_PREFIX or path.startswith(API_PREFIX + '/'):
+            return self.handle_city_api(path, parse_qs(urlsplit(self.path).query))
+        return super().do_GET()
+
+    def send_json(self, payload, status=http.HTTPStatus.OK):
+        body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        self.send_body(body, 'application/json', status)
+
+    def send_body(self, body, content_type, status=http.HTTPStatus.OK):
+        self.cache_control = 'no-store'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_city_api(self, path, query):
+        """Serve city summaries and filtered cells from the column cache.
+
+        /api/city lists the cities; /api/city/<name> describes one city;
+        adding metric (and optional min/max) returns the matching cells as
+        cell IDs (format=ids, the default), GeoJSON squares
+        (format=geojson) or little-endian uint32 row indices (format=rows).
+        """
+        name = unquote(path[len(API_PREFIX):]).strip('/')
+        if not name:
+            return self.send_json({'cities': self.city_cache.city_names(), 'cache': self.city_cache.stats()})
+        metric = query.get('metric', [None])[0]
+        output_format = query.get('format', ['ids'])[0]
+        try:
+            low = float(query['min'][0]) if 'min' in query else None
+            high = float(query['max'][0]) if 'max' in query else None
+        except ValueError:
+            return self.send_json({'error': 'min and max must be numbers'}, http.HTTPStatus.BAD_REQUEST)
+        if output_format not in ('ids', 'geojson', 'rows'):
+            return self.send_json({'error': f"Unknown format '{output_format}'"}, http.HTTPStatus.BAD_REQUEST)
+
+        try:
+            if metric is None:
+                entry = self.city_cache.get(name)
+                return self.send_json({
+                    'city': name,
+                    'count': entry['header']['count'],
+                    'spacing': entry['header']['spacing'],
+                    'metrics': [column for column in entry['columns'] if column not in ('Latitude', 'Longitude')]
+                })
+            entry, rows = self.city_cache.query(name, metric, low, high)
+        except KeyError as e:
+            return self.send_json({'error': f"Not found: {e.args[0]}"}, http.HTTPStatus.NOT_FOUND)
+
+        if output_format == 'rows':
+            return self.send_body(rows.astype('<u4').tobytes(), 'application/octet-stream')
+        if output_format == 'geojson':
+            return self.send_json(rows_geojson(entry, rows, [metric]))
+        self.send_json({
+            'city': name,
+            'metric': metric,
+            'min': low,
+            'max': high,
+            'count': int(len(rows)),
+            'ids': [str(cell_id) for cell_id in row_cell_ids(entry, rows).tolist()]
+        })
+
+    def precompressed_variant(self, path):
+        """A .br/.gz sibling of path the client accepts, as (encoding, path)."""
+        accepted = [token.split(';')[0].strip().lower()
+                    for token in self.headers.get('Accept-Encoding', '').split(',')]
+        for encoding, extension in PRECOMPRESSED:
+            # Skip siblings left over from an earlier build of the file
+            if (encoding in accepted and os.path.isfile(path + extension)
+                    and os.path.getmtime(path + extension) >= os.path.getmtime(path)):
+                return encoding, path + extension
+        return None, path
+
+    def not_modified(self, etag, mtime):
+        """True when the request's validators match the file."""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            return etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since
+        return False
+
+    def byte_range(self, size, etag):
+        """The (start, end) the client asked for, None for the whole file, or 'invalid'."""
+        header = self.headers.get('Range')
+        if not header:
+            return None
+        if_range = self.headers.get('If-Range')
+        if if_range and if_range.strip() != etag:
+            return None
+        match = RANGE_PATTERN.match(header.strip())
+        if not match or match.groups() == ('', ''):
+            return None  # Multiple or malformed ranges: send the whole file
+        first, last = match.groups()
+        if first == '':
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+        if start >= size or start > end:
+            return 'invalid'
+        return start, end
+
+    def send_head(self):
+        """Serve files with validators, ranges and precompressed siblings.
+
+        Directories and missing files fall back to SimpleHTTPRequestHandler.
+        """
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path) or self.path.endswith('/'):
+            self.cache_control = 'no-store, no-cache, must-revalidate'
+            return super().send_head()
+        if path.lower().endswith(NO_STORE_EXTENSIONS):
+            self.cache_control = 'no-store, no-cache, must-revalidate'
+        else:
+            self.cache_control = 'no-cache'
+
+        encoding, served_path = self.precompressed_variant(path)
+        try:
+            f = open(served_path, 'rb')
+        except OSError:
+            self.send_error(http.HTTPStatus.NOT_FOUND, "File not found")
+            return None
+        try:
+            stat = os.fstat(f.fileno())
+            etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}{"-" + encoding if encoding else ""}"'
+            last_modified = self.date_time_string(stat.st_mtime)
+
+            if self.not_modified(etag, stat.st_mtime):
+                f.close()
+                self.send_response(http.HTTPStatus.NOT_MODIFIED)
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+                self.send_header('Vary', 'Accept-Encoding')
+                self.end_headers()
+                return None
+
+            byte_range = self.byte_range(stat.st_size, etag)
+            if byte_range == 'invalid':
+                f.close()
+                self.send_response(http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header('Content-Range', f'bytes */{stat.st_size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+
+            if byte_range:
+                start, end = byte_range
+                f.seek(start)
+                body = io.BytesIO(f.read(end - start + 1))
+                f.close()
+                f = body
+                self.send_response(http.HTTPStatus.PARTIAL_CONTENT)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{stat.st_size}')
+                length = end - start + 1
+            else:
+                self.send_response(http.HTTPStatus.OK)
+                length = stat.st_size
+            self.send_header('Content-Type', self.guess_type(path))
+            if encoding:
+                self.send_header('Content-Encoding', encoding)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(length))
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.end_headers()
+            return f
+        except Exception:
+            f.close()
+            raise
+
+class ThreadingServer(http.server.ThreadingHTTPServer):
+    # One slow client no longer blocks the others; don't wait on them at exit
+    daemon_threads = True
+
 if __name__ == '__main__':
     PORT = 8001
-    
+
     # Change to the directory containing this script
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
-    
+
     Handler = partial(CORSHTTPRequestHandler, directory=os.getcwd())
-    
+    CORSHTTPRequestHandler.city_cache = CityColumnCache(CITY_DATA_DIR, CITY_CACHE_MB * 1024 * 1024)
+
     while True:
         try:
-            with socketserver.TCPServer(("", PORT), Handler) as httpd:
+            with ThreadingServer(("", PORT), Handler) as httpd:
                 print(f"Serving at port {PORT}...")
                 httpd.serve_forever()
         except OSError as e:
@@ -2,7 +2,13 @@
 let map;
 let currentCity;
 let currentLayer;
-let kmlData;
+// Features of the full-resolution layer, from the KML or the .bin file
+let cityFeatures = [];
+// Per-metric statistics written by generate_city_kml.py
+let cityStats = null;
+// Coarser levels written by generate_city_kml.py --lod
+let lodLayers = [];
+let lodSummed = new Set();
 const schoolsLayer = 'schools-layer';
 
 // Initialize map
@@ -60,7 +66,12 @@ function initControls() {
 
 async function loadCity(cityId) {
     try {
-        // Remove existing city layer
+        // Remove existing city layers
+        lodLayers.forEach(({ id }) => {
+            map.removeLayer(id);
+            map.removeSource(id);
+        });
+        lodLayers = [];
         if (currentLayer) {
             map.removeLayer(currentLayer);
             map.removeSource(currentLayer);
@@ -69,17 +80,16 @@ async function loadCity(cityId) {
         currentCity = cityId;
         const city = config.cities[cityId];
         
-        // Load and parse KML
-        const response = await fetch(city.kmlFile);
-        const kmlText = await response.text();
-        const parser = new DOMParser();
-        kmlData = parser.parseFromString(kmlText, 'text/xml');
-        
-        // Convert to GeoJSON
-        const geojson = kmlToGeoJSON(kmlData);
+        // Prefer the compact columnar file when the build produced one
+        const geojson = (city.binFile && await loadCityBinary(city.binFile)) || await loadKmlFile(city.kmlFile);
+        cityFeatures = geojson.features;
+        cityStats = city.statsFile ? await fetchJson(city.statsFile) : null;
         
         // Add source and layer
         addGeoJSONLayer(geojson, cityId);
+        if (city.lodFile) {
+            await loadLodLevels(city.lodFile, cityId);
+        }
         
         // Update map view
         map.flyTo({
@@ -127,10 +137,138 @@ function addGeoJSONLayer(geojson, layerId) {
     updateMetricsList();
 }
 
+async function loadKmlFile(kmlFile) {
+    const response = await fetch(kmlFile);
+    if (!response.ok) throw new Error(`${kmlFile}: HTTP ${response.status}`);
+    const kmlText = await response.text();
+    return kmlToGeoJSON(new DOMParser().parseFromString(kmlText, 'text/xml'));
+}
+
+async function fetchJson(url) {
+    try {
+        const response = await fetch(url);
+        return response.ok ? await response.json() : null;
+    } catch (error) {
+        console.warn(`Could not load ${url}:`, error);
+        return null;
+    }
+}
+
+// Load the columnar .bin file written by generate_city_kml.py --binary;
+// returns null so the caller can fall back to the KML
+async function loadCityBinary(binFile) {
+    try {
+        const response = await fetch(binFile);
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        const buffer = await response.arrayBuffer();
+        const headerLength = new DataView(buffer).getUint32(0, true);
+        const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, headerLength)));
+        const dataStart = 4 + headerLength;
+        const arrayTypes = {
+            float64: Float64Array, float32: Float32Array,
+            uint8: Uint8Array, uint16: Uint16Array, uint32: Uint32Array,
+            int16: Int16Array, int32: Int32Array
+        };
+        
+        // Typed array views over each column; scaled integer columns
+        // (see data/output_schema.csv) are decoded once
+        const columns = {};
+        header.columns.forEach(column => {
+            const values = new arrayTypes[column.type](buffer, dataStart + column.offset, header.count);
+            columns[column.name] = column.scale ? Float64Array.from(values, v => v / column.scale) : values;
+        });
+        
+        const halfLat = header.spacing.lat / 2;
+        const halfLon = header.spacing.lon / 2;
+        const lats = columns.Latitude;
+        const lons = columns.Longitude;
+        const metricNames = header.columns.map(column => column.name)
+            .filter(name => name !== 'Latitude' && name !== 'Longitude');
+        
+        const features = new Array(header.count);
+        for (let i = 0; i < header.count; i++) {
+            const west = lons[i] - halfLon, east = lons[i] + halfLon;
+            const south = lats[i] - halfLat, north = lats[i] + halfLat;
+            const properties = {};
+            metricNames.forEach(name => {
+                properties[name] = columns[name][i];
+            });
+            features[i] = {
+                type: 'Feature',
+                geometry: {
+                    type: 'Polygon',
+                    coordinates: [[[west, south], [east, south], [east, north], [west, north], [west, south]]]
+                },
+                properties: properties
+            };
+        }
+        
+        return {
+            type: 'FeatureCollection',
+            features: features
+        };
+    } catch (error) {
+        console.error('Error loading binary city file:', error);
+        return null;
+    }
+}
+
+async function loadLodLevels(lodFile, cityId) {
+    const response = await fetch(lodFile);
+    const lod = await response.json();
+    const baseDir = lodFile.substring(0, lodFile.lastIndexOf('/') + 1);
+    lodSummed = new Set(lod.summed);
+    
+    // Each level is its own layer, drawn only within its zoom range
+    for (const level of lod.levels) {
+        if (level.factor === 1) {
+            map.setLayerZoomRange(currentLayer, level.minzoom ?? 0, level.maxzoom ?? 24);
+            continue;
+        }
+        const geojson = (level.binFile && await loadCityBinary(baseDir + level.binFile))
+            || await loadKmlFile(baseDir + level.file);
+        const layerId = `${cityId}-x${level.factor}`;
+        map.addSource(layerId, {
+            type: 'geojson',
+            data: geojson
+        });
+        map.addLayer({
+            id: layerId,
+            type: 'fill',
+            source: layerId,
+            minzoom: level.minzoom ?? 0,
+            maxzoom: level.maxzoom ?? 24,
+            paint: {
+                'fill-opacity': 1,
+                'fill-outline-color': 'rgba(0,0,0,0)'
+            }
+        });
+        lodLayers.push({ id: layerId, factor: level.factor });
+    }
+}
+
+function setFillColor(metric, steps) {
+    // Tiles leave zero values out of a feature's properties
+    const metricValue = ['coalesce', ['get', metric], 0];
+    map.setPaintProperty(currentLayer, 'fill-color', [
+        'interpolate',
+        ['linear'],
+        metricValue,
+        ...steps
+    ]);
+    lodLayers.forEach(({ id, factor }) => {
+        // Summed metrics grow with block area; scale back to per-cell values
+        const value = lodSummed.has(metric) ? ['/', metricValue, factor * factor] : metricValue;
+        map.setPaintProperty(id, 'fill-color', ['interpolate', ['linear'], value, ...steps]);
+    });
+}
+
 async function loadSchools() {
     try {
-        const response = await fetch(config.schools.source);
-        const geojson = await response.json();
+        // With a tile index, start empty and fetch only the tiles in view
+        const geojson = config.schools.tileIndex
+            ? { type: 'FeatureCollection', features: [] }
+            : await fetch(config.schools.source).then(res => res.json());
         
         // Add source
         map.addSource('schools', {
@@ -181,14 +319,66 @@ async function loadSchools() {
             map.getCanvas().style.cursor = '';
         });
         
+        if (config.schools.tileIndex) {
+            const response = await fetch(config.schools.tileIndex);
+            schoolTiles.index = await response.json();
+            map.on('moveend', loadSchoolTilesInView);
+            await loadSchoolTilesInView();
+        }
+        
     } catch (error) {
         console.error('Error loading schools:', error);
     }
 }
 
+// Schools partitioned by geocode_schools.py --tiles-dir
+const schoolTiles = { index: null, loaded: new Set(), pending: new Set(), features: [] };
+
+async function loadSchoolTilesInView() {
+    if (!schoolTiles.index) return;
+    
+    const bounds = map.getBounds();
+    const minTuition = parseFloat(document.getElementById('minTuition').value) || 0;
+    const baseUrl = config.schools.tileIndex.substring(0, config.schools.tileIndex.lastIndexOf('/') + 1);
+    
+    // Tiles in view that have not been fetched and can pass the tuition filter
+    const wanted = Object.entries(schoolTiles.index.tiles).filter(([quadkey, tile]) => {
+        const [west, south, east, north] = tile.bbox;
+        return !schoolTiles.loaded.has(quadkey) && !schoolTiles.pending.has(quadkey)
+            && tile.tuition_max !== null && tile.tuition_max >= minTuition
+            && west <= bounds.getEast() && east >= bounds.getWest()
+            && south <= bounds.getNorth() && north >= bounds.getSouth();
+    });
+    if (wanted.length === 0) return;
+    
+    // A tile only counts as loaded once its response arrived, so failed
+    // requests are retried on the next move
+    const collections = await Promise.all(wanted.map(async ([quadkey, tile]) => {
+        schoolTiles.pending.add(quadkey);
+        try {
+            const response = await fetch(baseUrl + tile.file);
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            const collection = await response.json();
+            schoolTiles.loaded.add(quadkey);
+            return collection;
+        } catch (error) {
+            console.warn(`Could not load school tile ${quadkey}:`, error);
+            return null;
+        } finally {
+            schoolTiles.pending.delete(quadkey);
+        }
+    }));
+    const loaded = collections.filter(collection => collection);
+    if (loaded.length === 0) return;
+    loaded.forEach(collection => schoolTiles.features.push(...collection.features));
+    map.getSource('schools').setData({ type: 'FeatureCollection', features: schoolTiles.features });
+}
+
 function filterSchools() {
     const minTuition = parseFloat(document.getElementById('minTuition').value) || 0;
     map.setFilter(schoolsLayer, ['all', ['has', 'tuition'], ['>=', ['get', 'tuition'], minTuition]]);
+    // A lower threshold can make tiles skipped earlier relevant
+    loadSchoolTilesInView();
 }
 
 function kmlToGeoJSON(kmlData) {
@@ -267,37 +457,36 @@ function updateMetricsList() {
 function displayMetric(metric) {
     if (!currentLayer || !metric) return;
     
-    // Get all values for this metric
-    const values = [];
-    const placemarks = kmlData.getElementsByTagName('Placemark');
-    
-    // Loop through each placemark to get values for the selected metric
-    for (const placemark of placemarks) {
-        const dataElements = placemark.getElementsByTagName('data');
-        for (const data of dataElements) {
-            if (data.getAttribute('name') === metric) {
-                const value = parseFloat(data.textContent.trim());
-                if (!isNaN(value)) {
-                    values.push(value);
-                }
-                break; // Found the metric for this placemark
-            }
-        }
+    // Use the build's precomputed statistics when the city has them
+    let stats;
+    const precomputed = cityStats?.metrics?.[metric];
+    if (precomputed) {
+        stats = {
+            min: precomputed.min,
+            max: precomputed.max,
+            mean: precomputed.mean,
+            median: precomputed.quantiles['0.5']
+        };
+    } else {
+        // Get all values for this metric
+        const values = cityFeatures
+            .map(feature => parseFloat(feature.properties[metric]))
+            .filter(value => !isNaN(value));
+        
+        if (values.length === 0) return;
+        
+        // Calculate statistics
+        values.sort((a, b) => a - b); // Sort for median calculation
+        stats = {
+            min: values[0],
+            max: values[values.length - 1],
+            mean: values.reduce((sum, val) => sum + val, 0) / values.length,
+            median: values.length % 2 === 0 
+                ? (values[values.length/2 - 1] + values[values.length/2]) / 2
+                : values[Math.floor(values.length/2)]
+        };
     }
     
-    if (values.length === 0) return;
-    
-    // Calculate statistics
-    values.sort((a, b) => a - b); // Sort for median calculation
-    const stats = {
-        min: values[0],
-        max: values[values.length - 1],
-        mean: values.reduce((sum, val) => sum + val, 0) / values.length,
-        median: values.length % 2 === 0 
-            ? (values[values.length/2 - 1] + values[values.length/2]) / 2
-            : values[Math.floor(values.length/2)]
-    };
-    
     // Update statistics display
     const minElement = document.getElementById('current-min');
     const maxElement = document.getElementById('current-max');
@@ -346,12 +535,7 @@ function displayMetric(metric) {
     }
     
     // Update layer style
-    map.setPaintProperty(currentLayer, 'fill-color', [
-        'interpolate',
-        ['linear'],
-        ['get', metric],
-        ...steps
-    ]);
+    setFillColor(metric, steps);
 }
 
 // Add event listener for the apply range button
@@ -372,12 +556,7 @@ document.getElementById('apply-range')?.addEventListener('click', () => {
         }
         
         // Update layer style
-        map.setPaintProperty(currentLayer, 'fill-color', [
-            'interpolate',
-            ['linear'],
-            ['get', currentMetric],
-            ...steps
-        ]);
+        setFillColor(currentMetric, steps);
     }
 });
 
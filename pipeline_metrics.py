@@ -0,0 +1,249 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+RUN_LOG_FILE = Path(__file__).parent / 'pipeline_runs.jsonl'
+LATENCY_BUCKETS_MS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+PROFILE_TOP = 25
+TRACEMALLOC_TOP = 10
+
+# The run started by start_run; the module-level helpers are no-ops without one,
+# so library callers and benchmarks pay nothing
+_active = None
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB (None where unavailable)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round((peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024), 1)
+
+class LatencyHistogram:
+    """Counts of observed latencies in fixed millisecond buckets."""
+
+    def __init__(self, bounds_ms=LATENCY_BUCKETS_MS):
+        self.bounds_ms = list(bounds_ms)
+        self.counts = [0] * (len(self.bounds_ms) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        bucket = next((i for i, bound in enumerate(self.bounds_ms) if ms <= bound), len(self.bounds_ms))
+        self.counts[bucket] += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding quantile q (the max for the overflow bucket)."""
+        count = sum(self.counts)
+        if not count:
+            return None
+        seen = 0
+        for bound, bucket_count in zip(self.bounds_ms + [self.max], self.counts):
+            seen += bucket_count
+            if seen >= q * count:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        count = sum(self.counts)
+        labels = [f'<={bound}ms' for bound in self.bounds_ms] + [f'>{self.bounds_ms[-1]}ms']
+        return {
+            'count': count,
+            'mean_ms': round(self.total / count, 2) if count else None,
+            'p50_ms': self.quantile(0.5),
+            'p90_ms': self.quantile(0.9),
+            'p99_ms': self.quantile(0.99),
+            'max_ms': round(self.max, 2),
+            'buckets': dict(zip(labels, self.counts))
+        }
+
+class RunLog:
+    """One pipeline run written as JSON lines: run_start, one line per stage, run_end.
+
+    Stages carry wall time, rows, rows per second and peak RSS (plus the
+    tracemalloc peak with trace_memory). Stage totals, counters, cache hit
+    ratios and latency histograms are written with run_end. With profile
+    set, cProfile runs for the whole run and its stats are dumped there.
+    Worker processes forked from the run append their stage lines to the
+    same log; their totals are not merged into run_end.
+    """
+
+    def __init__(self, script, path=RUN_LOG_FILE, profile=None, trace_memory=False, settings=None):
+        self.script = script
+        self.path = path
+        self.profile_path = profile
+        self.trace_memory = trace_memory
+        self.settings = settings or {}
+        self.run_id = uuid.uuid4().hex[:12]
+        self.totals = {}
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8') if path else None
+        self._profiler = None
+        self._start = time.perf_counter()
+
+    def __enter__(self):
+        self.write('run_start', argv=sys.argv, settings=self.settings)
+        if self.trace_memory:
+            tracemalloc.start()
+        if self.profile_path:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close('error' if exc_type else 'ok', str(exc) if exc else None)
+
+    def write(self, event, **fields):
+        """Append one JSON line to the run log."""
+        if self._file is None:
+            return
+        record = {'event': event, 'run_id': self.run_id, 'script': self.script, 'pid': os.getpid(),
+                  'time': datetime.now().isoformat(timespec='milliseconds'), **fields}
+        line = json.dumps(record, default=str) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def add_time(self, name, seconds, rows=None):
+        """Add to a stage's totals without writing a line, for work done in many small pieces."""
+        with self._lock:
+            total = self.totals.setdefault(name, {'seconds': 0.0, 'rows': 0, 'calls': 0})
+            total['seconds'] += seconds
+            total['rows'] += rows or 0
+            total['calls'] += 1
+
+    @contextmanager
+    def stage(self, name, rows=None, **fields):
+        """Time a block and write it as a stage line.
+
+        rows may be given up front or set later through the yielded
+        dict, e.g. once a CSV has been read.
+        """
+        info = {'rows': rows}
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            seconds = time.perf_counter() - start
+            rows = info['rows']
+            self.add_time(name, seconds, rows)
+            record = {'stage': name, 'seconds': round(seconds, 6), 'rows': rows,
+                      'rows_per_sec': round(rows / seconds, 1) if rows and seconds > 0 else None,
+                      'peak_rss_mb': peak_rss_mb(), **fields}
+            if self.trace_memory:
+                record['traced_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+            self.write('stage', **record)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        """Record one latency sample, e.g. a geocoder request."""
+        with self._lock:
+            self.histograms.setdefault(name, LatencyHistogram()).add(seconds)
+
+    def cache_ratios(self):
+        """Hit ratio of every <name>_hits/<name>_misses counter pair."""
+        ratios = {}
+        for name, hits in self.counters.items():
+            if name.endswith('_hits'):
+                misses = self.counters.get(name[:-len('_hits')] + '_misses', 0)
+                ratios[name[:-len('_hits')]] = round(hits / (hits + misses), 4) if hits + misses else None
+        return ratios
+
+    def close(self, status='ok', error=None):
+        if self._start is None:
+            return
+        seconds = time.perf_counter() - self._start
+        self._start = None
+        summary = {'status': status, 'error': error, 'seconds': round(seconds, 6), 'peak_rss_mb': peak_rss_mb()}
+        summary['stages'] = {name: {**total, 'seconds': round(total['seconds'], 6),
+                                    'rows_per_sec': round(total['rows'] / total['seconds'], 1)
+                                    if total['rows'] and total['seconds'] > 0 else None}
+                             for name, total in self.totals.items()}
+        summary['counters'] = self.counters
+        summary['cache_hit_ratio'] = self.cache_ratios()
+        summary['latency'] = {name: histogram.summary() for name, histogram in self.histograms.items()}
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.profile_path)
+            summary['profile'] = str(self.profile_path)
+            report = io.StringIO()
+            pstats.Stats(self._profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_TOP)
+            print(report.getvalue())
+        if self.trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            summary['top_allocations'] = [
+                {'where': str(stat.traceback), 'size_mb': round(stat.size / (1024 * 1024), 2), 'count': stat.count}
+                for stat in snapshot.statistics('lineno')[:TRACEMALLOC_TOP]]
+            tracemalloc.stop()
+        self.write('run_end', **summary)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def add_arguments(parser):
+    """Add the --run-log, --profile and --trace-memory options to a script's parser."""
+    parser.add_argument('--run-log', default=str(RUN_LOG_FILE),
+                        help=f'JSON-lines log of stage timings and memory ("" to disable, default: {RUN_LOG_FILE.name})')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Profile the run with cProfile, dump the stats to FILE and print the top functions')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Track Python allocations with tracemalloc: per-stage peaks and top allocation sites')
+
+def start_run(script, args=None, settings=None):
+    """Start the run that the module-level helpers report to; use as a context manager."""
+    global _active
+    _active = RunLog(script,
+                     path=getattr(args, 'run_log', str(RUN_LOG_FILE)) or None,
+                     profile=getattr(args, 'profile', None),
+                     trace_memory=getattr(args, 'trace_memory', False),
+                     settings=settings if settings is not None else vars(args) if args is not None else None)
+    return _active
+
+@contextmanager
+def stage(name, rows=None, **fields):
+    """Time a block as a stage of the active run; yields a dict whose 'rows' may be set."""
+    if _active is None:
+        yield {'rows': rows}
+        return
+    with _active.stage(name, rows, **fields) as info:
+        yield info
+
+def add_time(name, seconds, rows=None):
+    if _active is not None:
+        _active.add_time(name, seconds, rows)
+
+def count(name, amount=1):
+    if _active is not None:
+        _active.count(name, amount)
+
+def observe(name, seconds):
+    if _active is not None:
+        _active.observe(name, seconds)
+
+def enabled():
+    """True when a run is active, so callers can skip timing work nobody records."""
+    return _active is not None
@@ -1,58 +1,73 @@
 import os
-import json
 import re
+import argparse
+
+import pipeline_metrics
+
+# A city's kmlFile line plus any sibling entries written by an earlier run
+CITY_FILES_PATTERN = re.compile(
+    r"^(?P<indent>[ \t]*)kmlFile:\s*'data/KMLs/(?P<kml>[^']+)',?[ \t]*\n"
+    r"(?:[ \t]*(?:binFile|statsFile|lodFile):\s*'[^']*',?[ \t]*\n)*",
+    re.MULTILINE)
+
+# Files written next to <City>.kml by generate_city_kml.py, in config order
+SIBLING_FILES = [
+    ('binFile', '.bin'),         # columnar cells, loaded in place of the KML
+    ('statsFile', '.stats.json'),  # per-metric min/max/quantiles for the stats panel
+    ('lodFile', '.lod.json')     # coarser levels for zoomed-out views
+]
 
 def read_config(file_path):
     with open(file_path, 'r', encoding='utf-8') as f:
         content = f.read()
-        # Extract everything before and after the polygonLayers array
-        pattern = r'(.*?polygonLayers\s*:\s*\[)([^\]]*?)(\].*)'
-        match = re.search(pattern, content, re.DOTALL)
-        if not match:
-            raise ValueError("Could not find polygonLayers in config")
-        return match.group(1), match.group(3)
-
-def write_config(file_path, prefix, suffix, polygon_layers):
-    # Format the polygon layers as JavaScript
-    layers_str = '\n'
-    for layer in polygon_layers:
-        layers_str += ' ' * 8 + '{\n'
-        layers_str += ' ' * 12 + f'name: "{layer["name"]}",\n'
-        layers_str += ' ' * 12 + f'file: "{layer["file"]}"\n'
-        layers_str += ' ' * 8 + '},\n'
-    
-    # Remove the trailing comma from the last entry if there are entries
-    if polygon_layers:
-        layers_str = layers_str.rstrip(',\n') + '\n'
-    
-    # Combine everything
-    new_content = prefix + layers_str + suffix
-    
+    if not re.search(r'cities\s*:\s*\{', content):
+        raise ValueError("Could not find cities in config")
+    return content
+
+def write_config(file_path, content):
     with open(file_path, 'w', encoding='utf-8') as f:
-        f.write(new_content)
+        f.write(content)
+
+def city_file_entries(kml_file, kmls_dir):
+    """binFile/statsFile/lodFile entries for the files built next to a city's KML."""
+    base = os.path.splitext(kml_file)[0]
+    return [(key, f'data/KMLs/{base}{extension}') for key, extension in SIBLING_FILES
+            if os.path.exists(os.path.join(kmls_dir, base + extension))]
 
-def update_polygon_layers(config_path, kmls_dir):
-    # Read existing config structure
-    prefix, suffix = read_config(config_path)
+def update_city_files(config_path, kmls_dir):
+    content = read_config(config_path)
     
     # Get list of KML files
-    kml_files = sorted([f for f in os.listdir(kmls_dir) if f.lower().endswith('.kml')])
+    with pipeline_metrics.stage('scan') as scanned:
+        kml_files = sorted([f for f in os.listdir(kmls_dir) if f.lower().endswith('.kml')])
+        scanned['rows'] = len(kml_files)
     
-    # Create new polygon layers
-    polygon_layers = []
-    for kml_file in kml_files:
-        name = os.path.splitext(kml_file)[0]  # Remove .kml extension
-        name = name.replace('_', ' ')  # Replace underscores with spaces
-        polygon_layers.append({
-            'name': name,
-            'file': f'data/KMLs/{kml_file}'
-        })
+    configured = set()
+    def replace(match):
+        kml_file = match.group('kml')
+        configured.add(kml_file)
+        entries = [('kmlFile', f'data/KMLs/{kml_file}')] + city_file_entries(kml_file, kmls_dir)
+        lines = [f"{match.group('indent')}{key}: '{value}'," for key, value in entries]
+        # Keep the comma only where the last replaced line had one
+        if not match.group(0).rstrip().endswith(','):
+            lines[-1] = lines[-1][:-1]
+        return '\n'.join(lines) + '\n'
     
     # Write updated config
-    write_config(config_path, prefix, suffix, polygon_layers)
+    with pipeline_metrics.stage('write', len(kml_files)):
+        write_config(config_path, CITY_FILES_PATTERN.sub(replace, content))
+    
+    for kml_file in kml_files:
+        if kml_file not in configured:
+            print(f"Warning: {kml_file} has no entry in config.cities")
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Point each city in config.js at the .bin, stats and LOD files built next to its KML")
+    pipeline_metrics.add_arguments(parser)
+    args = parser.parse_args()
     config_path = 'config.js'
     kmls_dir = 'data/KMLs'
-    update_polygon_layers(config_path, kmls_dir)
+    with pipeline_metrics.start_run('update_config', args):
+        update_city_files(config_path, kmls_dir)
     print("Config file updated successfully!")